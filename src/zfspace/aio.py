@@ -0,0 +1,141 @@
+""" asyncio flavour of ZfsBridge range queries.
+
+Snapshot range dry-runs are started as asyncio subprocesses, and every pyramid cell is reported as soon as
+the queries it depends on are done. It lets SnapshotSpace draw the pyramid while it is still being calculated.
+The exec and shell transports, and the ssh and command ones built on them, start their zfs as an asyncio
+subprocess. Any other transport, like coproc, runs its queries in threads of the event loop executor.
+"""
+
+import time
+import asyncio
+import subprocess
+
+from .zfspace import ZfsBridge, TriangularMatrix, ShellTransport, ExecTransport
+
+
+class AsyncZfsBridge:
+    """
+    Runs snapshot range queries of a ZfsBridge with asyncio.
+    The ZfsBridge provides the transport, the limit of parallel queries, the timeout and the cache.
+    """
+    def __init__(self, zb: ZfsBridge):
+        self.zb = zb
+
+    async def _start(self, args):
+        """Starts zfs the way the transport does. Returns None if the transport doesn't start a process per command."""
+        transport = self.zb.transport
+        if type(transport).run is ExecTransport.run:
+            return await asyncio.create_subprocess_exec(
+                *transport.argv(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if type(transport).run is ShellTransport.run:
+            return await asyncio.create_subprocess_shell(
+                transport.command(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return None
+
+    async def run(self, args):
+        """Runs zfs with the args list through the transport and returns its standard output.
+        The zfs process is killed if the query is cancelled or runs out of time. A transport without a process
+        per command, like coproc, runs the query in an executor thread and handles the timeout itself,
+        so a cancelled query there finishes in the background."""
+        start = time.monotonic()
+        output = None
+        try:
+            process = await self._start(args)
+            if process is None:
+                output = await asyncio.get_event_loop().run_in_executor(
+                    None, self.zb.transport.run, args, self.zb.timeout)
+                return output
+            try:
+                output, _ = await asyncio.wait_for(process.communicate(), self.zb.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise TimeoutError('"{}" did not finish in {} seconds.'.format(
+                    self.zb.transport.command(args), self.zb.timeout))
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                raise
+        finally:
+            self.zb.profiler.record_command(args, start, time.monotonic() - start,
+                                            None if output is None else len(output))
+        return output.decode()
+
+    async def get_snapshots_space(self, dataset_name, snapshot_list, bounds=None, callback=None):
+        """The same as ZfsBridge.get_snapshots_space, but the queries of the shortest ranges go first.
+
+        :param callback: Function called with (row, col, exclusive size, would free size) arguments for every
+            pyramid cell as soon as its exclusive size is known
+        :return: Two TriangularMatrix like ZfsBridge.get_snapshots_space
+        """
+        self.zb._check_dataset_name(dataset_name)
+        if bounds is None:
+            bounds = [(i, i) for i in range(len(snapshot_list))]
+        size = len(bounds)
+        used_matrix, would_free_matrix = TriangularMatrix.pair(size)
+        cells = [(row, col) for row in range(size) for col in range(size - row)]  # The bottom row goes first
+        pairs = [(bounds[col][0], bounds[col + row][1]) for row, col in cells]
+        sizes, keys = self.zb._cached_sizes(dataset_name, snapshot_list, pairs)
+        known = [[False] * (size - row) for row in range(size)]
+        reported = [[False] * (size - row) for row in range(size)]
+
+        def dependencies(row, col):
+            return [(row, col)] + [(row - 1, col), (row - 1, col + 1)] * (row > 0) + [(row - 2, col + 1)] * (row > 1)
+
+        def learn(row, col, freed):
+            would_free_matrix.set(row, col, freed)
+            known[row][col] = True
+            # The cell and the three cells above it, which use it in the inclusion-exclusion
+            for r, c in ((row, col), (row + 1, col), (row + 1, col - 1), (row + 2, col - 1)):
+                if 0 <= r < size and 0 <= c < size - r and not reported[r][c] and \
+                        all(known[i][j] for i, j in dependencies(r, c)):
+                    reported[r][c] = True
+                    used_matrix.set(r, c, would_free_matrix.exclusive_at(r, c))
+                    if callback is not None:
+                        callback(r, c, used_matrix.get(r, c), would_free_matrix.get(r, c))
+
+        semaphore = asyncio.Semaphore(self.zb.jobs)
+
+        async def query(index):
+            row, col = cells[index]
+            async with semaphore:
+                output = await self.run(['destroy', '-nvp', '{}@{}%{}'.format(
+                    dataset_name, snapshot_list[pairs[index][0]], snapshot_list[pairs[index][1]])])
+            freed = int(self.zb._parse_reclaim(output))
+            self.zb._store_size(dataset_name, keys[index], freed)
+            learn(row, col, freed)
+
+        for index, cached in enumerate(sizes):
+            if cached is not None:
+                learn(*cells[index], cached)
+        tasks = [asyncio.ensure_future(query(index)) for index, cached in enumerate(sizes) if cached is None]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()  # Stops the rest of the queries if one of them fails or Ctrl-C is pressed
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            if self.zb.cache is not None:
+                self.zb.cache.save()
+        return used_matrix, would_free_matrix
+
+
+def run_until_complete(coroutine):
+    """Runs a coroutine in a new event loop. Ctrl-C cancels it, killing zfs processes, and is raised afterwards."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    task = loop.create_task(coroutine)
+    try:
+        return loop.run_until_complete(task)
+    except KeyboardInterrupt:
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except (asyncio.CancelledError, Exception):
+            pass
+        raise
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
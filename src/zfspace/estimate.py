@@ -0,0 +1,123 @@
+""" Approximate snapshot pyramids from space properties.
+
+An exact pyramid needs a "zfs destroy -nvp" dry-run per snapshot range. The written@snapshot property of a newer
+snapshot tells how much of its referenced space was written after the older snapshot, and a block is referenced
+by a contiguous range of snapshots. So with b a snapshot after column i,
+    D(i, b) = written@(snapshot before column i) of b - written@(last snapshot of column i) of b
+is the space born in column i and still referenced by b. The space exclusive to columns i to j is
+D(i, first of j) - D(i, first of j + 1), and the space born in column i and gone before the next column is the sum
+of written of its snapshots minus D(i, first of i + 1). It takes two "zfs get" calls: written and used of every
+snapshot, and referenced and written@ column ends of the first snapshots of the columns and of the dataset.
+
+The dataset keeps changing while the properties are read, and zfs accounts some metadata differently for
+properties and dry-runs, so the estimate checks itself with redundant values: all cells add up to the space used
+by snapshots, a column of a single snapshot holds its used space and no cell is negative. The largest mismatch is
+the error bound of the cells. Cells can be confirmed with the range queries of the exact pyramid.
+"""
+
+from .zfspace import ZfsBridge, TriangularMatrix
+
+
+def _read_properties(zb: ZfsBridge, properties, targets, recursive=False):
+    """Reads properties of targets with a single "zfs get".
+
+    :return: A dict of (name, property) -> integer value or None, and the number of values
+    """
+    args = ['get', '-H', '-p', '-o', 'name,property,value']
+    if recursive:
+        args += ['-d', '1', '-t', 'snapshot']
+    values = dict()
+    for line in zb.transport.lines(args + [','.join(properties)] + list(targets)):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) == 3:
+            values[(fields[0], fields[1])] = int(fields[2]) if fields[2].isdigit() else None
+    return values, len(values)
+
+
+def _would_free(exclusive, would_free):
+    """Fills would_free with sums of the exclusive cells inside every range."""
+    for row in range(len(exclusive)):
+        for col in range(len(exclusive) - row):
+            size = exclusive.get(row, col)
+            if row == 1:
+                size += would_free.get(0, col) + would_free.get(0, col + 1)
+            elif row > 1:
+                size += would_free.get(row - 1, col) + would_free.get(row - 1, col + 1) - \
+                    would_free.get(row - 2, col + 1)
+            would_free.set(row, col, size)
+
+
+def estimate_snapshots_space(zb: ZfsBridge, dataset_name, snapshot_list, bounds=None):
+    """Estimates the pyramid of space occupied by snapshot ranges from written@ properties.
+
+    See ZfsBridge.get_snapshots_space for the arguments.
+    :return: A tuple of the two TriangularMatrix of get_snapshots_space, the error bound of a cell in bytes and the
+        number of property values read
+    """
+    zb._check_dataset_name(dataset_name)
+    if bounds is None:
+        bounds = [(i, i) for i in range(len(snapshot_list))]
+    size = len(bounds)
+    names = ['{}@{}'.format(dataset_name, name) for name in snapshot_list]
+    after = bounds[-1][1] + 1
+    # targets[j] is the first snapshot of column j, or the snapshot or the dataset after the last column for j = size
+    targets = [None] + [names[first] for first, _ in bounds[1:]] + [names[after] if after < len(names) else
+                                                                    dataset_name]
+    # marks[i] is the snapshot before column i, marks[size] is the last snapshot of the last column
+    marks = [first - 1 for first, _ in bounds] + [bounds[-1][1]]
+    with zb.profiler.phase('estimate'):
+        snapshot_values, count = _read_properties(zb, ['written', 'used'], [dataset_name], recursive=True)
+        properties = ['referenced'] + ['written@' + snapshot_list[mark] for mark in marks if mark >= 0]
+        values, targets_count = _read_properties(zb, properties, targets[1:])
+
+        def born_since(column, j):
+            """Space referenced by targets[j] and born after the snapshot before the column."""
+            prop = 'written@' + snapshot_list[marks[column]] if marks[column] >= 0 else 'referenced'
+            return values.get((targets[j], prop)) or 0
+
+        def alive(i, j):
+            """Space born in column i and referenced by targets[j]."""
+            return born_since(i, j) - born_since(i + 1, j)
+
+        exclusive, would_free = TriangularMatrix.pair(size)
+        error = 0
+        for i, (first, last) in enumerate(bounds):
+            born = sum(snapshot_values.get((names[index], 'written')) or 0 for index in range(first, last + 1))
+            cells = [born - alive(i, i + 1)] + [alive(i, j) - alive(i, j + 1) for j in range(i + 1, size)]
+            if first == last:
+                used = snapshot_values.get((names[first], 'used'))
+                if used is not None:
+                    error = max(error, abs(cells[0] - used))
+            for row, cell in enumerate(cells):
+                error = max(error, -cell)
+                exclusive.set(row, i, max(cell, 0))
+        if bounds[0][0] == 0 and after == len(names):
+            used = zb.index.datasets[dataset_name]['usedbysnapshots'] or 0
+            error = max(error, abs(sum(map(sum, exclusive)) - used))
+        _would_free(exclusive, would_free)
+    return exclusive, would_free, error, count + targets_count
+
+
+def refine_cells(zb: ZfsBridge, dataset_name, snapshot_list, bounds, exclusive, would_free, cells):
+    """Replaces estimated cells with exact values from range dry-runs, four per cell at most.
+    Ranges enclosing the refined cells are summed again.
+
+    :param cells: A list of (row, col) of the cells to refine
+    """
+    ranges = dict()  # (first column, last column) -> exact space freed by destroying the range
+    for row, col in cells:
+        for first, last in ((col, col + row), (col + 1, col + row), (col, col + row - 1), (col + 1, col + row - 1)):
+            if first <= last:
+                ranges[(first, last)] = None
+    pairs = list(ranges)
+    with zb.profiler.phase('range queries'):
+        sizes = zb._query_ranges(dataset_name, snapshot_list,
+                                 [(bounds[first][0], bounds[last][1]) for first, last in pairs])
+    ranges = dict(zip(pairs, sizes))
+    for row, col in cells:
+        first, last = col, col + row
+        exclusive.set(row, col, ranges[(first, last)] - ranges.get((first + 1, last), 0) -
+                      ranges.get((first, last - 1), 0) + ranges.get((first + 1, last - 1), 0))
+    _would_free(exclusive, would_free)
+    for (first, last), size in ranges.items():
+        would_free.set(last - first, first, size)
@@ -0,0 +1,213 @@
+""" Long running exporter of zfspace results as Prometheus metrics.
+
+Every cycle reads the whole pool with a single "zfs list" and exports the space breakdown of the tracked datasets.
+A snapshot pyramid is queried again only when the snapshots of its dataset have changed: a snapshot was created
+or destroyed (the list of snapshot guids differs) or the space held by snapshots has changed. With the range
+cache of the bridge, unchanged ranges come from the cache, so usually only the ranges ending at the newest snapshot
+are queried. Without it the whole changed pyramid is queried.
+Pyramid cells are labeled by their position counted from the newest snapshot, not by snapshot names, so rotating
+snapshots keep the same set of series instead of starting new ones every cycle.
+The number of range queries per cycle is limited. Pyramids that don't fit the limit keep their previous values
+and are marked stale until a later cycle gets to them, the longest waiting first.
+"""
+
+import os
+import sys
+import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from .zfspace import ZfsBridge, SnapshotSpace, space_columns
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def metric_line(name, labels, value):
+    """Formats a sample of the Prometheus text exposition format."""
+    if not labels:
+        return '{} {}'.format(name, value)
+    return '{}{{{}}} {}'.format(name, ','.join('{}="{}"'.format(key, _escape(label))
+                                               for key, label in labels.items()), value)
+
+
+metric_help = (
+    ('zfspace_space_bytes', 'gauge', 'Space of the dataset by zfs list -o space column.'),
+    ('zfspace_snapshots', 'gauge', 'Number of snapshots of the dataset.'),
+    ('zfspace_snapshot_range_bytes', 'gauge',
+     'Space of a snapshot pyramid cell: exclusive to the range or freed by destroying it. The range has length '
+     'columns and age newer columns after it.'),
+    ('zfspace_destroy_candidate_bytes', 'gauge', 'Space freed by destroying a recommended snapshot range, by rank.'),
+    ('zfspace_destroy_candidate_snapshots', 'gauge', 'Number of snapshots of a recommended snapshot range, by rank.'),
+    ('zfspace_pyramid_stale', 'gauge', '1 if the pyramid waits for a refresh because of the query limit.'),
+    ('zfspace_pyramid_timestamp_seconds', 'gauge', 'When the pyramid of the dataset was queried.'),
+    ('zfspace_refresh_seconds', 'gauge', 'Duration of the last refresh cycle.'),
+    ('zfspace_refresh_queries', 'gauge', 'Upper estimate of range queries of the last refresh cycle.'),
+    ('zfspace_refresh_timestamp_seconds', 'gauge', 'When the last refresh cycle finished.'),
+)
+
+
+class Exporter:
+    def __init__(self, zb: ZfsBridge, dataset_name, recursive=False, snapshot_args=None, query_budget=2000):
+        """
+        :param str dataset_name: The dataset to export
+        :param bool recursive: Export all descendants of the dataset too
+        :param dict snapshot_args: Keyword arguments for SnapshotSpace, like snapshot grouping options
+        :param int query_budget: Maximum number of range queries per cycle. At least one pyramid is
+            queried every cycle anyway, so every pyramid gets its turn.
+        The cache of zb is used as it is. Give it a RangeSpaceCache to query only the changed ranges again.
+        """
+        self.zb = zb
+        self.dataset_name = dataset_name
+        self.recursive = recursive
+        self.snapshot_args = dict(snapshot_args or dict())
+        self.prune = self.snapshot_args.pop('prune', None)
+        self.query_budget = query_budget
+        self.pyramids = dict()  # Dataset name -> (signature, query time, list of samples)
+        self.metrics = ''
+        self._lock = threading.Lock()
+
+    def datasets(self):
+        zb = self.zb
+        zb._check_dataset_name(self.dataset_name)
+        if not self.recursive:
+            return [self.dataset_name]
+        return [name for name in zb.index.datasets
+                if name == self.dataset_name or name.startswith(self.dataset_name + '/')]
+
+    def _signature(self, dataset_name):
+        return (tuple(info.guid for info in self.zb.index.snapshots.get(dataset_name, list())),
+                self.zb.index.datasets[dataset_name]['usedbysnapshots'])
+
+    def _pyramid_samples(self, ss: SnapshotSpace):
+        """Returns a list of (metric name, labels, value) of a queried pyramid."""
+        samples = list()
+        newest = len(ss.columns) - 1
+        for row, sizes in enumerate(ss.would_free_matrix):
+            for col, freed in enumerate(sizes):
+                labels = dict(dataset=ss.dataset_name, length=row + 1, age=newest - col - row)
+                samples.append(('zfspace_snapshot_range_bytes', dict(labels, kind='exclusive'),
+                                ss.snapshot_size_matrix.get(row, col)))
+                samples.append(('zfspace_snapshot_range_bytes', dict(labels, kind='would_free'), freed))
+        candidates = sorted(ss.get_destroy_candidates(3), reverse=True)
+        for rank, (size, count, first, last) in enumerate(candidates, 1):
+            labels = dict(dataset=ss.dataset_name, rank=rank)
+            samples.append(('zfspace_destroy_candidate_bytes', labels, size))
+            samples.append(('zfspace_destroy_candidate_snapshots', labels, count))
+        return samples
+
+    def refresh(self):
+        """Runs a refresh cycle and renders the metrics."""
+        start = time.time()
+        self.zb.refresh()
+        datasets = self.datasets()
+        for name in list(self.pyramids):
+            if name not in datasets or not self.zb.index.snapshots.get(name):
+                del self.pyramids[name]
+        changed = [name for name in datasets if self.zb.index.snapshots.get(name) and
+                   (name not in self.pyramids or self.pyramids[name][0] != self._signature(name))]
+        changed.sort(key=lambda name: self.pyramids[name][1] if name in self.pyramids else 0)
+        queries = 0
+        for name in changed:
+            signature = self._signature(name)
+            ss = SnapshotSpace(name, self.zb, **dict(self.snapshot_args, defer=True))
+            cost = 2 + ss.refine_count * 4 if ss.estimated else len(ss.columns) * (len(ss.columns) + 1) // 2
+            if queries and queries + cost > self.query_budget:
+                continue
+            queries += cost
+            ss.query(self.prune)
+            self.pyramids[name] = (signature, time.time(), self._pyramid_samples(ss))
+
+        samples = list()
+        for name in datasets:
+            props = self.zb.index.datasets[name]
+            for column, prop in space_columns[1:]:
+                samples.append(('zfspace_space_bytes', dict(dataset=name, column=column), props[prop] or 0))
+            samples.append(('zfspace_snapshots', dict(dataset=name), len(self.zb.index.snapshots.get(name, list()))))
+            if name in self.pyramids:
+                signature, queried, pyramid = self.pyramids[name]
+                samples.extend(pyramid)
+                samples.append(('zfspace_pyramid_stale', dict(dataset=name), int(signature != self._signature(name))))
+                samples.append(('zfspace_pyramid_timestamp_seconds', dict(dataset=name), queried))
+        samples.append(('zfspace_refresh_seconds', None, time.time() - start))
+        samples.append(('zfspace_refresh_queries', None, queries))
+        samples.append(('zfspace_refresh_timestamp_seconds', None, time.time()))
+
+        lines = list()
+        for metric, kind, text in metric_help:  # Samples of a metric must go together after its description
+            lines.append('# HELP {} {}'.format(metric, text))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            lines.extend(metric_line(*sample) for sample in samples if sample[0] == metric)
+        with self._lock:
+            self.metrics = '\n'.join(lines) + '\n'
+        return self.metrics
+
+    def get_metrics(self):
+        with self._lock:
+            return self.metrics
+
+    def write_textfile(self, path):
+        """Writes the metrics for the node exporter textfile collector. The file is replaced at once."""
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.get_metrics())
+        os.replace(path + '.tmp', path)
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_metrics(exporter: Exporter, address):
+    """Serves the last rendered metrics on http://address/metrics from a background thread.
+    Requests never start zfs queries, they get the result of the last cycle.
+
+    :param str address: Port or host:port to listen on
+    :return: The HTTP server, stop it with shutdown()
+    """
+    host, _, port = address.rpartition(':')
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = exporter.get_metrics().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _MetricsServer((host or '127.0.0.1', int(port)), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_exporter(exporter: Exporter, interval=300, textfile=None, listen=None, once=False):
+    """Refreshes the metrics every interval seconds, writing them to textfile and serving them on listen address.
+    A cycle starts no sooner than interval seconds after the previous one started, however long it took.
+    """
+    server = serve_metrics(exporter, listen) if listen else None
+    try:
+        while True:
+            start = time.monotonic()
+            try:
+                exporter.refresh()
+                if textfile:
+                    exporter.write_textfile(textfile)
+            except Exception as err:
+                if once:
+                    raise
+                print('Refresh failed: {}'.format(err), file=sys.stderr)  # The next cycle may succeed
+            if once:
+                return
+            time.sleep(max(0, interval - (time.monotonic() - start)))
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
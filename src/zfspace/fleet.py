@@ -0,0 +1,244 @@
+""" Analysis of many hosts at once.
+
+Every host gets its own ZfsBridge with a transport running zfs over ssh and its own worker pool, so --jobs bounds
+the queries of every host separately. ssh multiplexes all commands of a host over one master connection, which
+makes a dry-run cost a round trip instead of a handshake. Hosts are analyzed in parallel threads and reported as
+they finish, so a slow or unreachable host delays nothing but its own results, and hosts still busy at the deadline
+are left out. The ranked space users of every host come from pool.pool_report and are merged into one list.
+
+A host may also be a "name=command" stand-in running zfs through a local command, which is how the fleet is tested
+with the fake zfs.
+"""
+
+import os
+import sys
+import time
+import queue
+import shlex
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import namedtuple
+
+from .zfspace import ZfsBridge, ExecTransport, DivBar, size2human, term_format
+from .pool import pool_report
+
+# A ranked space user of pool.pool_report found on a host
+FleetItem = namedtuple('FleetItem', 'host size dataset part advice')
+# items is None if the analysis of the host failed or didn't finish in time, and error tells why.
+# finished is False for a host still busy at the deadline
+HostResult = namedtuple('HostResult', 'host items error seconds finished')
+
+
+class CommandTransport(ExecTransport):
+    """
+    Runs zfs through a local command line, like "env FAKE_ZFS_STATE=a.json tests/fake_zfs.py". The last word is
+    the zfs executable, which advice shows, and the words before it only wrap the commands.
+    """
+    name = 'command'
+
+    def __init__(self, command):
+        self.prefix = shlex.split(command)
+        super().__init__(self.prefix[-1])
+
+    def check(self):
+        if shutil.which(self.prefix[0]) is None:
+            raise FileNotFoundError('{} is not found on your computer.'.format(self.prefix[0]))
+
+    def argv(self, args):
+        return self.prefix + list(args)
+
+
+class SshTransport(ExecTransport):
+    """
+    Runs zfs on a remote host over ssh. The first command opens a master connection that ssh keeps for a minute
+    after the last command, and every other command of the host goes through it.
+    """
+    name = 'ssh'
+    connect_timeout = 10
+
+    def __init__(self, host, zfs_path='/sbin/zfs', ssh='ssh', control_dir=None):
+        """
+        :param str host: Host name for ssh, may be user@host
+        :param str zfs_path: Path to zfs executable on the host
+        :param str ssh: ssh command line with any extra options
+        :param str control_dir: Directory for the sockets of master connections. Defaults to the temporary one.
+        """
+        super().__init__(zfs_path)
+        self.host = host
+        control_path = os.path.join(control_dir or tempfile.gettempdir(), 'zfspace-%C')
+        # -n keeps every zfs command of every host from reading the local terminal
+        self.prefix = shlex.split(ssh) + ['-n', '-o', 'BatchMode=yes',
+                                          '-o', 'ConnectTimeout={}'.format(self.connect_timeout),
+                                          '-o', 'ControlMaster=auto', '-o', 'ControlPersist=60',
+                                          '-o', 'ControlPath=' + control_path, host, '--']
+
+    def check(self):
+        """Opens the master connection and raises an error if the host or zfs on it can't be reached."""
+        # The master connection stays in background, so it must not hold pipes the caller would wait for
+        try:
+            code = subprocess.run(self.prefix + ['test', '-x', shlex.quote(self.zfs_path)], stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  timeout=self.connect_timeout * 2).returncode
+        except subprocess.TimeoutExpired:
+            raise TimeoutError('{} did not answer in {} seconds.'.format(self.host, self.connect_timeout * 2))
+        if code == 255:
+            raise ConnectionError('Cannot connect to {} with ssh.'.format(self.host))
+        if code:
+            raise FileNotFoundError('{} is not found on {}. Is ZFS-on-Linux installed?'.format(
+                self.zfs_path, self.host))
+
+    def argv(self, args):
+        # ssh joins the remote command line with spaces, and the remote shell splits it again
+        return self.prefix + [shlex.quote(arg) for arg in [self.zfs_path, *args]]
+
+
+def make_transport(spec, zfs_path='/sbin/zfs', ssh='ssh'):
+    """Returns a tuple of the host name and its transport.
+
+    :param str spec: A host name for ssh, or "name=command" to run zfs through a local command instead
+    """
+    name, separator, command = spec.partition('=')
+    if separator:
+        return name, CommandTransport(command)
+    return spec, SshTransport(spec, zfs_path, ssh)
+
+
+def analyze_host(host, transport, dataset_name=None, filter_level=0.368, top=10, snapshot_args=None, jobs=4,
+                 timeout=None):
+    """Ranks the space users of a host with pool.pool_report.
+
+    :param str dataset_name: The dataset to analyze. None analyzes every pool of the host.
+    :return: A HostResult
+    """
+    start = time.monotonic()
+    try:
+        zb = ZfsBridge(jobs=jobs, timeout=timeout, transport=transport)
+        roots = [dataset_name] if dataset_name else sorted(name for name in zb.index.datasets if '/' not in name)
+        items = list()
+        for root in roots:
+            zb._check_dataset_name(root)
+            items.extend(FleetItem(host, size, name, part, advice)
+                         for size, name, part, advice in pool_report(zb, root, filter_level, top, snapshot_args))
+        return HostResult(host, items, None, time.monotonic() - start, True)
+    except Exception as err:
+        return HostResult(host, None, str(err) or type(err).__name__, time.monotonic() - start, True)
+
+
+def analyze_fleet(transports, deadline=None, **host_args):
+    """Analyzes all hosts at the same time and yields a HostResult for every host as soon as it is done.
+
+    :param transports: A list of (host name, transport) tuples
+    :param float deadline: Seconds to wait for all hosts. Hosts not done by then are yielded as failed.
+    :param host_args: Keyword arguments for analyze_host
+    """
+    results = queue.Queue()
+    for host, transport in transports:
+        # Daemon threads don't keep the process alive for a host that hangs past the deadline
+        threading.Thread(target=lambda *args: results.put(analyze_host(*args, **host_args)),
+                         args=(host, transport), daemon=True).start()
+    pending = set(host for host, _ in transports)
+    start = time.monotonic()
+    while pending:
+        try:
+            remaining = None if deadline is None else max(0, start + deadline - time.monotonic())
+            result = results.get(timeout=remaining)
+        except queue.Empty:
+            break
+        pending.discard(result.host)
+        yield result
+    for host, _ in transports:
+        if host in pending:
+            yield HostResult(host, None, 'The analysis did not finish in {:g} seconds.'.format(deadline),
+                             time.monotonic() - start, False)
+
+
+def fleet_report(results):
+    """Merges the space users of all hosts into one list sorted by size in descending order."""
+    return sorted((item for result in results if result.items for item in result.items),
+                  key=lambda item: (-item.size, item.host, item.dataset))
+
+
+def print_host_result(result: HostResult):
+    if result.error is None:
+        print(term_format['WHITEBOLD'] + result.host + term_format['END'] +
+              ': {} space user(s) in {:.1f} s'.format(len(result.items), result.seconds))
+    else:
+        print(term_format['WHITEBOLD'] + result.host + term_format['END'] + ': ' + term_format['RED'] +
+              result.error + term_format['END'])
+
+
+def print_fleet_report(report, top=None):
+    part_names = dict(USEDSNAP='Snapshots', USEDDS='Files', USEDREFRESERV='Refreservation')
+    dv = DivBar()
+    dv.print_hr()
+    print('The biggest space users of the fleet are:')
+    for rank, item in enumerate(report[:top], 1):
+        print('{:>3}. '.format(rank) + term_format['CYAN'] + '{:>9}'.format(size2human(item.size)) +
+              term_format['END'] + ' ' + term_format['WHITEBOLD'] + part_names[item.part] + term_format['END'] +
+              ' of ' + term_format['BOLD'] + item.host + ':' + item.dataset + term_format['END'] + '. ' + item.advice)
+
+
+def fleet_main(argv=None):
+    """Entry point of "zfspace fleet"."""
+    parser = argparse.ArgumentParser(prog='zfspace fleet',
+                                     description='rank space users of ZFS pools on many hosts at once.')
+    parser.add_argument('hosts', nargs='+', metavar='HOST',
+                        help='Hosts to reach with ssh, or NAME=COMMAND to run zfs through a local command.')
+    parser.add_argument('-d', '--dataset', type=str, default=None,
+                        help='The dataset to analyze on every host. Defaults to every pool.')
+    parser.add_argument('-f', '--filter', type=float, default=0.632,
+                        help='Threshold in range [0,1] to filter out less significant parts on every host.')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of zfs queries to run in parallel per host.')
+    parser.add_argument('-t', '--timeout', type=float, default=None,
+                        help='Seconds to wait for a single snapshot range query before giving up.')
+    parser.add_argument('--deadline', type=float, default=None,
+                        help='Seconds to wait for all hosts. Hosts not done by then are left out of the report.')
+    parser.add_argument('--top', type=int, default=10,
+                        help='The number of the heaviest datasets to analyze per pool, and of the fleet report lines.')
+    parser.add_argument('-b', '--buckets', type=int, default=None,
+                        help='Group snapshots into this number of buckets and build the pyramids over buckets.')
+    parser.add_argument('--estimate', action='store_true',
+                        help='Estimate snapshot pyramids from written@ properties instead of range dry-runs.')
+    parser.add_argument('--zfs-path', type=str, default=ZfsBridge.zfs_path, help='Path to zfs on the hosts.')
+    parser.add_argument('--ssh', type=str, default='ssh', help='ssh command with extra options, like "ssh -p 2222".')
+    parser.add_argument('--format', type=str, default='text', choices=['text', 'json', 'ndjson'],
+                        help='Print the report as text, as a JSON document or as JSON lines, one per host as soon '
+                             'as it is done and one per space user at the end.')
+    args = parser.parse_args(argv)
+    if args.filter > 1 or args.filter < 0:
+        parser.error('The filter cannot be out of [0,1] range.')
+    if args.jobs < 1:
+        parser.error('The number of jobs must be a positive integer.')
+    transports = [make_transport(spec, args.zfs_path, args.ssh) for spec in args.hosts]
+    if len(set(host for host, _ in transports)) < len(transports):
+        parser.error('Host names must be unique.')
+    snapshot_args = dict(bucket_by='count' if args.buckets else None, buckets=args.buckets, estimate=args.estimate)
+    output = None
+    if args.format != 'text':
+        from .output import formats
+        output = formats[args.format]()
+    results = list()
+    for result in analyze_fleet(transports, args.deadline, dataset_name=args.dataset, filter_level=1 - args.filter,
+                                top=args.top, snapshot_args=snapshot_args, jobs=args.jobs, timeout=args.timeout):
+        results.append(result)
+        if output is None:
+            print_host_result(result)
+        else:
+            output.emit(dict(type='host', host=result.host, error=result.error, seconds=result.seconds,
+                             space_users=None if result.items is None else len(result.items)))
+    report = fleet_report(results)
+    if output is None:
+        print_fleet_report(report, args.top)
+    else:
+        for item in report:
+            output.emit(dict(item._asdict(), type='fleet_item'))
+        output.close()
+    if not all(result.finished for result in results):
+        # Worker pools of the hosts past the deadline would keep the process alive until their queries finish
+        sys.stdout.flush()
+        os._exit(1)
+    if any(result.error is not None for result in results):
+        sys.exit(1)
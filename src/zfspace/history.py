@@ -0,0 +1,275 @@
+""" Local history of dataset space and snapshot pyramids for growth trends.
+
+A run with --record stores the "zfs list -o space" columns of the dataset and all its descendants and the cells of
+the snapshot pyramids queried on the way in a SQLite database. A row is written only when its values differ from
+the previous row of the same dataset or snapshot range, so a year of hourly runs over thousands of mostly idle
+datasets stays small. The value at any time is the last row written before it, found with the primary key of
+(dataset, run) or (first snapshot, last snapshot, run). Snapshots are stored once and cells refer to them.
+"""
+
+import os
+import sys
+import time
+import heapq
+import sqlite3
+import argparse
+from collections import namedtuple
+
+from .zfspace import ZfsBridge, SnapshotSpace, space_columns, size2human, term_format
+
+# change is in bytes between the samples seconds apart, rate is bytes per day. size is the latest value
+Growth = namedtuple('Growth', 'name size change seconds rate')
+
+_schema = """
+CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, time REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS runs_time ON runs (time);
+CREATE TABLE IF NOT EXISTS datasets (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS space (
+    dataset INTEGER NOT NULL, run INTEGER NOT NULL, available INTEGER, used INTEGER, usedbysnapshots INTEGER,
+    usedbydataset INTEGER, usedbyrefreservation INTEGER, usedbychildren INTEGER,
+    PRIMARY KEY (dataset, run)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY, dataset INTEGER NOT NULL, guid TEXT NOT NULL, name TEXT NOT NULL, creation INTEGER,
+    seen INTEGER NOT NULL, UNIQUE (dataset, guid));
+CREATE TABLE IF NOT EXISTS cells (
+    first INTEGER NOT NULL, last INTEGER NOT NULL, run INTEGER NOT NULL, exclusive INTEGER, would_free INTEGER,
+    PRIMARY KEY (first, last, run)) WITHOUT ROWID;
+"""
+
+
+class HistoryStore:
+    columns = tuple(prop for _, prop in space_columns[1:])
+
+    def __init__(self, path=None):
+        """
+        :param str path: The SQLite database. Defaults to $XDG_DATA_HOME/zfspace/history.sqlite
+        """
+        if path is None:
+            data_home = os.environ.get('XDG_DATA_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'share')
+            path = os.path.join(data_home, 'zfspace', 'history.sqlite')
+        self.path = path
+        self._db = None
+        self._pyramids = list()  # (dataset name, list of (first SnapshotInfo, last SnapshotInfo, exclusive, freed))
+
+    def _connect(self, create=True):
+        if self._db is None:
+            if not create and not os.path.exists(self.path):
+                raise ValueError('There is no history in {}. Record it with "zfspace --record" first.'.format(
+                    self.path))
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path)
+            self._db.executescript(_schema)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def add_pyramid(self, ss: SnapshotSpace):
+        """Keeps the cells of a queried pyramid until the next record."""
+        identities = ss.zb.get_snapshot_identities(ss.dataset_name)
+        cells = list()
+        for row, sizes in enumerate(ss.would_free_matrix):
+            for col, freed in enumerate(sizes):
+                first, last = ss.columns[col][1], ss.columns[col + row][2]
+                cells.append((identities[first], identities[last], ss.snapshot_size_matrix.get(row, col), freed))
+        self._pyramids.append((ss.dataset_name, cells))
+
+    def _dataset_id(self, db, name):
+        db.execute('INSERT OR IGNORE INTO datasets (name) VALUES (?)', (name,))
+        return db.execute('SELECT id FROM datasets WHERE name = ?', (name,)).fetchone()[0]
+
+    @staticmethod
+    def _subtree(db, dataset_name):
+        """Returns (id, name) of the dataset and its descendants. '0' follows '/', so the range holds descendants."""
+        return db.execute('SELECT id, name FROM datasets WHERE name = ? OR (name >= ? AND name < ?)',
+                          (dataset_name, dataset_name + '/', dataset_name + '0')).fetchall()
+
+    def record(self, zb: ZfsBridge, dataset_name, now=None):
+        """Stores the space of the dataset and its descendants and the pyramids added since the last record.
+
+        :param float now: Time of the run, defaults to the current time
+        :return: The run id
+        """
+        db = self._connect()
+        names = [name for name in zb.index.datasets if name == dataset_name or name.startswith(dataset_name + '/')]
+        with db:  # A single transaction per run
+            run = db.execute('INSERT INTO runs (time) VALUES (?)', (time.time() if now is None else now,)).lastrowid
+            present = set()
+            for name in names:
+                dataset = self._dataset_id(db, name)
+                present.add(dataset)
+                props = zb.index.datasets[name]
+                self._write_space(db, dataset, run, tuple(props[column] for column in self.columns))
+            for dataset, _ in self._subtree(db, dataset_name):
+                if dataset not in present:  # A destroyed dataset gets a row of nulls
+                    self._write_space(db, dataset, run, (None,) * len(self.columns))
+            for name, cells in self._pyramids:
+                dataset = self._dataset_id(db, name)
+                snapshot_ids = dict()
+                for first, last, exclusive, freed in cells:
+                    ids = list()
+                    for info in (first, last):
+                        if info.guid not in snapshot_ids:
+                            db.execute('INSERT OR IGNORE INTO snapshots (dataset, guid, name, creation, seen) '
+                                       'VALUES (?, ?, ?, ?, ?)', (dataset, str(info.guid), info.name, info.creation,
+                                                                  run))
+                            snapshot_ids[info.guid] = db.execute(
+                                'SELECT id FROM snapshots WHERE dataset = ? AND guid = ?',
+                                (dataset, str(info.guid))).fetchone()[0]
+                        ids.append(snapshot_ids[info.guid])
+                    latest = db.execute('SELECT exclusive, would_free FROM cells WHERE first = ? AND last = ? '
+                                        'ORDER BY run DESC LIMIT 1', ids).fetchone()
+                    if latest != (exclusive, freed):
+                        db.execute('INSERT INTO cells VALUES (?, ?, ?, ?, ?)', (ids[0], ids[1], run, exclusive, freed))
+                db.executemany('UPDATE snapshots SET seen = ? WHERE id = ?',
+                               [(run, snapshot_id) for snapshot_id in snapshot_ids.values()])
+        self._pyramids.clear()
+        return run
+
+    def _write_space(self, db, dataset, run, values):
+        latest = db.execute('SELECT {} FROM space WHERE dataset = ? ORDER BY run DESC LIMIT 1'.format(
+            ', '.join(self.columns)), (dataset,)).fetchone()
+        if latest is None and all(value is None for value in values):
+            return
+        if latest != values:
+            db.execute('INSERT INTO space (dataset, run, {}) VALUES (?, ?, {})'.format(
+                ', '.join(self.columns), ', '.join('?' * len(self.columns))), (dataset, run) + values)
+
+    @staticmethod
+    def _growth(db, query, key, start, name):
+        """Compares the latest value with the value at the start run, or with the oldest one if it is younger.
+        Rows are written only on changes, so a value holds from its run until the next row.
+
+        :param str query: SELECT of (value, time) for the key, with a run condition and ordering to fill in
+        :param start: A tuple of the id and the time of the start run, the last run and its time
+        :return: Growth or None if the value doesn't exist now
+        """
+        (start_run, start_time), (_, end_time) = start
+        latest = db.execute(query.format('', 'DESC'), key).fetchone()
+        if latest is None or latest[0] is None:
+            return None
+        then = db.execute(query.format('AND s.run <= ?', 'DESC'), key + (start_run,)).fetchone() \
+            if start_run is not None else None
+        if then is not None and then[0] is not None:
+            then = (then[0], start_time)
+        else:
+            then = db.execute(query.format('AND s.run > ?' if start_run is not None else '', ''),
+                              key + ((start_run,) if start_run is not None else ())).fetchone()
+        seconds = end_time - then[1]
+        change = latest[0] - (then[0] or 0)
+        return Growth(name, latest[0], change, seconds, change * 86400 / seconds if seconds > 0 else None)
+
+    def _start(self, db, since):
+        """Returns the id and the time of the last run at or before since and of the last run."""
+        return (db.execute('SELECT id, time FROM runs WHERE time <= ? ORDER BY time DESC LIMIT 1', (since,)).fetchone()
+                or (None, None),
+                db.execute('SELECT id, time FROM runs ORDER BY id DESC LIMIT 1').fetchone())
+
+    def dataset_growth(self, dataset_name, since, column='used'):
+        """Returns the Growth of a space column of the dataset since the time, or None if it is not recorded."""
+        db = self._connect(create=False)
+        row = db.execute('SELECT id FROM datasets WHERE name = ?', (dataset_name,)).fetchone()
+        if row is None:
+            return None
+        return self._growth(db, self._space_query(column), (row[0],), self._start(db, since), dataset_name)
+
+    def _space_query(self, column):
+        if column not in self.columns:
+            raise ValueError('Unknown space column {}.'.format(column))
+        return 'SELECT s.{}, r.time FROM space s JOIN runs r ON r.id = s.run WHERE s.dataset = ? {{}} ' \
+               'ORDER BY s.run {{}} LIMIT 1'.format(column)
+
+    def top_growers(self, dataset_name, since, top=10, column='used'):
+        """Returns Growth of the dataset and its descendants growing the fastest, the fastest first."""
+        db = self._connect(create=False)
+        start = self._start(db, since)
+        query = self._space_query(column)
+        growths = (self._growth(db, query, (dataset,), start, name) for dataset, name in
+                   self._subtree(db, dataset_name))
+        return heapq.nlargest(top, (growth for growth in growths if growth is not None and growth.rate is not None),
+                              key=lambda growth: growth.rate)
+
+    def range_growers(self, dataset_name, since, top=10):
+        """Returns Growth of the space freed by destroying snapshot ranges of the last recorded pyramid,
+        the fastest growing first. Ranges are named like dataset@first%last."""
+        db = self._connect(create=False)
+        row = db.execute('SELECT id FROM datasets WHERE name = ?', (dataset_name,)).fetchone()
+        if row is None:
+            return list()
+        snapshots = db.execute('SELECT id, name, seen FROM snapshots WHERE dataset = ?', (row[0],)).fetchall()
+        if not snapshots:
+            return list()
+        seen = max(last_seen for _, _, last_seen in snapshots)
+        names = {snapshot_id: name for snapshot_id, name, last_seen in snapshots if last_seen == seen}
+        start = self._start(db, since)
+        query = 'SELECT s.would_free, r.time FROM cells s JOIN runs r ON r.id = s.run WHERE s.first = ? ' \
+                'AND s.last = ? {} ORDER BY s.run {} LIMIT 1'
+        growths = list()
+        for first in names:
+            for (last,) in db.execute('SELECT DISTINCT last FROM cells WHERE first = ?', (first,)).fetchall():
+                if last in names:
+                    growth = self._growth(db, query, (first, last), start, '{}@{}%{}'.format(
+                        dataset_name, names[first], names[last]))
+                    if growth is not None and growth.rate is not None:
+                        growths.append(growth)
+        return heapq.nlargest(top, growths, key=lambda growth: growth.rate)
+
+    def samples(self):
+        """Returns the number of runs and the times of the first and the last one."""
+        return self._connect(create=False).execute('SELECT count(*), min(time), max(time) FROM runs').fetchone()
+
+
+def _rate2human(rate):
+    return ('+' if rate >= 0 else '-') + size2human(int(abs(rate))) + '/day'
+
+
+def print_history(store: HistoryStore, dataset_name, days=30, top=10):
+    """Prints growth of the dataset, its fastest growing descendants and snapshot ranges."""
+    count, first, last = store.samples()
+    if not count:
+        print('The history in {} is empty.'.format(store.path))
+        return
+    print('History of {} runs from {} to {}.'.format(count, time.strftime('%Y-%m-%d %H:%M', time.localtime(first)),
+                                                     time.strftime('%Y-%m-%d %H:%M', time.localtime(last))))
+    since = last - days * 86400
+    for label, period in (('day', 1), ('week', 7), ('{} days'.format(days), days)):
+        growth = store.dataset_growth(dataset_name, last - period * 86400)
+        if growth is None:
+            raise ValueError('There is no history of dataset "{}".'.format(dataset_name))
+        if growth.rate is not None:
+            print('  {:<10} '.format(label) + term_format['CYAN'] + '{:>16}'.format(_rate2human(growth.rate)) +
+                  term_format['END'] + ' used {} now'.format(size2human(growth.size)))
+    print('The fastest growing datasets over the last {} days are:'.format(days))
+    for growth in store.top_growers(dataset_name, since, top):
+        print(term_format['CYAN'] + '{:>16}'.format(_rate2human(growth.rate)) + term_format['END'] +
+              ' {} uses {}'.format(growth.name, size2human(growth.size)))
+    ranges = store.range_growers(dataset_name, since, top)
+    if ranges:
+        print('The snapshot ranges growing the fastest over the last {} days are:'.format(days))
+        for growth in ranges:
+            print(term_format['CYAN'] + '{:>16}'.format(_rate2human(growth.rate)) + term_format['END'] +
+                  ' {} would free {}'.format(growth.name, size2human(growth.size)))
+
+
+def history_main(argv=None):
+    """Entry point of "zfspace history"."""
+    parser = argparse.ArgumentParser(prog='zfspace history',
+                                     description='show how space of a ZFS dataset grows, using runs recorded '
+                                                 'with "zfspace --record".')
+    parser.add_argument('--history-db', type=str, default=None,
+                        help='The history database. Defaults to ~/.local/share/zfspace/history.sqlite.')
+    parser.add_argument('--days', type=float, default=30, help='Measure growth over this many last days.')
+    parser.add_argument('--top', type=int, default=10, help='The number of the fastest growers to show.')
+    parser.add_argument('dataset_name', type=str, help='a ZFS dataset name with recorded history.')
+    args = parser.parse_args(argv)
+    store = HistoryStore(args.history_db)
+    try:
+        print_history(store, args.dataset_name, args.days, args.top)
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        store.close()
@@ -0,0 +1,151 @@
+""" Instrumentation of zfs calls and analysis phases.
+
+A Profiler records every zfs command with its latency and output size, and the time spent in every phase of
+the analysis. It tells whether a slow run waits for zfs or computes in python. A disabled profiler records
+nothing: the transport is not wrapped and phases are a shared no-op context manager.
+"""
+
+import sys
+import time
+import threading
+
+
+class _NoPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_phase = _NoPhase()
+
+
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record_phase(self.name, self.start, time.monotonic() - self.start)
+        return False
+
+
+class ProfiledTransport:
+    """Wraps a transport to record every zfs command it runs. Other attributes come from the wrapped transport."""
+    def __init__(self, transport, profiler):
+        self.transport = transport
+        self.profiler = profiler
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+    def run(self, args, timeout=None):
+        start = time.monotonic()
+        output = None
+        try:
+            output = self.transport.run(args, timeout)
+            return output
+        finally:
+            self.profiler.record_command(args, start, time.monotonic() - start,
+                                         None if output is None else len(output))
+
+    def lines(self, args):
+        start = time.monotonic()
+        size = 0
+        complete = False
+        try:
+            for line in self.transport.lines(args):
+                size += len(line)
+                yield line
+            complete = True
+        finally:
+            self.profiler.record_command(args, start, time.monotonic() - start, size if complete else None)
+
+
+class Profiler:
+    """Collects zfs commands and phase timings. All methods may be called from several threads."""
+    # Upper bounds of latency histogram buckets in seconds, the last bucket is unbounded
+    histogram_bounds = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.origin = time.monotonic()
+        self.commands = list()  # Tuples of (args, start, seconds, output bytes or None if the command failed)
+        self.phases = list()  # Tuples of (name, start, seconds)
+        self._lock = threading.Lock()
+
+    def wrap(self, transport):
+        """Returns the transport recording its commands, or the transport itself if profiling is disabled."""
+        return ProfiledTransport(transport, self) if self.enabled else transport
+
+    def phase(self, name):
+        """Returns a context manager measuring the time spent in a phase of the analysis."""
+        return _Phase(self, name) if self.enabled else _no_phase
+
+    def record_command(self, args, start, seconds, output_size):
+        """Records a zfs command. output_size is None if the command failed."""
+        if self.enabled:
+            with self._lock:
+                self.commands.append((list(args), start - self.origin, seconds, output_size))
+
+    def record_phase(self, name, start, seconds):
+        with self._lock:
+            self.phases.append((name, start - self.origin, seconds))
+
+    def histogram(self):
+        """Returns a list of (upper bound in seconds or None, number of commands) for command latencies."""
+        counts = [0] * (len(self.histogram_bounds) + 1)
+        for _, _, seconds, _ in self.commands:
+            counts[next((i for i, bound in enumerate(self.histogram_bounds) if seconds <= bound), -1)] += 1
+        return list(zip(list(self.histogram_bounds) + [None], counts))
+
+    def to_dict(self):
+        return dict(commands=[dict(args=args, start=start, seconds=seconds, output_bytes=size)
+                              for args, start, seconds, size in self.commands],
+                    phases=[dict(name=name, start=start, seconds=seconds) for name, start, seconds in self.phases],
+                    histogram=[dict(le=bound, count=count) for bound, count in self.histogram()])
+
+    def dump(self, path):
+        """Writes the whole trace as JSON."""
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def print_summary(self, file=None):
+        """Prints time per phase, zfs commands per subcommand and the latency histogram."""
+        file = file or sys.stderr
+        print('Profile of {:.3f} seconds:'.format(time.monotonic() - self.origin), file=file)
+        totals = dict()
+        for name, _, seconds in self.phases:
+            count, total = totals.get(name, (0, 0))
+            totals[name] = (count + 1, total + seconds)
+        for name, (count, total) in totals.items():
+            print('  phase {:<20} {:>4}x {:>10.3f} s'.format(name, count, total), file=file)
+        subcommands = dict()
+        for args, _, seconds, size in self.commands:
+            count, total, output, failed = subcommands.get(args[0], (0, 0, 0, 0))
+            subcommands[args[0]] = (count + 1, total + seconds, output + (size or 0), failed + (size is None))
+        for name, (count, total, output, failed) in subcommands.items():
+            print('  zfs {:<22} {:>4}x {:>10.3f} s {:>10.1f} ms avg {:>10} bytes {:>4} failed'.format(
+                name, count, total, total / count * 1000, output, failed), file=file)
+        if self.commands:
+            latencies = sorted(seconds for _, _, seconds, _ in self.commands)
+            print('  latency p50 {:.1f} ms, p95 {:.1f} ms, max {:.1f} ms'.format(
+                latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.95)] * 1000,
+                latencies[-1] * 1000), file=file)
+            histogram = self.histogram()
+            peak = max(count for _, count in histogram)
+            first = next(i for i, (_, count) in enumerate(histogram) if count)
+            last = max(i for i, (_, count) in enumerate(histogram) if count)
+            for bound, count in histogram[first:last + 1]:
+                label = '<= {:g} ms'.format(bound * 1000) if bound is not None else '> {:g} ms'.format(
+                    self.histogram_bounds[-1] * 1000)
+                print('  {:>12} {:>6} {}'.format(label, count, '#' * round(count * 40 / peak)), file=file)
+
+
+disabled = Profiler(enabled=False)
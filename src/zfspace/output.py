@@ -0,0 +1,163 @@
+""" Machine-readable output of the analysis.
+
+The analysis is reported as a sequence of records, plain dicts with a "type" key. NdjsonOutput writes every record
+as a line of JSON as soon as it is made, including every snapshot pyramid cell right after its queries finish.
+JsonOutput assembles the records into a single JSON document written at the end.
+"""
+
+import os
+import sys
+import json
+
+from .zfspace import ZfsBridge, SnapshotSpace, scan_dataset
+
+
+class NdjsonOutput:
+    """Writes every record as a separate line of JSON."""
+    streaming = True
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def emit(self, record):
+        self.stream.write(json.dumps(record) + '\n')
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+
+class JsonOutput:
+    """Collects records into one document: the dataset summary and a list of analyzed parts with their details."""
+    streaming = False
+    list_records = dict(recommendation='recommendations', child='children')
+    document_lists = dict(space_user='space_users', retention='retention', attribution='attributions',
+                          host='hosts', fleet_item='fleet')
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.document = dict()
+
+    def emit(self, record):
+        record = dict(record)
+        kind = record.pop('type')
+        if kind == 'summary':
+            self.document.update(record)
+        elif kind == 'part':
+            self.document.setdefault('parts', list()).append(record)
+        elif kind in self.document_lists:
+            self.document.setdefault(self.document_lists[kind], list()).append(record)
+        elif kind in self.list_records:
+            self.document['parts'][-1].setdefault(self.list_records[kind], list()).append(record)
+        else:
+            self.document['parts'][-1].update(record)
+
+    def close(self):
+        json.dump(self.document, self.stream, indent=1)
+        self.stream.write('\n')
+
+
+formats = dict(json=JsonOutput, ndjson=NdjsonOutput)
+
+
+def space_dict(summary):
+    """Turns a list of (column name, value) tuples of PoolIndex.summary into a dict without the name column."""
+    return {column: value for column, value in summary if column != 'NAME'}
+
+
+def _emit_snapshots(zb: ZfsBridge, dataset_name, output, snapshot_args, plan_args):
+    progressive = output.streaming and snapshot_args.get('prune') is None and not snapshot_args.get('estimate')
+    ss = SnapshotSpace(dataset_name, zb, **dict(snapshot_args, progressive=progressive))
+    output.emit(dict(type='snapshots', snapshot_count=len(ss.snapshot_names), bucketed=ss.bucketed,
+                     columns=[dict(label=label, first=ss.snapshot_names[first], last=ss.snapshot_names[last])
+                              for label, first, last in ss.columns]))
+    if ss.estimated:
+        output.emit(dict(type='estimate', error_bound=ss.error_bound, property_values=ss.property_values,
+                         exact_cells=sorted(ss.exact_cells)))
+
+    def emit_cell(row, col, exclusive, would_free):
+        first, last, count = ss._range_snapshots(row, col)
+        output.emit(dict(type='cell', row=row, col=col, first=first, last=last, snapshots=count,
+                         exclusive=exclusive, would_free=would_free))
+
+    if progressive:
+        ss.query_progressive(emit_cell)
+    elif output.streaming:
+        for row in range(len(ss.columns)):
+            for col in range(len(ss.columns) - row):
+                emit_cell(row, col, ss.snapshot_size_matrix.get(row, col), ss.would_free_matrix.get(row, col))
+    else:
+        output.emit(dict(type='pyramid', exclusive=list(ss.snapshot_size_matrix),
+                         would_free=list(ss.would_free_matrix)))
+    for size, count, first, last in sorted(ss.get_destroy_candidates(3), reverse=True):
+        output.emit(dict(type='recommendation', size=size, snapshots=count, first=first, last=last,
+                         command='{} destroy {}@{}%{}'.format(zb.zfs_path, dataset_name, first, last)))
+    if plan_args:
+        from .planner import make_plan
+        try:
+            planner, plan = make_plan(ss, **plan_args)
+        except ValueError as err:
+            output.emit(dict(type='plan', plan=None, error=str(err)))
+            return
+        if plan is None:
+            output.emit(dict(type='plan', plan=None))
+        else:
+            output.emit(dict(type='plan', plan=dict(
+                snapshots=plan.snapshots, freed=plan.freed, verified_freed=planner.dry_run(plan.runs),
+                command='{} destroy {}'.format(zb.zfs_path, planner.destroy_spec(plan.runs)))))
+
+
+def _emit_files(zb: ZfsBridge, dataset_name, output, scan):
+    path = zb.get_filesystem_mountpoint(dataset_name)
+    output.emit(dict(type='files', mountpoint=path))
+    if scan and path and os.path.isdir(path):
+        result = scan_dataset(zb, dataset_name, path)
+        output.emit(dict(type='scan', files=result.files, errors=result.errors, entries=dict(result.top_entries()),
+                         heaviest=[dict(size=size, path=directory)
+                                   for size, directory in result.heaviest_directories()]))
+
+
+def emit_analysis(zb: ZfsBridge, dataset_name, output, filter_level, snapshot_args=None, scan=False, plan_args=None):
+    """Makes the same analysis as main, reporting records to output instead of printing text.
+
+    :param output: JsonOutput or NdjsonOutput
+    :param float filter_level: Fraction of the used space to analyze, the less significant parts are skipped
+    :param dict snapshot_args: Keyword arguments for SnapshotSpace
+    :param bool scan: Scan files of the dataset when they take a significant space
+    :param dict plan_args: Keyword arguments for planner.make_plan to plan snapshot deletions
+    """
+    snapshot_args = snapshot_args or dict()
+    summary = zb.get_dataset_summary(dataset_name)
+    used = summary[2][1]
+    output.emit(dict(type='summary', dataset=dataset_name, space=space_dict(summary)))
+    part_count = 0
+    for name, size in sorted(summary[3:], key=lambda x: -x[1]):
+        if not size:
+            break
+        part_count += size / used if used else 1
+        output.emit(dict(type='part', dataset=dataset_name, part=name, size=size))
+        if name == 'USEDSNAP':
+            _emit_snapshots(zb, dataset_name, output, snapshot_args, plan_args)
+        elif name == 'USEDDS':
+            _emit_files(zb, dataset_name, output, scan)
+        elif name == 'USEDREFRESERV':
+            refreservation = zb.get_filesystem_refreservation(dataset_name)
+            output.emit(dict(type='refreservation', refreservation=refreservation,
+                             suggested=refreservation - size))
+        elif name == 'USEDCHILD':
+            child_count = 0
+            for child in zb.get_children_summary(dataset_name):
+                child_count += child[2][1] / size if size else 1
+                output.emit(dict(type='child', dataset=child[0][1], space=space_dict(child)))
+                if child_count > filter_level:
+                    break
+        if part_count > filter_level:
+            break
+
+
+def emit_pool_report(zb: ZfsBridge, dataset_name, output, filter_level, top=10, snapshot_args=None):
+    """Reports the ranked space users of pool.pool_report as records."""
+    from .pool import pool_report
+    output.emit(dict(type='summary', dataset=dataset_name, space=space_dict(zb.get_dataset_summary(dataset_name))))
+    for size, name, part, advice in pool_report(zb, dataset_name, filter_level, top, snapshot_args):
+        output.emit(dict(type='space_user', dataset=name, part=part, size=size, advice=advice))
@@ -0,0 +1,172 @@
+""" Planning of snapshot deletions that free the most space for the fewest destroyed snapshots.
+
+A block of data is referenced by a contiguous range of snapshots, so destroying a set of snapshots frees exactly
+the blocks whose whole range is inside one of the runs of consecutive destroyed snapshots. The space a set frees
+is the sum of the would free sizes of its runs, and the would free size of a run is the sum of the exclusive
+pyramid cells inside it. So the snapshot pyramid is the cost model of any set of snapshots, contiguous or not,
+and the search doesn't need zfs. The result is confirmed with a single "zfs destroy -nvp" of a comma separated list.
+The pyramid must be exact: a pruned pyramid holds zeros for the skipped ranges, and an estimate may be off.
+"""
+
+from collections import namedtuple
+
+from .zfspace import SnapshotSpace, group_snapshots, size2human
+
+# runs is a list of (first column, last column) of destroyed pyramid columns, snapshots is their number,
+# freed is the space predicted by the pyramid
+Plan = namedtuple('Plan', 'runs snapshots freed')
+
+
+class DeletionPlanner:
+    def __init__(self, ss: SnapshotSpace, keep=None):
+        """
+        :param SnapshotSpace ss: A queried snapshot pyramid. Its columns, single snapshots or buckets, are
+            destroyed as a whole.
+        :param str keep: Keep at least one snapshot of every 'hour', 'day', 'week', 'month' or 'year'
+        """
+        if ss.would_free_matrix is None:
+            raise ValueError('The snapshot pyramid must be queried before planning.')
+        if ss.pruned:
+            raise ValueError('Deletion plans need the sizes of all snapshot ranges. Plan without --prune.')
+        if ss.estimated and ss.error_bound:
+            raise ValueError('The estimated pyramid may be off by {}, which is too much for a deletion plan. '
+                             'Plan without --estimate.'.format(size2human(ss.error_bound)))
+        self.ss = ss
+        self.size = len(ss.columns)
+        self.weights = [last - first + 1 for _, first, last in ss.columns]
+        self._dry_runs = dict()  # Destroy specification -> space freed by zfs dry-run
+        # A column can't be destroyed together with all columns back to protected[column]. Time periods are
+        # consecutive snapshots, so a period is lost only when a single run of destroyed columns covers it.
+        self.protected = [-1] * self.size
+        if keep is not None:
+            column_of = dict()
+            for col, (_, first, last) in enumerate(ss.columns):
+                for index in range(first, last + 1):
+                    column_of[index] = col
+            identities = ss.zb.get_snapshot_identities(ss.dataset_name)
+            for _, first, last in group_snapshots(identities, keep):
+                if first in column_of and last in column_of:
+                    start, end = column_of[first], column_of[last]
+                    self.protected[end] = max(self.protected[end], start)
+
+    def range_freed(self, first, last):
+        """Returns the space freed by destroying the columns from first to last."""
+        return self.ss.would_free_matrix.get(last - first, first)
+
+    def predict(self, runs):
+        """Returns the space freed by destroying runs of columns according to the pyramid."""
+        return sum(self.range_freed(first, last) for first, last in runs)
+
+    def _allowed(self, start, col):
+        """Tells whether a run of destroyed columns from start can be extended to col."""
+        return start > self.protected[col]
+
+    def plan(self, target=None, max_snapshots=None):
+        """Finds the best set of columns to destroy.
+
+        With target, finds the set freeing at least target bytes with the fewest snapshots, preferring more
+        freed space among sets of the same size. Without target, finds the set freeing the most space with at
+        most max_snapshots snapshots.
+        :param int target: Space to free in bytes
+        :param int max_snapshots: Maximum number of snapshots to destroy
+        :return: Plan or None if there is no such set
+        """
+        if target is None and max_snapshots is None:
+            raise ValueError('Either the space to free or the number of snapshots to destroy is required.')
+        with self.ss.zb.profiler.phase('planning'):
+            return self._search(target, max_snapshots)
+
+    def _search(self, target, max_snapshots):
+        """Finds the plan with dynamic programming over the columns.
+
+        A state is a column whose left neighbour is kept, so the runs after it don't depend on the runs before.
+        Of the sets of columns reaching a state, only those freeing more than every set of fewer snapshots
+        can be part of the best plan, which keeps the states small. It takes O(columns^2) steps per kept set.
+        """
+        size = self.size
+        # fronts[pos] maps the number of destroyed snapshots to the most space freed with them before pos, and the
+        # state, the count and the run it came from
+        fronts = [dict() for _ in range(size + 1)]
+        fronts[0][0] = (0, None, None, None)
+        for pos in range(size + 1):
+            front = self._pareto(fronts[pos])
+            if pos == size:
+                break
+            for count, freed in front:  # Keep the column
+                self._offer(fronts[pos + 1], count, freed, (pos, count, None))
+            weight = 0
+            for last in range(pos, size):  # Destroy the columns from pos to last and keep the next one
+                weight += self.weights[last]
+                if not self._allowed(pos, last) or (max_snapshots is not None and weight > max_snapshots):
+                    break
+                run_freed = self.range_freed(pos, last)
+                for count, freed in front:
+                    if max_snapshots is not None and count + weight > max_snapshots:
+                        break
+                    if target is None or freed < target:  # Destroying more only adds snapshots
+                        self._offer(fronts[min(last + 2, size)], count + weight, freed + run_freed,
+                                    (pos, count, (pos, last)))
+        candidates = [(count, freed) for count, freed in front
+                      if count and (target is None or freed >= target)]
+        if not candidates:
+            return None
+        if target is not None:
+            count, freed = min(candidates, key=lambda item: (item[0], -item[1]))
+        else:
+            count, freed = min(candidates, key=lambda item: (-item[1], item[0]))
+        runs = list()
+        pos, state_count = size, count
+        while pos:
+            _, pos, state_count, run = fronts[pos][state_count]
+            if run is not None:
+                runs.append(run)
+        return Plan(runs[::-1], count, freed)
+
+    @staticmethod
+    def _pareto(front):
+        """Returns (count, freed) of the sets freeing more than every set of fewer snapshots, by count."""
+        ret, best = list(), -1
+        for count in sorted(front):
+            if front[count][0] > best:
+                best = front[count][0]
+                ret.append((count, best))
+        return ret
+
+    @staticmethod
+    def _offer(front, count, freed, origin):
+        if count not in front or front[count][0] < freed:
+            front[count] = (freed,) + origin
+
+    def destroy_spec(self, runs):
+        """Returns the snapshot list for zfs destroy like dataset@a%b,c."""
+        names = self.ss.snapshot_names
+        parts = list()
+        for first, last in runs:
+            first_name, last_name = names[self.ss.columns[first][1]], names[self.ss.columns[last][2]]
+            parts.append(first_name if first_name == last_name else '{}%{}'.format(first_name, last_name))
+        return '{}@{}'.format(self.ss.dataset_name, ','.join(parts))
+
+    def dry_run(self, runs):
+        """Asks zfs how much destroying runs of columns frees. Results are remembered for the same runs."""
+        spec = self.destroy_spec(runs)
+        if spec not in self._dry_runs:
+            zb = self.ss.zb
+            self._dry_runs[spec] = int(zb._parse_reclaim(zb._run('destroy', '-nvp', spec, timeout=zb.timeout)))
+        return self._dry_runs[spec]
+
+    def describe(self, plan: Plan, validate=True):
+        """Returns the plan as text with the command to run."""
+        text = 'Destroying {} snapshot(s) in {} range(s) will free {}'.format(
+            plan.snapshots, len(plan.runs), size2human(plan.freed))
+        if validate:
+            text += ' ({} by zfs dry-run)'.format(size2human(self.dry_run(plan.runs)))
+        return text + '. Use "{} destroy {}"'.format(self.ss.zb.zfs_path, self.destroy_spec(plan.runs))
+
+
+def make_plan(ss: SnapshotSpace, target=None, max_snapshots=None, keep=None):
+    """Plans deletions of a queried SnapshotSpace. See DeletionPlanner.plan for the arguments.
+
+    :return: A tuple of the DeletionPlanner and the Plan or None if nothing satisfies the request
+    """
+    planner = DeletionPlanner(ss, keep)
+    return planner, planner.plan(target, max_snapshots)
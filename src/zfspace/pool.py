@@ -0,0 +1,119 @@
+""" Recursive analysis of a dataset with all its descendants.
+
+Instead of one level of children, the whole dataset tree is walked. The datasets holding the most space
+by themselves are analyzed and their snapshot pyramids are calculated in parallel. The result is a single
+ranked list of places where the space goes with advice how to free it.
+"""
+
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+
+from .zfspace import ZfsBridge, SnapshotSpace, DivBar, size2human, term_format
+
+
+def own_space(zb: ZfsBridge, dataset_name):
+    """Returns the space used by a dataset itself, without its children."""
+    props = zb.index.datasets[dataset_name]
+    return props['used'] - (props['usedbychildren'] or 0)
+
+
+def heaviest_datasets(zb: ZfsBridge, dataset_name, top=10):
+    """Finds datasets holding the most space by themselves in the tree starting at dataset_name.
+
+    Branches are walked heaviest first. A branch can't hold more than its USED, so the walk stops as soon as
+    the heaviest branch left is lighter than every dataset found, and light branches are never listed.
+    :param int top: The number of datasets to find
+    :return: A list of (own space, dataset name) tuples sorted by space in descending order
+    """
+    zb._check_dataset_name(dataset_name)
+    branches = [(-zb.index.datasets[dataset_name]['used'], dataset_name)]
+    best = list()  # Min-heap of top datasets, so the lightest one is at hand
+    while branches:
+        used, name = heapq.heappop(branches)
+        if len(best) == top and -used <= best[0][0]:
+            break
+        if len(best) < top:
+            heapq.heappush(best, (own_space(zb, name), name))
+        else:
+            heapq.heappushpop(best, (own_space(zb, name), name))
+        for child in zb.index.children[name]:
+            heapq.heappush(branches, (-zb.index.datasets[child]['used'], child))
+    return sorted(best, reverse=True)
+
+
+def _snapshot_advice(zb, dataset_name, snapshot_args):
+    ss = SnapshotSpace(dataset_name, zb, **snapshot_args)
+    candidates = ss.get_destroy_candidates(1)
+    if not candidates:
+        return 'There is nothing to free by destroying snapshots.'
+    size, count, first, last = max(candidates)
+    return 'Removing {} snapshot(s) will free {}. Use "{} destroy {}@{}%{}"'.format(
+        count, size2human(size), zb.zfs_path, dataset_name, first, last)
+
+
+def pool_report(zb: ZfsBridge, dataset_name, filter_level, top=10, snapshot_args=None):
+    """Ranks the space users of all datasets in the tree starting at dataset_name.
+
+    :param float filter_level: Fraction of the total used space to cover, the less significant parts are skipped
+    :param int top: The number of the heaviest datasets to analyze
+    :param dict snapshot_args: Keyword arguments for SnapshotSpace
+    :return: A list of (size, dataset name, part name, advice) tuples sorted by size in descending order
+    """
+    snapshot_args = dict(snapshot_args or dict(), progressive=False)
+    total = zb.index.datasets[dataset_name]['used']
+    items = list()
+    for _, name in heaviest_datasets(zb, dataset_name, top):
+        props = zb.index.datasets[name]
+        if props['usedbysnapshots']:
+            items.append((props['usedbysnapshots'], name, 'USEDSNAP', None))
+        if props['usedbydataset']:
+            items.append((props['usedbydataset'], name, 'USEDDS', 'Files in {}.'.format(props['mountpoint'])
+                          if props['mountpoint'] else 'Data of the volume.'))
+        if props['usedbyrefreservation']:
+            items.append((props['usedbyrefreservation'], name, 'USEDREFRESERV',
+                          'Limit it with "{} set refreservation={} {}".'.format(
+                              zb.zfs_path, size2human(props['refreservation'] - props['usedbyrefreservation'],
+                                                      fmt='short'), name)))
+    items.sort(reverse=True)
+
+    # Keep only the most important parts according to filter level
+    part_count = 0
+    for count, item in enumerate(items):
+        part_count += item[0] / total if total else 1
+        if part_count > filter_level:
+            items = items[:count + 1]
+            break
+
+    # Snapshot pyramids of different datasets are independent, so they are calculated at the same time.
+    # Their range queries share the bridge worker pool, which keeps the number of zfs processes bounded.
+    snapshot_items = [item for item in items if item[2] == 'USEDSNAP']
+    with ThreadPoolExecutor(max_workers=max(1, min(zb.jobs, len(snapshot_items)))) as executor:
+        futures = {item[1]: executor.submit(_snapshot_advice, zb, item[1], snapshot_args) for item in snapshot_items}
+        ret = list()
+        for size, name, part, advice in items:
+            if part == 'USEDSNAP':
+                try:
+                    advice = futures[name].result()
+                except Exception as err:
+                    advice = 'Snapshot analysis failed: {}'.format(err)
+            ret.append((size, name, part, advice))
+    return ret
+
+
+def print_pool_report(zb: ZfsBridge, dataset_name, filter_level, top=10, snapshot_args=None):
+    part_names = dict(USEDSNAP='Snapshots', USEDDS='Files', USEDREFRESERV='Refreservation')
+    descendants = sum(1 for name in zb.index.datasets if name.startswith(dataset_name + '/'))
+    total = zb.index.datasets[dataset_name]['used']
+    dv = DivBar()
+    dv.print_hr()
+    print('Analyzing ' + term_format['WHITEBOLD'] + dataset_name + term_format['END'] +
+          ' and its {} descendant datasets. Total used space is '.format(descendants) +
+          term_format['CYAN'] + size2human(total) + term_format['END'] + '. The biggest space users are:')
+    report = pool_report(zb, dataset_name, filter_level, top, snapshot_args)
+    if report:
+        dv.print_dict([(name, size) for size, name, _, _ in report])
+    dv.print_hr()
+    for rank, (size, name, part, advice) in enumerate(report, 1):
+        print('{:>3}. '.format(rank) + term_format['CYAN'] + '{:>9}'.format(size2human(size)) + term_format['END'] +
+              ' ' + term_format['WHITEBOLD'] + part_names[part] + term_format['END'] + ' of ' +
+              term_format['BOLD'] + name + term_format['END'] + '. ' + advice)
@@ -0,0 +1,196 @@
+""" What-if simulation of snapshot retention policies.
+
+A policy like "hourly=24,daily=7,weekly=4" keeps the newest snapshot of each of the 24 latest hours, 7 latest days
+and 4 latest weeks that have snapshots, and destroys the rest. Destroyed snapshots form runs between the kept ones,
+and the space a policy frees is the sum of the would free sizes of the runs. A run made of whole pyramid columns is
+read from the pyramid, and a range queried before is read from the range cache. Only the rest of the runs are
+asked from zfs with a single comma separated dry-run per policy, and all of them run in parallel.
+The pyramid itself is queried only if it costs no more queries than the dry-runs it can replace, which is
+usually the case when it is in the range cache already.
+"""
+
+import time
+from collections import namedtuple
+
+from .zfspace import ZfsBridge, SnapshotSpace, RangeSpaceCache, DivBar, bucket_time_formats, size2human, \
+    term_format
+
+period_names = dict(hourly='hour', daily='day', weekly='week', monthly='month', yearly='year')
+
+# freed is None if the dry-runs failed. pyramid_runs and queried_runs count runs read from the pyramid or
+# the cache and runs asked from zfs
+SimulationResult = namedtuple('SimulationResult', 'dataset policy kept destroyed freed pyramid_runs queried_runs')
+
+
+class RetentionPolicy:
+    def __init__(self, text):
+        """
+        :param str text: Comma separated keep counts like "last=3,hourly=24,daily=7,weekly=4,monthly=12,yearly=1".
+            "last" keeps the newest snapshots, other counts keep the newest snapshot of each of the latest periods.
+        """
+        self.text = text
+        self.last = 0
+        self.periods = dict()  # Period name of bucket_time_formats -> number of periods to keep
+        for item in text.split(','):
+            name, _, count = item.strip().partition('=')
+            if not count.isdigit():
+                raise ValueError('Bad retention "{}". Use keep counts like "hourly=24,daily=7".'.format(item))
+            if name == 'last':
+                self.last = int(count)
+            elif name in period_names or name in bucket_time_formats:
+                self.periods[period_names.get(name, name)] = int(count)
+            else:
+                raise ValueError('Unknown retention period "{}". Use last, {}.'.format(name, ', '.join(period_names)))
+
+    def kept(self, identities):
+        """Returns the set of indexes of snapshots the policy keeps.
+
+        :param identities: A list of SnapshotInfo sorted by creation
+        """
+        kept = set(range(max(0, len(identities) - self.last), len(identities)))
+        for period, count in self.periods.items():
+            seen = set()
+            for index in reversed(range(len(identities))):
+                if len(seen) >= count:
+                    break
+                key = time.strftime(bucket_time_formats[period], time.localtime(identities[index].creation))
+                if key not in seen:
+                    seen.add(key)
+                    kept.add(index)
+        return kept
+
+
+def destroyed_runs(count, kept):
+    """Returns (first, last) index tuples of runs of consecutive snapshots not in kept."""
+    runs = list()
+    start = None
+    for index in range(count + 1):
+        if index < count and index not in kept:
+            if start is None:
+                start = index
+        elif start is not None:
+            runs.append((start, index - 1))
+            start = None
+    return runs
+
+
+class RetentionSimulator:
+    def __init__(self, zb: ZfsBridge, dataset_name, snapshot_args=None, max_queries=None):
+        """Queries the snapshot pyramid of the dataset, which is used for all policies.
+
+        :param dict snapshot_args: Keyword arguments for SnapshotSpace, like snapshot grouping options
+        :param int max_queries: Don't query the pyramid if it needs more range queries than this, because
+            they are not in the range cache. None always queries the pyramid.
+        """
+        snapshot_args = dict(snapshot_args or dict(), drill=None, defer=True)
+        prune = snapshot_args.pop('prune', None)
+        self.zb = zb
+        self.dataset_name = dataset_name
+        self.identities = zb.get_snapshot_identities(dataset_name)
+        self.ss = SnapshotSpace(dataset_name, zb, **snapshot_args)
+        self.column_starts, self.column_ends = dict(), dict()
+        if max_queries is not None:
+            if self.ss.estimated:  # Two property reads, and up to four dry-runs per refined cell
+                needed = self.ss.refine_count * 4
+            else:
+                columns = self.ss.columns
+                pairs = [(columns[start][1], columns[end][2])
+                         for end in range(len(columns)) for start in range(end + 1)]
+                sizes, _ = zb._cached_sizes(dataset_name, self.ss.snapshot_names, pairs)
+                needed = sum(size is None for size in sizes)
+            if needed > max_queries:
+                return
+        self.ss.query(prune)
+        if not prune:  # A pruned pyramid holds zeros instead of sizes up to the prune limit
+            self.column_starts = {first: col for col, (_, first, _) in enumerate(self.ss.columns)}
+            self.column_ends = {last: col for col, (_, _, last) in enumerate(self.ss.columns)}
+
+    def _measured(self, row, col):
+        """Whether the space freed by a pyramid cell is measured rather than estimated.
+        An inexact estimate is trusted only where every cell within the range was refined."""
+        if not self.ss.estimated or not self.ss.error_bound:
+            return True
+        return all((r, c) in self.ss.exact_cells for r in range(row + 1) for c in range(col, col + row - r + 1))
+
+    def known_freed(self, first, last):
+        """Returns the space freed by destroying snapshots from first to last if it is known without zfs, or None."""
+        if first in self.column_starts and last in self.column_ends:
+            start, end = self.column_starts[first], self.column_ends[last]
+            if self._measured(end - start, start):
+                return self.ss.would_free_matrix.get(end - start, start)
+        if self.zb.cache is not None:
+            key = RangeSpaceCache.range_key(self.identities, first, last)
+            if key is not None:
+                return self.zb.cache.get(self.dataset_name, key)
+        return None
+
+    def destroy_spec(self, runs):
+        """Returns the snapshot list for zfs destroy like dataset@a%b,c."""
+        return '{}@{}'.format(self.dataset_name, ','.join(
+            self.identities[first].name if first == last else
+            '{}%{}'.format(self.identities[first].name, self.identities[last].name) for first, last in runs))
+
+    def evaluate(self, policy: RetentionPolicy):
+        """Splits the snapshots a policy destroys into runs.
+
+        :return: A tuple of the number of kept snapshots, the number of destroyed snapshots, the space freed by
+            the runs known without zfs, the number of such runs and the list of the other runs
+        """
+        kept = policy.kept(self.identities)
+        known, known_runs, unknown = 0, 0, list()
+        for first, last in destroyed_runs(len(self.identities), kept):
+            freed = self.known_freed(first, last)
+            if freed is None:
+                unknown.append((first, last))
+            else:
+                known += freed
+                known_runs += 1
+        return len(kept), len(self.identities) - len(kept), known, known_runs, unknown
+
+
+def simulate(zb: ZfsBridge, dataset_names, policies, snapshot_args=None):
+    """Calculates the space every policy would free on every dataset.
+
+    :param dataset_names: Datasets with snapshots
+    :param policies: A list of RetentionPolicy
+    :return: A list of SimulationResult in the order of datasets and policies
+    """
+    evaluations = list()
+    specs = dict()  # Destroy specification of the runs unknown without zfs -> space freed
+    for dataset_name in dataset_names:
+        simulator = RetentionSimulator(zb, dataset_name, snapshot_args, max_queries=len(policies))
+        for policy in policies:
+            kept, destroyed, known, known_runs, unknown = simulator.evaluate(policy)
+            spec = simulator.destroy_spec(unknown) if unknown else None
+            if spec is not None:
+                specs[spec] = None
+            evaluations.append((dataset_name, policy, kept, destroyed, known, known_runs, len(unknown), spec))
+
+    def dry_run(spec):
+        try:
+            return int(zb._parse_reclaim(zb._run('destroy', '-nvp', spec, timeout=zb.timeout)))
+        except Exception:
+            return None
+
+    with zb.profiler.phase('retention dry-runs'):
+        specs = dict(zip(specs, zb._get_executor().map(dry_run, specs)))
+    ret = list()
+    for dataset_name, policy, kept, destroyed, known, known_runs, unknown_runs, spec in evaluations:
+        freed = known if spec is None else (None if specs[spec] is None else known + specs[spec])
+        ret.append(SimulationResult(dataset_name, policy.text, kept, destroyed, freed, known_runs, unknown_runs))
+    return ret
+
+
+def print_simulation(results):
+    dv = DivBar()
+    dv.print_hr()
+    print('Space freed by the retention policies:')
+    for dataset_name in dict.fromkeys(result.dataset for result in results):
+        print(term_format['WHITEBOLD'] + dataset_name + term_format['END'])
+        for result in results:
+            if result.dataset == dataset_name:
+                print('  ' + term_format['CYAN'] + '{:>9}'.format(
+                    size2human(result.freed) if result.freed is not None else 'failed') + term_format['END'] +
+                    ' {} keeps {} and destroys {} snapshot(s), {} of {} run(s) asked from zfs'.format(
+                        result.policy, result.kept, result.destroyed, result.queried_runs,
+                        result.pyramid_runs + result.queried_runs))
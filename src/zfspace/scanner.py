@@ -0,0 +1,313 @@
+""" File level analysis of ZFS filesystems.
+
+The scanner walks a mounted filesystem like "du -xs" does, but with a pool of threads. Memory use doesn't
+depend on the number of files: only sizes of the heaviest top level entries and the heaviest directories are kept,
+along with the directories on the stacks of the workers, about depth times the number of subdirectories per
+directory, and inodes with several hardlinks whose other links haven't been seen yet.
+
+The space of a range of snapshots is attributed to files with "zfs diff". Files removed right after the last
+snapshot of the range hold its blocks, and their old versions are still readable in .zfs/snapshot. Renamed files
+keep their blocks in the live filesystem and are skipped. Modified files hold only their changed blocks, which
+can't be told apart, so they are counted whole and reported separately as an upper bound.
+"""
+
+import os
+import re
+import stat
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class TopSizes:
+    """
+    Sums sizes by key in bounded memory with the Space-Saving algorithm. At most capacity keys are kept, and a new
+    key takes the place of the lightest one, starting from its sum. So the sum of a kept key may be too big by
+    the sum it took over, but a key holding more than total / capacity is always kept. Below capacity keys,
+    all sums are exact.
+    """
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.sums = dict()  # Key -> sum
+        self.total = 0
+        self._heap = list()  # (sum, key) of every update, the outdated ones are dropped when they come up
+
+    def add(self, key, size):
+        self.total += size
+        if key not in self.sums and len(self.sums) >= self.capacity:
+            while True:
+                lightest, lightest_key = heapq.heappop(self._heap)
+                if self.sums.get(lightest_key) == lightest:
+                    del self.sums[lightest_key]
+                    break
+            self.sums[key] = lightest
+        self.sums[key] = self.sums.get(key, 0) + size
+        heapq.heappush(self._heap, (self.sums[key], key))
+        if len(self._heap) > 4 * self.capacity:
+            self._heap = [(size, key) for key, size in self.sums.items()]
+            heapq.heapify(self._heap)
+
+    def items(self):
+        """Returns (key, sum) tuples sorted by sum in descending order."""
+        return sorted(self.sums.items(), key=lambda item: -item[1])
+
+
+class ScanResult:
+    def __init__(self):
+        self.entries = TopSizes()  # Top level entry name -> allocated bytes
+        self.heaviest = list()  # Min-heap of (bytes of files right in the directory, directory path)
+        self.files = 0
+        self.errors = 0
+
+    def top_entries(self):
+        """Returns (name, size) tuples of the heaviest top level entries sorted by size in descending order."""
+        return self.entries.items()
+
+    def heaviest_directories(self):
+        """Returns (size, path) tuples of the directories with the biggest files right in them."""
+        return sorted(self.heaviest, reverse=True)
+
+
+def _scan_directory(path, top_name, root_dev, exclude):
+    """Lists a single directory.
+
+    :return: A tuple of the directory path, (top level entry name, bytes) tuples, bytes of files right in
+        the directory, a list of (path, top level entry name) of subdirectories, a list of
+        ((device, inode), bytes, top level entry name, number of links) for files with several hardlinks,
+        the number of files and the number of errors
+    """
+    sizes, own, subdirs, links, files = TopSizes(), 0, list(), list(), 0
+    try:
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                name = top_name or entry.name
+                size = st.st_blocks * 512  # Allocated space, not the apparent file size
+                if stat.S_ISDIR(st.st_mode):
+                    # Other filesystems, including children datasets, are mounted over directories of another device
+                    if st.st_dev != root_dev or entry.path in exclude:
+                        continue
+                    subdirs.append((entry.path, name))
+                elif st.st_nlink > 1:
+                    links.append(((st.st_dev, st.st_ino), size, name, st.st_nlink))
+                    files += 1
+                    continue
+                else:
+                    own += size
+                    files += 1
+                sizes.add(name, size)
+    except OSError:
+        return path, sizes.items(), own, subdirs, links, files, 1
+    return path, sizes.items(), own, subdirs, links, files, 0
+
+
+class _Walk:
+    """Directories of a filesystem walked by several workers, each depth-first with its own stack."""
+    def __init__(self, path, root_dev, exclude, top):
+        self.root_dev = root_dev
+        self.exclude = exclude
+        self.top = top
+        self.result = ScanResult()
+        self.unseen_links = dict()  # (device, inode) -> links not seen yet, of files with several hardlinks
+        self.shared = [(path, None)]  # Directories given away to idle workers
+        self.busy = 0  # Workers with directories on their stacks
+        self.idle = 0  # Workers waiting for a shared directory
+        self.failed = False
+        self.condition = threading.Condition()
+
+    def collect(self, directory, sizes, own, links, files, errors):
+        result = self.result
+        for (inode, size, name, nlink) in links:
+            left = self.unseen_links.pop(inode, None)
+            if left is None:  # A file with several hardlinks is counted once
+                result.entries.add(name, size)
+                own += size
+                left = nlink
+            if left > 1:
+                self.unseen_links[inode] = left - 1
+        for name, size in sizes:
+            result.entries.add(name, size)
+        if len(result.heaviest) < self.top:
+            heapq.heappush(result.heaviest, (own, directory))
+        elif own > result.heaviest[0][0]:
+            heapq.heapreplace(result.heaviest, (own, directory))
+        result.files += files
+        result.errors += errors
+
+    def _take_shared(self, stack):
+        """Waits for a shared directory. Returns False when all workers are out of work."""
+        with self.condition:
+            self.idle += 1
+            while not self.shared and self.busy and not self.failed:
+                self.condition.wait()
+            self.idle -= 1
+            if not self.shared or self.failed:
+                return False
+            stack.append(self.shared.pop())
+            self.busy += 1
+            return True
+
+    def worker(self):
+        stack = list()
+        try:
+            while stack or self._take_shared(stack):
+                directory, top_name = stack.pop()
+                listing = _scan_directory(directory, top_name, self.root_dev, self.exclude)
+                directory, sizes, own, subdirs, links, files, errors = listing
+                stack.extend(subdirs)
+                with self.condition:
+                    self.collect(directory, sizes, own, links, files, errors)
+                    if self.idle and len(stack) > 1:
+                        self.shared.append(stack.pop(0))  # The shallowest directory, likely with the most work
+                        self.condition.notify()
+                    if not stack:
+                        self.busy -= 1
+                        self.condition.notify_all()
+        except BaseException:
+            with self.condition:
+                self.failed = True  # Don't leave the other workers waiting
+                self.condition.notify_all()
+            raise
+
+
+def scan_filesystem(path, jobs=None, top=10, exclude=()):
+    """Calculates space allocated by files of a filesystem mounted at path, staying on that filesystem.
+
+    Every worker walks depth-first with its own stack of directories, so the directories waiting to be listed
+    are only the subdirectories of the directories on the paths the workers are in, not a whole level of the tree.
+    A worker gives the shallowest directory of its stack to a worker that has run out of work.
+    Files with several hardlinks are remembered only until all their links are seen.
+
+    :param str path: The mountpoint to scan
+    :param int jobs: The number of directories to list at the same time. Defaults to the number of CPUs.
+    :param int top: The number of the heaviest directories to keep
+    :param exclude: Paths of directories to skip, like mountpoints of children datasets
+    :return: ScanResult
+    """
+    jobs = jobs or os.cpu_count() or 1
+    root_dev = os.lstat(path).st_dev
+    path = os.path.normpath(path)
+    walk = _Walk(path, root_dev, set(map(os.path.normpath, exclude)), top)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for future in [executor.submit(walk.worker) for _ in range(jobs)]:
+            future.result()
+    return walk.result
+
+
+_escaped_byte = re.compile(r'\\([0-7]{4})')  # zfs diff writes spaces and non-printable bytes like \0040
+
+
+def _unescape(path):
+    path = _escaped_byte.sub(lambda match: chr(int(match.group(1), 8)), path)
+    try:
+        return path.encode('latin-1').decode('utf-8', 'surrogateescape')
+    except UnicodeEncodeError:  # Not an escaped byte string
+        return path
+
+
+def parse_zfs_diff(lines):
+    """Parses "zfs diff -H" output line by line as it comes.
+
+    :param lines: Iterable of tab separated lines
+    :return: A generator of (change, path, new path) tuples. change is '-', '+', 'M' or 'R',
+        new path is None unless the file was renamed
+    """
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 2:
+            continue
+        yield fields[0], _unescape(fields[1]), _unescape(fields[2]) if len(fields) > 2 else None
+
+
+class AttributionResult(ScanResult):
+    def __init__(self):
+        super().__init__()
+        self.directories = TopSizes()  # Directory path -> bytes of changed files right in the directory
+        self.largest = list()  # Min-heap of (bytes, file path, modified)
+        self.changes = 0  # Lines of zfs diff
+        self.total = 0
+        self.modified = 0  # Bytes of modified files in total, an upper bound of the space they hold
+
+    def largest_files(self):
+        """Returns (size, path, modified) tuples of the biggest changed files.
+        The size of a modified file is an upper bound."""
+        return sorted(self.largest, reverse=True)
+
+    def heaviest_directories(self, top=10):
+        """Returns (size, path) tuples of the directories with the biggest changed files right in them."""
+        return [(size, path) for path, size in self.directories.items()[:top]]
+
+
+def _stat_old_file(root, path, change, since):
+    """Reads the old version of a changed file in the snapshot mounted at root.
+
+    :return: A tuple of the path, the change, allocated bytes, (device, inode) for files with several hardlinks
+        or None, and the number of errors. Directories and files not written since the given time take 0 bytes.
+    """
+    try:
+        st = os.lstat(os.path.join(root, path))
+    except OSError:
+        return path, change, 0, None, 1
+    if stat.S_ISDIR(st.st_mode) or (since is not None and st.st_mtime <= since):
+        return path, change, 0, None, 0
+    return path, change, st.st_blocks * 512, (st.st_dev, st.st_ino) if st.st_nlink > 1 else None, 0
+
+
+def attribute_changes(changes, mountpoint, snapshot_root, jobs=None, top=10, since=None):
+    """Sums space of the old versions of files that were removed or modified.
+    Modified files are counted whole, so their part of the total is an upper bound.
+
+    :param changes: Iterable of (change, path, new path) tuples of parse_zfs_diff, consumed as it comes
+    :param str mountpoint: Where the filesystem is mounted, zfs diff paths start with it
+    :param str snapshot_root: Where the older snapshot of the diff is mounted, like mountpoint/.zfs/snapshot/name
+    :param int jobs: The number of files to stat at the same time. Defaults to the number of CPUs.
+    :param int top: The number of the biggest files to keep
+    :param float since: Skip files not modified after this time, their data is older than the range of snapshots
+    :return: AttributionResult
+    """
+    jobs = jobs or os.cpu_count() or 1
+    mountpoint = os.path.normpath(mountpoint)
+    result = AttributionResult()
+    seen_links = set()
+    running = set()
+
+    def collect(done):
+        for future in done:
+            path, change, size, inode, errors = future.result()
+            result.errors += errors
+            if not size or (inode is not None and inode in seen_links):
+                continue  # A file with several hardlinks is counted once
+            if inode is not None:
+                seen_links.add(inode)
+            directory = os.path.dirname(path) or os.curdir
+            top_name = path.split(os.sep, 1)[0]
+            modified = change == 'M'
+            result.directories.add(directory, size)
+            result.entries.add(top_name, size)
+            if len(result.largest) < top:
+                heapq.heappush(result.largest, (size, path, modified))
+            elif size > result.largest[0][0]:
+                heapq.heapreplace(result.largest, (size, path, modified))
+            result.files += 1
+            result.total += size
+            if modified:
+                result.modified += size
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for change, path, _ in changes:
+            result.changes += 1
+            if change in ('+', 'R'):  # A new file doesn't hold space of the older snapshot, a renamed one is still live
+                continue
+            path = os.path.relpath(path, mountpoint)
+            if path == os.curdir or path.startswith(os.pardir):
+                continue
+            # Only a few files are submitted ahead, so the diff is read no faster than files are checked
+            if len(running) >= jobs * 4:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+            running.add(executor.submit(_stat_old_file, snapshot_root, path, change, since))
+        collect(wait(running).done)
+    return result
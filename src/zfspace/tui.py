@@ -0,0 +1,240 @@
+""" Interactive terminal browser of snapshot pyramids and the tree of children datasets.
+
+The pyramid is shown through a viewport that scrolls with the cursor and zooms by changing the cell width, so
+pyramids of thousands of snapshots stay readable in any terminal. Only the cells inside the viewport get their
+labels and highlight, and the highlight threshold is found once per pyramid, so moving around costs the same
+however big the pyramid is. Views render plain lines of (position, text, style) segments, and only the main loop
+knows about curses.
+"""
+
+import os
+import math
+
+try:
+    import curses
+except ImportError:  # curses is missing on some platforms. Only the interactive mode needs it
+    curses = None
+
+from .zfspace import ZfsBridge, SnapshotSpace, format_in_line, shorten_names, size_label, size2human
+
+
+class PyramidView:
+    widths = (3, 5, 7, 9, 13, 19)  # Cell widths of the zoom levels
+
+    def __init__(self, ss: SnapshotSpace, highlight: float, drill=None):
+        """
+        :param SnapshotSpace ss: A queried snapshot pyramid
+        :param float highlight: Highlight the biggest cells that add up to this fraction of the total size
+        :param int drill: The bucket the pyramid shows, if any
+        """
+        self.ss = ss
+        self.drill = drill
+        self.size = len(ss.columns)
+        self.threshold = ss._highlight_threshold(highlight)
+        self.zoom = 3
+        self.row, self.col = 0, 0  # The cell under the cursor
+        self.left, self.bottom = 0, 0  # The first column and the lowest row of the viewport
+
+    def move(self, rows=0, cols=0):
+        self.row = min(max(self.row + rows, 0), self.size - 1)
+        self.col = min(max(self.col + cols, 0), self.size - 1 - self.row)
+
+    def zoom_by(self, steps):
+        self.zoom = min(max(self.zoom + steps, 0), len(self.widths) - 1)
+
+    def _scroll(self, rows, columns):
+        """Moves the viewport of rows by columns cells to keep the cursor inside."""
+        self.bottom = min(max(self.bottom, self.row - rows + 1), self.row)
+        center = self.col + self.row / 2  # A cell is centered over the range of columns it covers
+        if center < self.left:
+            self.left = math.floor(center)
+        elif center + 1 > self.left + columns:
+            self.left = math.ceil(center + 1 - columns)
+
+    def status(self):
+        first, last, count = self.ss._range_snapshots(self.row, self.col)
+        return '{}@{}%{}: {} snapshot(s), {} exclusive, destroying frees {}'.format(
+            self.ss.dataset_name, first, last, count, size2human(self.ss.snapshot_size_matrix.get(self.row, self.col)),
+            size2human(self.ss.would_free_matrix.get(self.row, self.col)))
+
+    def render(self, width, height):
+        """Returns the lines of the screen, each a list of (column, text, style) segments.
+        style is None, 'title', 'highlight', 'cursor' or 'status'.
+        """
+        cell = self.widths[self.zoom]
+        slot = cell + 1  # A cell and its separator
+        rows = max(height - 3, 1)  # Without the title, the names and the status lines
+        self._scroll(rows, max(width // slot - 1, 1))
+        title = '{}{}: {} snapshots in {} columns. Arrows move, +/- zoom, Enter drills into a bucket, ' \
+                'Tab shows datasets, q quits'.format(self.ss.dataset_name, '' if self.drill is None else
+                                                     ' bucket {}'.format(self.drill),
+                                                     len(self.ss.snapshot_names), self.size)
+        lines = [[(0, title[:width], 'title')]]
+        for row in reversed(range(self.bottom, min(self.bottom + rows, self.size))):
+            segments = list()
+            col = max(0, math.ceil(self.left - row / 2))
+            while col < self.size - row:
+                x = int((col + row / 2 - self.left) * slot)
+                if x + slot >= width:
+                    break
+                size = self.ss.snapshot_size_matrix.get(row, col)
+                style = 'cursor' if (row, col) == (self.row, self.col) else \
+                    'highlight' if size >= self.threshold else None
+                segments.append((x, '|', None))
+                segments.append((x + 1, format_in_line(size_label(size, cell), cell), style))
+                segments.append((x + slot, '|', None))
+                col += 1
+            lines.append(segments)
+        lines.extend([list()] * (rows + 1 - len(lines)))  # Empty lines above a low pyramid
+        first = max(0, self.left)
+        count = min(self.size - first, max((width - 1) // slot, 0))
+        labels = shorten_names([label for label, _, _ in self.ss.columns[first:first + count]], [cell] * count)
+        lines.append([(i * slot, '|' + format_in_line(label, cell), None) for i, label in enumerate(labels)])
+        lines.append([(0, self.status()[:width], 'status')])
+        return lines
+
+
+class TreeView:
+    def __init__(self, zb: ZfsBridge, dataset_name):
+        self.zb = zb
+        self.dataset_name = dataset_name
+        self.items = list()  # (depth, dataset name) in the order of the tree, the biggest children first
+        pending = [(0, dataset_name)]
+        while pending:
+            depth, name = pending.pop()
+            self.items.append((depth, name))
+            children = sorted(zb.index.children.get(name, list()), key=lambda child: zb.index.datasets[child]['used'])
+            pending.extend((depth + 1, child) for child in children)
+        self.cursor = 0
+        self.top = 0
+
+    def move(self, rows=0, cols=0):
+        self.cursor = min(max(self.cursor + rows, 0), len(self.items) - 1)
+
+    def zoom_by(self, steps):
+        pass
+
+    def selected(self):
+        return self.items[self.cursor][1]
+
+    def render(self, width, height):
+        rows = max(height - 2, 1)
+        self.top = min(max(self.top, self.cursor - rows + 1), self.cursor)
+        lines = [[(0, 'Datasets of {}. Enter shows the snapshot pyramid, q quits'.format(
+            self.dataset_name)[:width], 'title')],
+                 [(0, '{:>9} {:>9} {:>6}  {}'.format('USED', 'USEDSNAP', 'SNAPS', 'NAME')[:width], 'status')]]
+        for index in range(self.top, min(self.top + rows, len(self.items))):
+            depth, name = self.items[index]
+            props = self.zb.index.datasets[name]
+            text = '{:>9} {:>9} {:>6}  {}{}'.format(
+                size2human(props['used'] or 0), size2human(props['usedbysnapshots'] or 0),
+                len(self.zb.index.snapshots.get(name, list())), '  ' * depth, name.rsplit('/', 1)[-1])
+            lines.append([(0, text[:width], 'cursor' if index == self.cursor else None)])
+        return lines
+
+
+class Browser:
+    def __init__(self, zb: ZfsBridge, dataset_name, snapshot_args=None, highlight=0.368):
+        """
+        :param dict snapshot_args: Keyword arguments for SnapshotSpace, like snapshot grouping options
+        :param float highlight: Highlight the biggest cells that add up to this fraction of the total size
+        """
+        self.zb = zb
+        self.snapshot_args = dict(snapshot_args or dict(), progressive=False)
+        self.highlight = highlight
+        self.tree = TreeView(zb, dataset_name)
+        self.pyramids = dict()  # (dataset name, bucket) -> PyramidView
+        self.views = [self.tree]  # The last view is shown, Escape goes back to the previous one
+        if zb.index.snapshots.get(dataset_name):
+            self.open_pyramid(dataset_name, self.snapshot_args.get('drill'))
+
+    def open_pyramid(self, dataset_name, drill=None):
+        """Shows the pyramid of the dataset or of its bucket. Pyramids are queried once and kept."""
+        key = (dataset_name, drill)
+        if key not in self.pyramids:
+            ss = SnapshotSpace(dataset_name, self.zb, **dict(self.snapshot_args, drill=drill))
+            self.pyramids[key] = PyramidView(ss, self.highlight, drill)
+        self.views.append(self.pyramids[key])
+
+    def handle(self, key, notify=None):
+        """Reacts to a key code of curses.
+
+        :param notify: Function called with a message before a long zfs query
+        :return: False to quit
+        """
+        view = self.views[-1]
+        moves = {curses.KEY_UP: (1, 0), curses.KEY_DOWN: (-1, 0), curses.KEY_LEFT: (0, -1),
+                 curses.KEY_RIGHT: (0, 1), curses.KEY_PPAGE: (10, 0), curses.KEY_NPAGE: (-10, 0)}
+        if isinstance(view, TreeView):  # The tree goes down the screen
+            moves.update({curses.KEY_UP: (-1, 0), curses.KEY_DOWN: (1, 0), curses.KEY_PPAGE: (-10, 0),
+                          curses.KEY_NPAGE: (10, 0)})
+        if key in (ord('q'), ord('Q')):
+            return False
+        if key in moves:
+            view.move(*moves[key])
+        elif key in (ord('+'), ord('=')):
+            view.zoom_by(1)
+        elif key == ord('-'):
+            view.zoom_by(-1)
+        elif key == ord('\t'):  # The tree over a pyramid and back
+            if view is not self.tree:
+                self.views.append(self.tree)
+            elif len(self.views) > 1:
+                self.views.pop()
+        elif key in (27, curses.KEY_BACKSPACE, 127) and len(self.views) > 1:
+            self.views.pop()
+        elif key in (10, 13, curses.KEY_ENTER):
+            self._enter(view, notify)
+        return True
+
+    def _enter(self, view, notify):
+        if isinstance(view, TreeView):
+            name = view.selected()
+            if self.zb.index.snapshots.get(name):
+                if notify is not None and (name, None) not in self.pyramids:
+                    notify('Querying snapshots of {}...'.format(name))
+                self.open_pyramid(name)
+        elif view.drill is None and view.row == 0 and view.ss.columns[view.col][1] != view.ss.columns[view.col][2]:
+            if notify is not None and (view.ss.dataset_name, view.col) not in self.pyramids:
+                notify('Querying snapshots of bucket {}...'.format(view.col))
+            self.open_pyramid(view.ss.dataset_name, view.col)
+
+    def _draw(self, screen, lines):
+        styles = dict(title=curses.A_BOLD, highlight=curses.color_pair(1) | curses.A_BOLD, cursor=curses.A_REVERSE,
+                      status=curses.A_REVERSE)
+        screen.erase()
+        for y, segments in enumerate(lines):
+            for x, text, style in segments:
+                try:
+                    screen.addstr(y, x, text, styles.get(style, curses.A_NORMAL))
+                except curses.error:  # Writing the bottom right corner moves the cursor out of the screen
+                    pass
+        screen.refresh()
+
+    def run(self, screen):
+        """The main loop of curses.wrapper. The whole screen is drawn at once after every key."""
+        try:
+            curses.curs_set(0)
+            curses.use_default_colors()
+            curses.init_pair(1, curses.COLOR_CYAN, -1)
+        except curses.error:  # Terminals without colors or invisible cursor work anyway
+            pass
+
+        def notify(message):
+            height, width = screen.getmaxyx()
+            self._draw(screen, [list()] * (height - 1) + [[(0, message[:width - 1], 'status')]])
+
+        while True:
+            height, width = screen.getmaxyx()
+            self._draw(screen, self.views[-1].render(width, height))
+            if not self.handle(screen.getch(), notify):
+                return
+
+
+def browse(zb: ZfsBridge, dataset_name, snapshot_args=None, highlight=0.368):
+    """Starts the interactive browser of the dataset in the terminal."""
+    if curses is None:
+        raise ValueError('The interactive mode needs the curses module of Python.')
+    browser = Browser(zb, dataset_name, snapshot_args, highlight)
+    os.environ.setdefault('ESCDELAY', '25')  # Escape goes back at once instead of waiting for a key sequence
+    curses.wrapper(browser.run)
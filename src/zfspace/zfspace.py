@@ -11,10 +11,20 @@ explanatory for inexperienced users.
 """
 
 import os
+import sys
 import math
-import difflib
-import argparse
-import copy
+import time
+import itertools
+import threading
+from array import array
+from collections import namedtuple
+
+from . import instrument
+
+# Modules needed by a part of the commands are imported where they are used: subprocess, re, json, shlex, shutil,
+# signal, select, difflib, argparse, uuid, concurrent.futures and numpy. main reads the arguments of a plain --summary
+# without argparse, so quick queries from shell prompts start without most of them.
+numpy = None
 
 # Version is updated with bump2version helper. Do not update manually or you will lose sync
 __version__ = '0.7.6'
@@ -57,6 +67,22 @@ def size2human(size_bytes: int, fmt='full'):
             return '{:.4} {}'.format(s, size_name[order])
 
 
+def human2size(size_str: str):
+    """Convert human readable size like 1.5G, 10 MiB or 512 into a number of bytes.
+    This is the reverse of size2human with both 'full' and 'short' formats accepted.
+
+    :param str size_str: Number followed by an optional size letter and an optional 'iB' or 'B'
+    :return: Integer number of bytes
+    :rtype: int
+    """
+    import re
+    match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*([kKMGTPEZY]?)(i?B)?\s*', size_str)
+    if match is None:
+        raise ValueError('Can not understand size {}.'.format(size_str))
+    order = ' KMGTPEZY'.index(match.group(2).upper()) if match.group(2) else 0
+    return int(float(match.group(1)) * 1024 ** order)
+
+
 def split_terminal_line(term_columns, slices=0, fractions_list=None, padding=0):
     # Convert slices into fractions_list
     if fractions_list is None:
@@ -86,26 +112,52 @@ def split_terminal_line(term_columns, slices=0, fractions_list=None, padding=0):
     return start_pos, end_pos
 
 
-def print_in_line(string, str_length, emphasis=None):
-    """Prints centered output, considering that console cursor is in the beginning of the span to print.
-    Prints . or nothing if there is not enough space to print wrole string
+def format_in_line(string, str_length, emphasis=None):
+    """Returns the string centered in str_length symbols, or dots if there is not enough space for the whole string.
 
-    :param string: String to print
+    :param string: String to format
     :param int str_length: Integer number of symbols to fill with string
     :param string emphasis: Make terminal text highlighted, colored, bold or whatever, based on term_format dict
-    :return: None
+    :return: str
     """
     if emphasis is not None and emphasis not in term_format:
         raise ValueError('Incorrect emphasis passed to print_in_line.')
     if len(string) > str_length:
         string = '.' * str_length
     if str_length == 0:
-        return
+        return ''
     len_format = '{:^' + '{:d}'.format(str_length) + 's}'  # Prepare format string with desired width
     if emphasis is None:
-        print(len_format.format(string), end='')
-    else:
-        print(term_format[emphasis] + len_format.format(string) + term_format['END'], end='')
+        return len_format.format(string)
+    return term_format[emphasis] + len_format.format(string) + term_format['END']
+
+
+def print_in_line(string, str_length, emphasis=None):
+    """Prints centered output, considering that console cursor is in the beginning of the span to print.
+    Prints . or nothing if there is not enough space to print wrole string. See format_in_line for the arguments.
+    """
+    print(format_in_line(string, str_length, emphasis), end='')
+
+
+def _numpy():
+    """Returns the numpy module, or None if it is not installed. numpy is optional, it only speeds up pyramids of
+    hundreds of snapshots, so it is imported with the first pyramid.
+    """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy or None
+
+
+def size_label(size_bytes, str_length):
+    """Returns the size in the full human readable format, or in the short one if the full one doesn't fit."""
+    if size_bytes is None:
+        return '?'
+    label = size2human(size_bytes)
+    return label if len(label) <= str_length else size2human(size_bytes, fmt='short')
 
 
 def shorten_names(names_list, length_list):
@@ -118,6 +170,8 @@ def shorten_names(names_list, length_list):
     if len(names_list) <= 1:
         return names_list
 
+    import difflib
+
     # Find candidates for removal by first two names
     match = difflib.SequenceMatcher(None, names_list[0], names_list[1])
     # We save size with sequences longer than '...'
@@ -153,39 +207,563 @@ class DivBar:
     An object to draw console visual representations of parts as bars forming a whole
     """
     def __init__(self):
-        self.term_columns, self.term_lines = os.get_terminal_size()
+        import shutil
+        self.term_columns, self.term_lines = shutil.get_terminal_size()
 
-    def print_dict(self, names_list):
-        """ Print a bar in terminal divided into segments. It helps to visualize the differences in sizes.
+    def format_dict(self, names_list):
+        """ Returns a line of a bar divided into segments. It helps to visualize the differences in sizes.
 
         :param names_list: a list of tuples consisting of a name of a segment and its integer size
-        :return: None
+        :return: str
         """
         names, sizes = zip(*names_list)
         start, end = split_terminal_line(self.term_columns, fractions_list=sizes)
-        for i, name in enumerate(names):
-            print('|', end='')
-            print_in_line(name + ' ' + size2human(sizes[i]), end[i] - start[i])
-        print('|')  # New line afterwards
+        return '|' + ''.join(format_in_line(name + ' ' + size2human(sizes[i]), end[i] - start[i]) + '|'
+                             for i, name in enumerate(names))
+
+    def print_dict(self, names_list):
+        """ Print a bar in terminal divided into segments. See format_dict for the arguments."""
+        print(self.format_dict(names_list))
 
     def print_hr(self):
         print('-'*self.term_columns)
 
 
+class TriangularMatrix:
+    """
+    Compact storage of a snapshot pyramid.
+
+    Row i describes ranges of i + 1 snapshots, so it has size - i cells, and cell [i][j] is the range that starts
+    at snapshot j and ends at snapshot j + i. Rows are stored one after another in a flat array of 64-bit
+    integers, and several matrices may share one array.
+    """
+    def __init__(self, size, storage=None, offset=0):
+        self.size = size
+        self.cells = size * (size + 1) // 2
+        self._storage = storage if storage is not None else array('q', bytes(8 * self.cells))
+        self._offset = offset
+
+    @classmethod
+    def pair(cls, size):
+        """Creates two matrices of the same size sharing a single storage array."""
+        cells = size * (size + 1) // 2
+        storage = array('q', bytes(16 * cells))
+        return cls(size, storage), cls(size, storage, cells)
+
+    def _row_start(self, row):
+        if row < 0:
+            row += self.size
+        if not 0 <= row < self.size:
+            raise IndexError('Row {} is out of {} rows.'.format(row, self.size))
+        return self._offset + row * self.size - row * (row - 1) // 2
+
+    def get(self, row, col):
+        return self._storage[self._row_start(row) + col]
+
+    def set(self, row, col, value):
+        self._storage[self._row_start(row) + col] = value
+
+    def row(self, row):
+        start = self._row_start(row)
+        return self._storage[start:start + self.size - row % self.size].tolist()
+
+    def __getitem__(self, row):
+        return self.row(row)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return (self.row(i) for i in range(self.size))
+
+    def __eq__(self, other):
+        return isinstance(other, TriangularMatrix) and self.size == other.size and list(self) == list(other)
+
+    def exclusive_at(self, row, col):
+        """Returns the exclusive space of a single cell. See exclusive method."""
+        ret = self.get(row, col)
+        if row > 0:
+            ret -= self.get(row - 1, col) + self.get(row - 1, col + 1)
+        if row > 1:
+            ret += self.get(row - 2, col + 1)
+        return ret
+
+    def exclusive(self, out=None):
+        """
+        Treats self as a matrix of space freed by destroying each range and calculates the space held
+        by each range alone, without the space of its subranges.
+
+        A block is freed by destroying a range when every snapshot referencing it is in the range. So the space
+        exclusive to a range is found by inclusion-exclusion of the three ranges one snapshot shorter:
+        E(a, b) = W(a, b) - W(a + 1, b) - W(a, b - 1) + W(a + 1, b - 1). This is O(1) per cell.
+        :param TriangularMatrix out: Matrix of the same size to write the result to. A new one is created if None
+        :return: The matrix of exclusive space
+        """
+        if out is None:
+            out = TriangularMatrix(self.size)
+        if _numpy() is not None:
+            self._exclusive_numpy(out)
+            return out
+        for i in range(self.size):
+            start, length = self._row_start(i), self.size - i
+            row = self._storage[start:start + length]
+            if i > 0:
+                below = self._storage[start - length - 1:start]  # Row i - 1 has one cell more
+                row = array('q', (w - left - right for w, left, right in zip(row, below, below[1:])))
+            if i > 1:
+                inner = self._row_start(i - 2) + 1
+                inner = self._storage[inner:inner + length]
+                row = array('q', (w + both for w, both in zip(row, inner)))
+            out_start = out._row_start(i)
+            out._storage[out_start:out_start + length] = row
+        return out
+
+    def _exclusive_numpy(self, out):
+        source = numpy.frombuffer(self._storage, dtype=numpy.int64)
+        target = numpy.frombuffer(out._storage, dtype=numpy.int64)
+        for i in range(self.size):
+            start, length = self._row_start(i), self.size - i
+            row = source[start:start + length].copy()
+            if i > 0:
+                below = source[start - length - 1:start]
+                row -= below[:-1] + below[1:]
+            if i > 1:
+                inner = self._row_start(i - 2) + 1
+                row += source[inner:inner + length]
+            out_start = out._row_start(i)
+            target[out_start:out_start + length] = row
+
+
+# Identity of a snapshot. Names can be reused after destroy, but guid never repeats
+SnapshotInfo = namedtuple('SnapshotInfo', ['name', 'guid', 'createtxg', 'creation'])
+
+
+class RangeSpaceCache:
+    """
+    On-disk storage of snapshot range dry-run results, one JSON file per dataset.
+
+    Snapshots are immutable, but the space a range would free depends on its neighbours too: blocks shared
+    with the previous or the next snapshot are not freed. So a range is keyed by the guids of its first and last
+    snapshots, the guids of the snapshots around it and the number of snapshots inside. Any destroy that
+    could change the result changes the key. Ranges ending at the newest snapshot share blocks with the live
+    filesystem that keeps changing, so they are never cached.
+    """
+    def __init__(self, directory=None):
+        if directory is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            directory = os.path.join(cache_home, 'zfspace')
+        self.directory = directory
+        self._datasets = dict()  # Dataset name -> dict of range key -> size
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _path(self, dataset_name):
+        return os.path.join(self.directory, dataset_name.replace('/', '%') + '.json')
+
+    def _entries(self, dataset_name):
+        if dataset_name not in self._datasets:
+            import json
+            try:
+                with open(self._path(dataset_name)) as f:
+                    self._datasets[dataset_name] = json.load(f)
+            except (OSError, ValueError):  # Missing or damaged cache is just empty
+                self._datasets[dataset_name] = dict()
+        return self._datasets[dataset_name]
+
+    @staticmethod
+    def range_key(identities, first, last):
+        """Builds the cache key for a range of snapshots.
+
+        :param identities: The list of SnapshotInfo for all snapshots of the dataset, sorted by creation
+        :param int first: Index of the first snapshot of the range in identities
+        :param int last: Index of the last snapshot of the range in identities
+        :return: String key or None if the range can't be cached
+        """
+        if last + 1 >= len(identities):
+            return None
+        previous = identities[first - 1].guid if first > 0 else ''
+        return '{}:{}:{}:{}:{}'.format(previous, identities[first].guid, identities[last].guid,
+                                       identities[last + 1].guid, last - first + 1)
+
+    def get(self, dataset_name, key):
+        with self._lock:
+            return self._entries(dataset_name).get(key)
+
+    def put(self, dataset_name, key, size):
+        with self._lock:
+            self._entries(dataset_name)[key] = size
+            self._dirty.add(dataset_name)
+
+    def evict(self, dataset_name, identities):
+        """Removes all entries referencing snapshots that no longer exist."""
+        guids = {str(info.guid) for info in identities}
+        guids.add('')
+        with self._lock:
+            entries = self._entries(dataset_name)
+            stale = [key for key in entries if not all(guid in guids for guid in key.split(':')[:4])]
+            for key in stale:
+                del entries[key]
+            if stale:
+                self._dirty.add(dataset_name)
+
+    def save(self):
+        with self._lock:
+            if self._dirty:
+                os.makedirs(self.directory, exist_ok=True)
+            import json
+            for dataset_name in self._dirty:
+                path = self._path(dataset_name)
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(self._datasets[dataset_name], f)
+                os.replace(path + '.tmp', path)  # Never leave a half written cache behind
+            self._dirty.clear()
+
+
+class ShellTransport:
+    """
+    Runs zfs commands and returns their output.
+    This transport starts /bin/sh for every command, which then starts zfs, the way os.popen does.
+    Other transports override run and lines methods.
+    """
+    name = 'shell'
+
+    def __init__(self, zfs_path='/sbin/zfs'):
+        self.zfs_path = zfs_path
+
+    def check(self):
+        """Raises FileNotFoundError if zfs can't be run."""
+        if not os.path.isfile(self.zfs_path):
+            raise FileNotFoundError(
+                '{} is not found on your computer. Is ZFS-on-Linux installed?'.format(self.zfs_path))
+
+    def argv(self, args):
+        """Returns the full command line of a zfs command as a list."""
+        return [self.zfs_path, *args]
+
+    def command(self, args):
+        """Returns the full command line of a zfs command as a string for a shell."""
+        import shlex
+        return ' '.join(map(shlex.quote, self.argv(args)))
+
+    def run(self, args, timeout=None):
+        """Runs zfs with the args list and returns its standard output.
+        Raises TimeoutError if zfs doesn't finish in timeout seconds."""
+        import subprocess
+        try:
+            return subprocess.run(self.command(args), shell=True, stdout=subprocess.PIPE,
+                                  universal_newlines=True, timeout=timeout).stdout
+        except subprocess.TimeoutExpired:
+            raise TimeoutError('"{}" did not finish in {} seconds.'.format(self.command(args), timeout))
+
+    def _popen(self, args, stderr):
+        import subprocess
+        return subprocess.Popen(self.command(args), shell=True, stdout=subprocess.PIPE, stderr=stderr,
+                                universal_newlines=True)
+
+    def lines(self, args):
+        """Runs zfs with the args list and yields lines of its output as they come.
+        Raises OSError with the error message of zfs if it fails."""
+        import tempfile
+        with tempfile.TemporaryFile() as errors:
+            with self._popen(args, errors) as process:
+                yield from process.stdout
+            if process.returncode:
+                errors.seek(0)
+                raise _command_error(self.command(args), process.returncode, errors.read())
+
+    def close(self):
+        pass
+
+
+def _command_error(command, code, message):
+    message = message.decode(errors='replace').strip()
+    return OSError('"{}" failed: {}'.format(command, message or 'exit code {}'.format(code)))
+
+
+class ExecTransport(ShellTransport):
+    """Starts zfs directly without a shell."""
+    name = 'exec'
+
+    def run(self, args, timeout=None):
+        import subprocess
+        try:
+            return subprocess.run(self.argv(args), stdout=subprocess.PIPE, universal_newlines=True,
+                                  timeout=timeout).stdout
+        except subprocess.TimeoutExpired:
+            raise TimeoutError('"{}" did not finish in {} seconds.'.format(self.command(args), timeout))
+
+    def _popen(self, args, stderr):
+        import subprocess
+        return subprocess.Popen(self.argv(args), stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+
+
+class _CoprocessShell:
+    """A long living /bin/sh reading commands from its standard input."""
+    def __init__(self):
+        import tempfile
+        import subprocess
+        # Error messages of a command are kept in a file, which is emptied before the next command
+        self.errors = tempfile.TemporaryFile()
+        # The shell leads its own process group, so killing the group kills the running zfs too
+        self.process = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=self.errors, start_new_session=True)
+        self.buffer = b''
+
+    def execute(self, command, sentinel, timeout):
+        import select
+        # The sentinel goes on a line of its own after the output, so output without trailing new line is kept
+        self._clear_errors()
+        self.process.stdin.write('{} </dev/null; printf "\\n%s\\n" {}\n'.format(command, sentinel).encode())
+        self.process.stdin.flush()
+        marker = '\n{}\n'.format(sentinel).encode()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        fd = self.process.stdout.fileno()
+        while marker not in self.buffer:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError('"{}" did not finish in {} seconds.'.format(command, timeout))
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise OSError('The shell running "{}" has exited.'.format(command))
+            self.buffer += chunk
+        output, self.buffer = self.buffer.split(marker, 1)
+        return output.decode()
+
+    def stream(self, command, sentinel):
+        """Runs the command and yields lines of its output as they come.
+        The sentinel line after the output carries the exit code.
+
+        :return: The error of the command, or None if it succeeded
+        """
+        self._clear_errors()
+        self.process.stdin.write('{} </dev/null; printf "\\n%s %s\\n" {} $?\n'.format(command, sentinel).encode())
+        self.process.stdin.flush()
+        marker = sentinel.encode() + b' '
+        held = None  # The last line is held back, its new line may come from the sentinel line
+        while True:
+            end = self.buffer.find(b'\n')
+            if end < 0:
+                chunk = os.read(self.process.stdout.fileno(), 65536)
+                if not chunk:
+                    raise OSError('The shell running "{}" has exited.'.format(command))
+                self.buffer += chunk
+                continue
+            line, self.buffer = self.buffer[:end + 1], self.buffer[end + 1:]
+            if line.startswith(marker):  # The new line before the sentinel is not a part of the output
+                if held[:-1]:
+                    yield held[:-1].decode()
+                code = int(line[len(marker):])
+                if code:
+                    self.errors.seek(0)
+                    return _command_error(command, code, self.errors.read())
+                return None
+            if held is not None:
+                yield held.decode()
+            held = line
+
+    def _clear_errors(self):
+        self.errors.seek(0)
+        self.errors.truncate()
+
+    def close(self):
+        """Lets the shell exit after the end of its input."""
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+        self.errors.close()
+
+    def kill(self):
+        import signal
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass  # The shell and its commands are gone already
+        self.process.wait()
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass  # A command left in the buffer can't be written to the dead shell
+        self.process.stdout.close()
+        self.errors.close()
+
+
+class CoprocessTransport(ShellTransport):
+    """
+    Keeps a small pool of long living shells and pipes zfs commands into them, so no shell is started per command.
+    Outputs of the commands are separated with a random sentinel line.
+    """
+    name = 'coproc'
+
+    def __init__(self, zfs_path='/sbin/zfs', processes=1):
+        import uuid
+        super().__init__(zfs_path)
+        self.processes = processes
+        self._sentinel = '__zfspace_{}__'.format(uuid.uuid4().hex)
+        self._idle = list()
+        self._started = 0
+        self._condition = threading.Condition()
+
+    def _acquire(self):
+        with self._condition:
+            while not self._idle and self._started >= self.processes:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+        try:
+            return _CoprocessShell()
+        except Exception:
+            self._release(None)
+            raise
+
+    def _release(self, shell):
+        """Returns the shell to the pool. None means the shell is gone and a new one may be started."""
+        with self._condition:
+            if shell is None:
+                self._started -= 1
+            else:
+                self._idle.append(shell)
+            self._condition.notify()
+
+    def run(self, args, timeout=None):
+        shell = self._acquire()
+        try:
+            output = shell.execute(self.command(args), self._sentinel, timeout)
+        except BaseException:  # Ctrl-C doesn't reach the shell in its own session, so it is killed here
+            shell.kill()  # The shell is in unknown state, a new one replaces it
+            self._release(None)
+            raise
+        self._release(shell)
+        return output
+
+    def lines(self, args):
+        shell = self._acquire()
+        try:
+            error = yield from shell.stream(self.command(args), self._sentinel)
+        except BaseException:  # Including the consumer stopping in the middle of the output
+            shell.kill()  # The shell is in unknown state, a new one replaces it
+            self._release(None)
+            raise
+        self._release(shell)
+        if error is not None:
+            raise error
+
+    def close(self):
+        with self._condition:
+            for shell in self._idle:
+                shell.close()
+            self._started -= len(self._idle)
+            self._idle.clear()
+
+
+transports = {transport.name: transport for transport in (ShellTransport, ExecTransport, CoprocessTransport)}
+
+
+# Columns of "zfs list -o space" output and the properties they are made of
+space_columns = (('NAME', 'name'), ('AVAIL', 'available'), ('USED', 'used'), ('USEDSNAP', 'usedbysnapshots'),
+                 ('USEDDS', 'usedbydataset'), ('USEDREFRESERV', 'usedbyrefreservation'),
+                 ('USEDCHILD', 'usedbychildren'))
+
+
+class PoolIndex:
+    """
+    All datasets and snapshots of the system with the properties zfspace needs.
+    It is built from a single "zfs list" output, parsed line by line as it comes.
+    """
+    properties = ('name', 'type', 'available', 'used', 'usedbysnapshots', 'usedbydataset', 'usedbyrefreservation',
+                  'usedbychildren', 'mountpoint', 'refreservation', 'guid', 'createtxg', 'creation')
+
+    def __init__(self, lines):
+        """
+        :param lines: Iterable of tab separated lines of "zfs list -H -p" output with PoolIndex.properties columns
+        """
+        self.datasets = dict()  # Dataset name -> dict of properties
+        self.children = dict()  # Dataset name -> list of direct children names
+        self.snapshots = dict()  # Dataset name -> list of SnapshotInfo sorted by creation
+        for line in lines:
+            values = line.rstrip('\n').split('\t')
+            if len(values) != len(self.properties):
+                continue
+            props = dict(zip(self.properties, map(self._convert, values)))
+            name = props['name']
+            if props['type'] == 'snapshot':
+                dataset, snapshot = name.split('@')
+                self.snapshots.setdefault(dataset, list()).append(
+                    SnapshotInfo(snapshot, props['guid'], props['createtxg'], props['creation']))
+            else:
+                self.datasets[name] = props
+                self.children.setdefault(name, list())
+                if '/' in name:
+                    self.children.setdefault(name.rsplit('/', 1)[0], list()).append(name)
+        for snapshots in self.snapshots.values():
+            snapshots.sort(key=lambda info: info.createtxg)
+
+    @staticmethod
+    def _convert(value):
+        if value == '-':
+            return None
+        return int(value) if value.isdigit() else value
+
+    def summary(self, dataset_name):
+        """Returns the "zfs list -o space" columns of a dataset as a list of (column name, value) tuples."""
+        props = self.datasets[dataset_name]
+        return [(column, props[prop]) for column, prop in space_columns]
+
+
 class ZfsBridge:
     zfs_path = '/sbin/zfs'
+    profiler = instrument.disabled
+    history = None
 
-    def __init__(self):
+    def __init__(self, jobs=None, timeout=None, cache=None, transport=None, zfs_path=None, profiler=None,
+                 history=None, index=True):
+        """
+        :param int jobs: Maximum number of zfs queries running at the same time. Defaults to the number of CPUs.
+        :param float timeout: Seconds to wait for a single snapshot range query. None means wait forever.
+        :param RangeSpaceCache cache: Persistent storage of range query results. None disables caching.
+        :param transport: A transport object like ExecTransport or a transport name from transports dict
+            to run zfs commands with. Defaults to ExecTransport.
+        :param str zfs_path: Path to zfs executable for a transport created by name. Defaults to ZfsBridge.zfs_path.
+        :param instrument.Profiler profiler: Records zfs commands and analysis phases. None records nothing.
+        :param history.HistoryStore history: Keeps the queried pyramids for the history. None keeps nothing.
+        :param index: True to list all datasets and snapshots at once, or a ready PoolIndex to use instead.
+            If False, the pool is listed when a query first needs it, and get_dataset_summary reads just
+            the dataset, so a quick summary takes one zfs call.
+        """
+        if jobs is not None and jobs < 1:
+            raise ValueError('The number of jobs must be a positive integer.')
+        self.jobs = jobs or os.cpu_count() or 1
+        self.timeout = timeout
+        self.cache = cache
+        if zfs_path is not None:
+            self.zfs_path = zfs_path
+        if transport is None or isinstance(transport, str):
+            transport = transports[transport or 'exec'](self.zfs_path)
+        if profiler is not None:
+            self.profiler = profiler
+        self.history = history
+        self.transport = self.profiler.wrap(transport)
+        self.zfs_path = transport.zfs_path
+        self._executor = None
+        self._executor_lock = threading.Lock()
         # Check whether zfs is present in the system
-        if not os.path.isfile('/sbin/zfs'):
-            raise FileNotFoundError(
-                '{} is not found on your computer. Is ZFS-on-Linux installed?'.format(self.zfs_path))
-        # Check and store existing ZFS datasets to be able to explain the user's input errors
-        stream = os.popen('{} list'.format(self.zfs_path))
-        output = stream.read().split('\n')[1:-1]  # Take all strings of ZFS listing except first and last one
-        self.zfs_datasets = list()
-        for string in output:
-            self.zfs_datasets.append(string.split(' ')[0])
+        self.transport.check()
+        # Index all datasets and snapshots at once. It also explains the user's input errors
+        self.index = None
+        if isinstance(index, PoolIndex):
+            self.index = index
+        elif index:
+            self.refresh()
+
+    def _run(self, *args, timeout=None):
+        return self.transport.run(args, timeout)
+
+    def refresh(self):
+        """Reads all datasets and snapshots of the system again.
+        Raises OSError with the error message of zfs if it fails, the old index is kept then."""
+        with self.profiler.phase('listing'):
+            self.index = PoolIndex(self.transport.lines(['list', '-H', '-p', '-t', 'filesystem,volume,snapshot',
+                                                         '-s', 'createtxg', '-o', ','.join(PoolIndex.properties)]))
 
     @staticmethod
     def strip_filesystem_name(snapshot_name: str):
@@ -201,8 +779,11 @@ class ZfsBridge:
         return snapshot_name.split('@')[1]
 
     def _check_dataset_name(self, dataset_name):
-        if dataset_name not in self.zfs_datasets:
-            candidate_list = difflib.get_close_matches(dataset_name, self.zfs_datasets, n=1)
+        if self.index is None:
+            self.refresh()
+        if dataset_name not in self.index.datasets:
+            import difflib
+            candidate_list = difflib.get_close_matches(dataset_name, list(self.index.datasets), n=1)
             if len(candidate_list) == 1:
                 suggest_str = '\nDid you mean using ' + \
                               term_format['WHITEBOLD'] + '"{}"'.format(candidate_list[0]) + term_format['END'] + \
@@ -211,116 +792,309 @@ class ZfsBridge:
                 suggest_str = ''
             raise ValueError('There is no dataset "{}" in the system.{}'.format(dataset_name, suggest_str))
 
-    @staticmethod
-    def _zfs_output_convert(line: str):
-        """
-        Takes a line of ZFS output and convert it to a list with name and integer values
-        :param line: ZFS console output
-        :return: list starting with a string and followed by integers with data from input line
-        """
-        lst = list(filter(None, line.split(' ')))
-        return [lst[0], *list(map(int, lst[1:]))]  # Convert to integers all but name of the dataset
-
     def get_filesystem_mountpoint(self, dataset_name):
         self._check_dataset_name(dataset_name)
-        command = '{} get -Hp mountpoint {}'.format(self.zfs_path, dataset_name)
-        stream = os.popen(command)
-        output = stream.read().split('\t')[2]
-        return output
+        return self.index.datasets[dataset_name]['mountpoint']
 
     def get_filesystem_refreservation(self, dataset_name):
         self._check_dataset_name(dataset_name)
-        command = '{} get -Hp refreservation {}'.format(self.zfs_path, dataset_name)
-        stream = os.popen(command)
-        output = stream.read().split('\t')[2]
-        return int(output)
+        return self.index.datasets[dataset_name]['refreservation'] or 0
 
     def get_children_summary(self, dataset_name):
         self._check_dataset_name(dataset_name)
-        command = '{} list -d 1 -p -S used -o space {}'.format(self.zfs_path, dataset_name)
-        stream = os.popen(command)
-        output = stream.read().split('\n')[:-1]  # Get all lines except the last one, that is empty
-        names = list(filter(None, output[0].split(' ')))
-        children = list()
-        for child in output[1:]:
-            data = self._zfs_output_convert(child)
-            if data[0] == dataset_name:  # Filter out the parent
-                continue
-            children.append(list(zip(names, data)))
-        return children
+        children = [self.index.summary(child) for child in self.index.children[dataset_name]]
+        return sorted(children, key=lambda child: -child[2][1])
 
     def get_snapshot_names(self, dataset_name):
         self._check_dataset_name(dataset_name)
-        command = '{} list -H -d 1 -t snapshot -s creation -o name {}'.format(self.zfs_path, dataset_name)
-        stream = os.popen(command)
-        output = stream.read().split('\n')[:-1]  # Take all strings of ZFS snapshot listing except last one
-        return list(map(self.strip_filesystem_name, output))
+        return [info.name for info in self.index.snapshots.get(dataset_name, list())]
+
+    def get_snapshot_identities(self, dataset_name):
+        """Returns a list of SnapshotInfo for every snapshot of the dataset sorted by creation."""
+        self._check_dataset_name(dataset_name)
+        return list(self.index.snapshots.get(dataset_name, list()))
+
+    def _get_executor(self):
+        """Returns the worker pool shared by all parallel zfs queries of this bridge.
+        The pool is created on first use, so a bridge that never runs range queries doesn't start threads.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+            return self._executor
 
     def _get_snapshot_range_space(self, dataset, first_snap, last_snap):
-        command = '{} destroy -nvp {}@{}%{}'.format(self.zfs_path, dataset, first_snap, last_snap)
-        stream = os.popen(command)
-        return stream.read().split('\n')[-2].split('\t')[-1]  # Take the second part of the last line
+        output = self._run('destroy', '-nvp', '{}@{}%{}'.format(dataset, first_snap, last_snap), timeout=self.timeout)
+        return self._parse_reclaim(output)
+
+    @staticmethod
+    def _parse_reclaim(output):
+        return output.split('\n')[-2].split('\t')[-1]  # Take the second part of the last line
 
-    def get_snapshots_space(self, dataset_name, snapshot_list):
+    def _cached_sizes(self, dataset_name, snapshot_list, pairs):
+        """Looks up (start, end) ranges of snapshot_list in the cache.
+
+        :return: A list of cached sizes, None for ranges not in the cache, and a list of their cache keys
+        """
+        sizes = [None] * len(pairs)
+        keys = [None] * len(pairs)
+        if self.cache is not None:
+            identities = self.get_snapshot_identities(dataset_name)
+            self.cache.evict(dataset_name, identities)
+            position = {info.name: index for index, info in enumerate(identities)}
+            for i, (start, end) in enumerate(pairs):
+                keys[i] = self.cache.range_key(identities, position[snapshot_list[start]],
+                                               position[snapshot_list[end]])
+                if keys[i] is not None:
+                    sizes[i] = self.cache.get(dataset_name, keys[i])
+        return sizes, keys
+
+    def _store_size(self, dataset_name, key, size):
+        if key is not None:
+            self.cache.put(dataset_name, key, size)
+
+    def _query_ranges(self, dataset_name, snapshot_list, pairs):
+        """Gets the space freed by destroying each (start, end) range of snapshot_list.
+        Cached results are taken from the cache, the rest is queried in parallel.
+
+        :return: List of integer sizes in the same order as pairs
+        """
+        sizes, keys = self._cached_sizes(dataset_name, snapshot_list, pairs)
+        missing = [i for i, size in enumerate(sizes) if size is None]
+        # Every range is an independent dry-run, so the queries are spread over the worker pool.
+        # Results come back in submission order, which keeps the matrix assembly deterministic.
+        results = self._get_executor().map(
+            lambda i: int(self._get_snapshot_range_space(dataset_name, snapshot_list[pairs[i][0]],
+                                                         snapshot_list[pairs[i][1]])),
+            missing)
+        for i, size in zip(missing, results):
+            sizes[i] = size
+            self._store_size(dataset_name, keys[i], size)
+        if self.cache is not None:
+            self.cache.save()
+        return sizes
+
+    def _query_pruned(self, dataset_name, snapshot_list, bounds, prune, would_free_matrix):
+        """Fills would_free_matrix row by row from the top, skipping ranges inside ranges of prune bytes or less.
+        Queried ranges keep their real size, the skipped ones hold 0.
+        """
+        size = len(bounds)
+        for row in reversed(range(size)):
+            above = would_free_matrix.row(row + 1) if row + 1 < size else None
+            # A range is queried only when both enclosing ranges one snapshot longer hold more than prune bytes
+            columns = [col for col in range(size - row) if above is None or
+                       ((col == 0 or above[col - 1] > prune) and (col == size - row - 1 or above[col] > prune))]
+            pairs = [(bounds[col][0], bounds[col + row][1]) for col in columns]
+            for col, freed in zip(columns, self._query_ranges(dataset_name, snapshot_list, pairs)):
+                would_free_matrix.set(row, col, freed)
+
+    def get_snapshots_space(self, dataset_name, snapshot_list, bounds=None, prune=None):
+        """Calculates the pyramid of space occupied by snapshot ranges.
+
+        :param str dataset_name: The dataset to analyze
+        :param snapshot_list: Names of the dataset snapshots sorted by creation
+        :param bounds: A list of (first index, last index) tuples of snapshot_list, describing consecutive buckets
+            of snapshots to use as pyramid columns. Each snapshot is a column of its own if None.
+        :param int prune: Skip queries of ranges that can't hold more than prune bytes. None queries every range.
+            Destroying a subrange never frees more than destroying the whole range. So the pyramid is queried from
+            the widest ranges down, and the subranges of a range freeing prune bytes or less are not queried.
+            Such ranges are shown as 0, and so are the exclusive cells they would make negative.
+            With prune=0 the pyramid is exact.
+        :return: Two TriangularMatrix sharing one storage. The first one holds space occupied by each range and not
+            by its subranges, the second one holds space that would be freed by destroying each range.
+        """
         self._check_dataset_name(dataset_name)
-        used_matrix = [[0 for _ in range(len(snapshot_list))] for _ in range(len(snapshot_list))]
-        for end, end_name in enumerate(snapshot_list):
-            for start, start_name in enumerate(snapshot_list):
-                if start <= end:
-                    used_matrix[end - start][start] = \
-                        int(self._get_snapshot_range_space(dataset_name, start_name, end_name))
+        if bounds is None:
+            bounds = [(i, i) for i in range(len(snapshot_list))]
+        used_matrix, would_free_matrix = TriangularMatrix.pair(len(bounds))
+        with self.profiler.phase('range queries'):
+            if prune is None:
+                columns = [(start, end) for end in range(len(bounds)) for start in range(end + 1)]
+                pairs = [(bounds[start][0], bounds[end][1]) for start, end in columns]
+                sizes = self._query_ranges(dataset_name, snapshot_list, pairs)
+                for (start, end), size in zip(columns, sizes):
+                    would_free_matrix.set(end - start, start, size)
+            else:
+                self._query_pruned(dataset_name, snapshot_list, bounds, prune, would_free_matrix)
         # The occupied space we have in the matrix shows how much space will be freed if we delete the combination
         # While this might be useful to make a decision, this does not show used space hierarchy
         # Let's calculate the space occupied by snapshots combination and not by its subsets
-
-        # Save this matrix because it is also good for analysis
-        would_free_matrix = copy.deepcopy(used_matrix)
-
-        # Now define a helper function for triangle substraction
-        def substract_children(matrix, startx, starty):
-            for x in range(startx):
-                for y in range(starty, starty + startx - x + 1):
-                    matrix[startx][starty] -= matrix[x][y]
-        # Then row by row we substract space occupied by subsets
-        # This is the correct way
-        for i in range(1, len(snapshot_list)):
-            for j, _ in enumerate(snapshot_list):
-                if j < len(snapshot_list) - i:
-                    substract_children(used_matrix, i, j)
+        with self.profiler.phase('exclusive'):
+            would_free_matrix.exclusive(out=used_matrix)
+            if prune is not None:  # A range next to a skipped one is short of the space the skipped one shares
+                for row in range(len(bounds)):
+                    for col, size in enumerate(used_matrix.row(row)):
+                        if size < 0:
+                            used_matrix.set(row, col, 0)
         # Now we can get the whole snapshots occupied space by summing every matrix cell
         return used_matrix, would_free_matrix
 
     def get_dataset_summary(self, dataset_name):
-        self._check_dataset_name(dataset_name)
-        command = '{} list -p -o space {}'.format(self.zfs_path, dataset_name)
-        stream = os.popen(command)
-        string_list = stream.read().split('\n')[0:2]  # Get names and data strings
-        # Split it by spaces and remove empty strings.
-        names = list(filter(None, string_list[0].split(' ')))
-        data = self._zfs_output_convert(string_list[1])
-        return list(zip(names, data))
+        if self.index is None and '@' not in dataset_name:
+            summary = self._read_dataset_summary(dataset_name)
+            if summary is not None:
+                return summary
+        self._check_dataset_name(dataset_name)  # Lists the pool to suggest a dataset name
+        return self.index.summary(dataset_name)
+
+    def _read_dataset_summary(self, dataset_name):
+        """Reads the "zfs list -o space" columns of a single dataset without listing the pool.
+
+        :return: The same list as PoolIndex.summary, or None if there is no such dataset
+        """
+        try:
+            with self.profiler.phase('listing'):
+                properties = ','.join(prop for _, prop in space_columns)
+                lines = list(self.transport.lines(['list', '-H', '-p', '-o', properties, dataset_name]))
+        except OSError:  # The error of zfs is not shown, the pool listing explains a wrong name better
+            return None
+        for line in lines:
+            values = line.rstrip('\n').split('\t')
+            if len(values) == len(space_columns) and values[0] == dataset_name:
+                return [(column, PoolIndex._convert(value)) for (column, _), value in zip(space_columns, values)]
+        return None
+
+
+bucket_time_formats = dict(hour='%Y-%m-%d %H:00', day='%Y-%m-%d', week='%Y-W%W', month='%Y-%m', year='%Y')
+
+
+def group_snapshots(identities, bucket_by='count', buckets=None, pattern=None):
+    """Groups consecutive snapshots into buckets.
+
+    :param identities: A list of SnapshotInfo sorted by creation
+    :param str bucket_by: 'count' to split snapshots into the given number of equal buckets,
+        'hour', 'day', 'week', 'month' or 'year' to group snapshots created in the same period,
+        'name' to group consecutive snapshots with the same match of a regular expression in their names.
+    :param int buckets: The number of buckets for 'count' grouping
+    :param str pattern: Regular expression for 'name' grouping. The first group is used if there is one.
+    :return: A list of tuples (label, first index, last index)
+    """
+    if bucket_by == 'count':
+        if buckets is None or buckets < 1:
+            raise ValueError('The number of buckets must be a positive integer.')
+        if not identities:
+            return []
+        buckets = min(buckets, len(identities))
+        edges = [round(k * len(identities) / buckets) for k in range(buckets + 1)]
+        return [(identities[first].name if first == end - 1 else
+                 '{}..{}'.format(identities[first].name, identities[end - 1].name), first, end - 1)
+                for first, end in zip(edges, edges[1:])]
+    elif bucket_by in bucket_time_formats:
+        def key(info):
+            return time.strftime(bucket_time_formats[bucket_by], time.localtime(info.creation))
+    elif bucket_by == 'name':
+        if not pattern:
+            raise ValueError('A regular expression is required to group snapshots by name.')
+        import re
+        regex = re.compile(pattern)
+
+        def key(info):
+            match = regex.search(info.name)
+            if match is None:
+                return 'other'
+            return match.group(1) if regex.groups else match.group(0)
+    else:
+        raise ValueError('Unknown snapshot grouping {}.'.format(bucket_by))
+    ret = list()
+    for label, group in itertools.groupby(enumerate(identities), key=lambda item: key(item[1])):
+        indexes = [index for index, _ in group]
+        ret.append(('{} ({})'.format(label, len(indexes)), indexes[0], indexes[-1]))
+    return ret
 
 
 class SnapshotSpace:
     zfs_max_snapshots = 30
 
-    def __init__(self, dataset_name):
-        self.term_columns, self.term_lines = os.get_terminal_size()
-        self.zb = ZfsBridge()
-        self.snapshot_names = self.zb.get_snapshot_names(dataset_name)
+    def __init__(self, dataset_name, zb=None, bucket_by=None, buckets=None, pattern=None, drill=None, prune=None,
+                 progressive=False, estimate=False, refine=0, defer=False):
+        """
+        Snapshots are grouped into buckets if bucket_by is set or if there are too many snapshots to show in console.
+        Then the pyramid is built over bucket boundaries. See group_snapshots for the grouping arguments.
+        :param int drill: Show only snapshots of the bucket with this index, counting from 0
+        :param int prune: Don't query ranges that can't hold more than prune bytes. See ZfsBridge.get_snapshots_space
+        :param bool progressive: Don't query anything until print_used, which draws cells as soon as they are known.
+            Ignored with prune, because pruning needs the widest ranges first.
+        :param bool estimate: Estimate the pyramid from space properties with two zfs calls instead of a dry-run
+            per range. See the estimate module. prune is ignored then.
+        :param int refine: Confirm this many of the biggest estimated cells with exact range queries
+        :param bool defer: Don't query anything, the caller calls query when it decides to
+        """
+        import shutil
+        self.term_columns, self.term_lines = shutil.get_terminal_size()
+        self.zb = zb if zb is not None else ZfsBridge()
         self.dataset_name = dataset_name
-        if len(self.snapshot_names) >= self.zfs_max_snapshots:
-            raise ValueError('You have more than {} snapshots in {}. It is too many to show in console.'
-                             .format(len(self.snapshot_names), dataset_name))
-        self.snapshot_size_matrix, self.would_free_matrix = \
-            self.zb.get_snapshots_space(dataset_name, self.snapshot_names)
-
-    def _highlight_matrix(self, highlight_level):
-        # Initialize return matrix with False values
-        ret = [[False for _ in range(len(self.snapshot_size_matrix[0]))] for _ in range(len(self.snapshot_size_matrix))]
-
+        identities = self.zb.get_snapshot_identities(dataset_name)
+        self.snapshot_names = [info.name for info in identities]
+        buckets = buckets or self.zfs_max_snapshots - 1
+        if drill is not None:
+            groups = self._group(identities, bucket_by or 'count', buckets, pattern)
+            if not 0 <= drill < len(groups):
+                raise ValueError('There is no bucket {} among {} buckets of {}.'.format(
+                    drill, len(groups), dataset_name))
+            _, first, last = groups[drill]
+            offset, identities = first, identities[first:last + 1]
+            bucket_by = None  # The snapshots of a bucket are shown as is, unless there are still too many of them
+        else:
+            offset = 0
+        if bucket_by is None and len(identities) >= self.zfs_max_snapshots:
+            bucket_by = 'count'
+        if bucket_by is None:
+            self.columns = [(info.name, offset + i, offset + i) for i, info in enumerate(identities)]
+        else:
+            self.columns = [(label, offset + first, offset + last)
+                            for label, first, last in self._group(identities, bucket_by, buckets, pattern)]
+        self.bucketed = any(first != last for _, first, last in self.columns)
+        self.estimated = estimate
+        self.refine_count = refine
+        self.error_bound = 0  # Bytes an estimated cell may be off by. Refined cells are exact
+        self.exact_cells = set()  # (row, col) of the refined cells
+        self.pruned = False  # Whether ranges were skipped and hold 0
+        if defer or (progressive and prune is None and not estimate):
+            self.snapshot_size_matrix, self.would_free_matrix = None, None
+        else:
+            self.query(prune)
+
+    def _group(self, identities, bucket_by, buckets, pattern):
+        """The same as group_snapshots, but a time or name grouping with too many buckets to show in console
+        falls back to the given number of equal buckets."""
+        groups = group_snapshots(identities, bucket_by, buckets, pattern)
+        if bucket_by != 'count' and len(groups) >= self.zfs_max_snapshots:
+            groups = group_snapshots(identities, 'count', buckets)
+        return groups
+
+    def query(self, prune=None):
+        """Queries the pyramid at once. See ZfsBridge.get_snapshots_space for prune."""
+        if self.estimated:
+            from .estimate import estimate_snapshots_space
+            self.snapshot_size_matrix, self.would_free_matrix, self.error_bound, self.property_values = \
+                estimate_snapshots_space(self.zb, self.dataset_name, self.snapshot_names,
+                                         [(first, last) for _, first, last in self.columns])
+            self.exact_cells = set()
+            if self.refine_count:
+                self.refine(self.refine_count)
+            return
+        self.snapshot_size_matrix, self.would_free_matrix = self.zb.get_snapshots_space(
+            self.dataset_name, self.snapshot_names, [(first, last) for _, first, last in self.columns], prune)
+        self.pruned = bool(prune)
+        if self.zb.history is not None and not prune:  # A pruned pyramid is not exact
+            self.zb.history.add_pyramid(self)
+
+    def refine(self, count):
+        """Replaces the biggest estimated cells with exact values of range queries."""
+        from .estimate import refine_cells
+        cells = [(row, col) for row, sizes in enumerate(self.snapshot_size_matrix) for col, _ in enumerate(sizes)
+                 if (row, col) not in self.exact_cells]
+        cells = sorted(cells, key=lambda cell: -self.snapshot_size_matrix.get(*cell))[:count]
+        bounds = [(first, last) for _, first, last in self.columns]
+        refine_cells(self.zb, self.dataset_name, self.snapshot_names, bounds, self.snapshot_size_matrix,
+                     self.would_free_matrix, cells)
+        self.exact_cells.update(cells)
+
+    def _highlight_threshold(self, highlight_level):
+        """Returns the smallest exclusive size of the biggest cells that add up to highlight_level of the total."""
         # Now get total size from would_free_matrix top element
-        total_size = self.would_free_matrix[-1][0]
+        total_size = self.would_free_matrix.get(-1, 0)
 
         # Sort sizes to apply highlight_level
         flatten_sizes = [j for sub in self.snapshot_size_matrix for j in sub]
@@ -328,77 +1102,239 @@ class SnapshotSpace:
 
         # Calculate threshold
         accumulator = 0  # Accumulate sum of sizes, until reach the desired fraction of total size
-        threshold = 0  # A variable for threshold
         for s in flatten_sizes:
             accumulator += s
             if accumulator >= total_size * highlight_level:
-                threshold = s
-                break
+                return s
+        return 0
 
-        # Fill the matrix, knowing size threshold
-        for i, row in enumerate(ret):
-            for j, _ in enumerate(row):
-                if self.snapshot_size_matrix[i][j] >= threshold:
-                    ret[i][j] = True
-        return ret
+    def _highlight_matrix(self, highlight_level):
+        # Fill the triangular matrix, knowing size threshold
+        threshold = self._highlight_threshold(highlight_level)
+        return [[size >= threshold for size in row] for row in self.snapshot_size_matrix]
+
+    def _line_layout(self, cells):
+        """Returns start and end terminal columns of the cells of a pyramid line with the given number of cells."""
+        max_split = len(self.columns)
+        return split_terminal_line(self.term_columns, slices=cells,
+                                   padding=int((max_split - cells) * self.term_columns / max_split / 2))
+
+    def _format_line(self, sizes, highlight):
+        start, end = self._line_layout(len(sizes))
+        return ' ' * (start[0] - 1) + '|' + ''.join(  # shifting for padding
+            format_in_line(size_label(size, end[i] - start[i]), end[i] - start[i],
+                           emphasis='CYAN' if highlight[i] else None) + '|' for i, size in enumerate(sizes))
+
+    def _format_names(self):
+        start, end = split_terminal_line(self.term_columns, slices=len(self.columns))
+        lengths = [end[i] - start[i] for i, _ in enumerate(start)]
+        return '|' + ''.join(format_in_line(name, lengths[i]) + '|' for i, name in enumerate(
+            shorten_names([label for label, _, _ in self.columns], lengths)))
 
     def _print_line(self, sizes, highlight):
-        max_split = len(self.snapshot_names)
-        start, end = split_terminal_line(self.term_columns, slices=len(sizes),
-                                         padding=int((max_split - len(sizes)) * self.term_columns / max_split / 2))
-        print(' ' * (start[0] - 1) + '|', end='')  # shifting for padding
-        for i, size in enumerate(sizes):
-            print_in_line(size2human(size), end[i] - start[i], emphasis='CYAN' if highlight[i] else None)
-            print('|', end='')
-        print('')  # New line afterwards
+        print(self._format_line(sizes, highlight))
 
     def _print_names(self):
-        start, end = split_terminal_line(self.term_columns, slices=len(self.snapshot_names))
-        lengths = [end[i] - start[i] for i, _ in enumerate(start)]
-        for i, name in enumerate(shorten_names(self.snapshot_names, lengths)):
-            print('|', end='')
-            print_in_line(name, lengths[i])
-        print('|')  # New line afterwards
+        print(self._format_names())
+
+    def render(self, highlight: float):
+        """Returns the whole pyramid of a queried SnapshotSpace as a single string. See print_used."""
+        with self.zb.profiler.phase('highlight'):
+            hl = self._highlight_matrix(highlight)
+        with self.zb.profiler.phase('rendering'):
+            lines = [self._format_line(self.snapshot_size_matrix[i], hl[i]) for i in reversed(range(len(self.columns)))]
+            lines.append(self._format_names())
+        return '\n'.join(lines) + '\n'
+
+    def query_progressive(self, callback=None):
+        """Queries the pyramid with asyncio, the shortest ranges first.
+
+        :param callback: Function called with (row, col, exclusive size, would free size) arguments for every
+            pyramid cell as soon as it is known
+        """
+        from .aio import AsyncZfsBridge, run_until_complete
+        bridge = AsyncZfsBridge(self.zb)
+        with self.zb.profiler.phase('range queries'):
+            self.snapshot_size_matrix, self.would_free_matrix = run_until_complete(bridge.get_snapshots_space(
+                self.dataset_name, self.snapshot_names, [(first, last) for _, first, last in self.columns], callback))
+        if self.zb.history is not None:
+            self.zb.history.add_pyramid(self)
+
+    def _print_progressive(self):
+        """Queries the pyramid with asyncio, drawing every cell as soon as it is known, bottom rows first.
+        Nothing is drawn unless the output is a terminal tall enough for the pyramid.
+
+        :return: True if the pyramid was drawn and the cursor is below it
+        """
+        size = len(self.columns)
+        drawing = sys.stdout.isatty() and size + 2 < self.term_lines
+
+        def draw_cell(row, col, exclusive, _):
+            start, end = self._line_layout(size - row)
+            up = row + 2  # Lines between the cursor below the names and the pyramid row
+            print('\033[{}A\033[{}G'.format(up, start[col] + 1), end='')
+            print_in_line(size_label(exclusive, end[col] - start[col]), end[col] - start[col])
+            print('\033[{}B\r'.format(up), end='', flush=True)
+
+        if drawing:
+            for row in reversed(range(size)):
+                self._print_line([None] * (size - row), [False] * (size - row))
+            self._print_names()
+        self.query_progressive(draw_cell if drawing else None)
+        return drawing
 
     def print_used(self, highlight: float):
         """
         Prints the pyramid of snapshots space occupied. Snapshots names are at the bottom. Sizes are on top.
         They are divided with vertical lines, showing some span, the size corresponds to.
+        Buckets of snapshots are shown instead of individual snapshots when snapshots are grouped.
         Each size tells how much space is wasted in a combination, substracting space wasted in its any component.
         :param float highlight: Biggest sizes that add up to the highlight fraction of total size
             will be highlighted.
         :return:
         """
-        hl = self._highlight_matrix(highlight)
-        for i in reversed(range(1, len(self.snapshot_names))):
-            self._print_line(self.snapshot_size_matrix[i][:-i], hl[i][:-i])
-        self._print_line(self.snapshot_size_matrix[0], hl[0])  # Last line falls out of general rule
-        self._print_names()
-
-    def get_destroy_recommendations(self, recommendations=2):
+        if self.snapshot_size_matrix is None:
+            if self._print_progressive():
+                print('\033[{}A'.format(len(self.columns) + 1), end='')  # The final pyramid goes over it
+        if self.estimated:
+            print('The pyramid is estimated from {} property values. A cell may be off by up to {}{}.'.format(
+                self.property_values, size2human(self.error_bound),
+                ', except {} cells confirmed with range queries'.format(len(self.exact_cells))
+                if self.exact_cells else '') + ' Use "--refine N" to confirm the N biggest cells.')
+        frame = self.render(highlight)
+        sys.stdout.write(frame)  # The whole frame at once, a write per cell is slow over a network
+        sys.stdout.flush()
+
+    def _range_snapshots(self, row, col):
+        """Returns names of the first and the last snapshot and the number of snapshots in a pyramid cell."""
+        first, last = self.columns[col][1], self.columns[col + row][2]
+        return self.snapshot_names[first], self.snapshot_names[last], last - first + 1
+
+    def get_destroy_candidates(self, recommendations=2):
+        """Finds snapshot ranges that free the most space per destroyed snapshot.
+
+        :return: A list of tuples (size freed, number of snapshots, first snapshot name, last snapshot name)
+        """
         # Normalize would free matrix to the number of snapshots to be removed
-        free_norm_matrix = [[elem/(index + 1) for elem in row] for index, row in enumerate(self.would_free_matrix)]
+        free_norm_matrix = [[elem / self._range_snapshots(index, j)[2] for j, elem in enumerate(row)]
+                            for index, row in enumerate(self.would_free_matrix)]
 
         # Now sort the candidates in descending order
         flatten_sizes = [j for sub in free_norm_matrix for j in sub]
         flatten_sizes.sort(reverse=True)
 
         # Find the threshold for normalize values to neglect if equal or less
-        threshold = flatten_sizes[recommendations]
+        threshold = flatten_sizes[recommendations] if recommendations < len(flatten_sizes) else -1
 
         # Build recommendations knowing the threshold
-        answer = ''
+        candidates = list()
         for i, row in enumerate(free_norm_matrix):
             for j, _ in enumerate(row):
                 if free_norm_matrix[i][j] > threshold:
-                    answer += f'Removing {i+1} snapshot(s) will free {size2human(self.would_free_matrix[i][j])}. ' \
-                              f'Use "{self.zb.zfs_path} destroy ' \
-                              f'{self.dataset_name}@{self.snapshot_names[j]}%{self.snapshot_names[j+i]}"\n'
+                    first, last, count = self._range_snapshots(i, j)
+                    candidates.append((self.would_free_matrix.get(i, j), count, first, last))
+        return candidates
 
+    def get_destroy_recommendations(self, recommendations=2):
+        answer = ''
+        for size, count, first, last in self.get_destroy_candidates(recommendations):
+            answer += f'Removing {count} snapshot(s) will free {size2human(size)}. ' \
+                      f'Use "{self.zb.zfs_path} destroy {self.dataset_name}@{first}%{last}"\n'
         return answer
 
 
-def deep_analysis(zb: ZfsBridge, dataset_name, name, size):
+def scan_dataset(zb: ZfsBridge, dataset_name, path):
+    """Scans files of the dataset mounted at path, skipping mountpoints of its descendants.
+
+    :return: scanner.ScanResult
+    """
+    from .scanner import scan_filesystem
+    children = [name for name in zb.index.datasets if name.startswith(dataset_name + '/')]
+    with zb.profiler.phase('file scan'):
+        return scan_filesystem(path, zb.jobs, exclude=[zb.index.datasets[name]['mountpoint'] for name in children
+                                                       if zb.index.datasets[name]['mountpoint']])
+
+
+def attribute_snapshot_range(zb: ZfsBridge, dataset_name, snapshot_range, top=10):
+    """Finds the files holding space of a range of snapshots, like a pyramid cell.
+
+    Streams "zfs diff" between the last snapshot of the range and the next one, or the filesystem itself for
+    the newest snapshot, and reads the old versions of removed and modified files in .zfs/snapshot.
+    Files not modified since the snapshot before the range share their data with it and are skipped.
+    :param str snapshot_range: Snapshot names like "first%last" or a single snapshot name
+    :return: scanner.AttributionResult
+    """
+    from .scanner import parse_zfs_diff, attribute_changes
+    identities = zb.get_snapshot_identities(dataset_name)
+    names = [info.name for info in identities]
+    first, _, last = snapshot_range.partition('%')
+    last = last or first
+    for name in (first, last):
+        if name not in names:
+            raise ValueError('There is no snapshot "{}@{}" in the system.'.format(dataset_name, name))
+    start, end = names.index(first), names.index(last)
+    if start > end:
+        raise ValueError('Snapshot "{}" is newer than "{}".'.format(first, last))
+    mountpoint = zb.get_filesystem_mountpoint(dataset_name)
+    if not mountpoint or not os.path.isdir(mountpoint):
+        raise ValueError('Dataset "{}" is not mounted, its files cannot be read.'.format(dataset_name))
+    newer = '{}@{}'.format(dataset_name, names[end + 1]) if end + 1 < len(names) else dataset_name
+    lines = zb.transport.lines(['diff', '-H', '{}@{}'.format(dataset_name, last), newer])
+    with zb.profiler.phase('file attribution'):
+        return attribute_changes(parse_zfs_diff(lines), mountpoint,
+                                 os.path.join(mountpoint, '.zfs', 'snapshot', last), zb.jobs, top,
+                                 identities[start - 1].creation if start else None)
+
+
+def _print_attribution(zb: ZfsBridge, dataset_name, snapshot_range, top=10):
+    result = attribute_snapshot_range(zb, dataset_name, snapshot_range, top)
+    print('{} changed file(s) of {}@{} take {}{}. The biggest of them are in:'.format(
+        result.files, dataset_name, snapshot_range, size2human(result.total),
+        ' ({} files could not be read)'.format(result.errors) if result.errors else ''))
+    entries = result.top_entries()
+    if result.total:
+        DivBar().print_dict(entries[:top] + ([('other', sum(size for _, size in entries[top:]))]
+                                             if len(entries) > top else []))
+    print('The folders with the biggest changed files right in them are:')
+    for size, directory in result.heaviest_directories(top):
+        print(term_format['CYAN'] + '{:>9}'.format(size2human(size)) + term_format['END'] + ' ' + directory)
+    if result.modified:
+        print('Modified files are counted whole, but only their changed blocks are held. '
+              'They take at most {} of the total.'.format(size2human(result.modified)))
+    print('The biggest changed files are:')
+    for size, path, modified in result.largest_files():
+        print(term_format['CYAN'] + '{:>9}'.format(size2human(size)) + term_format['END'] + ' ' + path +
+              (' (modified, at most)' if modified else ''))
+
+
+def _print_scan(zb: ZfsBridge, dataset_name, path):
+    """Scans files of the dataset mounted at path and prints the heaviest of them."""
+    result = scan_dataset(zb, dataset_name, path)
+    print('Scanned {} files{}. The files and subfolders in {} take:'.format(
+        result.files, ' ({} folders could not be read)'.format(result.errors) if result.errors else '', path))
+    total = result.entries.total
+    if total:
+        shown, part_count = list(), 0
+        for name, size in result.top_entries():  # Show the most important entries according to filter level
+            shown.append((name, size))
+            part_count += size / total
+            if part_count > filter_level:
+                break
+        if sum(size for _, size in shown) < total:
+            shown.append(('other', total - sum(size for _, size in shown)))
+        DivBar().print_dict(shown)
+    print('The folders with the biggest files right in them are:')
+    for size, directory in result.heaviest_directories():
+        print(term_format['CYAN'] + '{:>9}'.format(size2human(size)) + term_format['END'] + ' ' + directory)
+
+
+def deep_analysis(zb: ZfsBridge, dataset_name, name, size, snapshot_args=None, scan=False, plan_args=None):
+    """Prints the analysis of a single part of the dataset space with advice how to free it.
+
+    :param dict snapshot_args: Keyword arguments for SnapshotSpace, like snapshot grouping options
+    :param bool scan: Scan files of the dataset instead of advising to run du
+    :param dict plan_args: Keyword arguments for planner.make_plan to plan snapshot deletions. None skips planning.
+    """
     global filter_level
 
     def hello_helper(section_name, size_bytes, text):
@@ -408,12 +1344,27 @@ def deep_analysis(zb: ZfsBridge, dataset_name, name, size):
     if name == 'USEDSNAP':
         hello_helper('Snapshots', size, 'This space consists of data unique for individual snapshots and data stored in'
                      ' snapshots combinations. Therefore we will use pyramid representation:')
-        ss = SnapshotSpace(dataset_name)
+        ss = SnapshotSpace(dataset_name, zb, **(snapshot_args or dict()))
+        if ss.bucketed:
+            print('{} snapshots are grouped into {} buckets. '.format(len(ss.snapshot_names), len(ss.columns)) +
+                  'Use "--drill N" to see the pyramid of the N-th bucket from the left, counting from 0.')
         ss.print_used(filter_level)
-        print(ss.get_destroy_recommendations(3))
+        print(ss.get_destroy_recommendations(3) +
+              'Use "--attribute FIRST%LAST" to find the files holding the space of a range of snapshots.')
+        if plan_args:
+            from .planner import make_plan
+            try:
+                planner, plan = make_plan(ss, **plan_args)
+                print(planner.describe(plan) if plan is not None else 'No set of snapshots satisfies the plan.')
+            except ValueError as err:
+                print(err)
 
     elif name == 'USEDDS':
-        path = zb.get_filesystem_mountpoint(dataset_name)
+        path = zb.get_filesystem_mountpoint(dataset_name) or ''
+        if scan and os.path.isdir(path):
+            hello_helper('Files in {}'.format(path), size, 'Scanning the filesystem without its children datasets.')
+            _print_scan(zb, dataset_name, path)
+            return
         if not path.endswith('/'):
             path = path + '/'
         hello_helper('Files in {}'.format(path), size,
@@ -422,7 +1373,8 @@ This will calculate the occupied space for each file and subfolder in your ZFS f
 excluding other filesystem mounts like network mounts and ZFS children filesystems.
 It will not exclude folders with mountpoints right in the {path}. \
 You will have to exclude them separately with du --exclude option. \
-Running as a regular user will skip some directories with "Permission denied" error.""")
+Running as a regular user will skip some directories with "Permission denied" error. \
+Or use "zfspace --scan" to do the same in parallel.""")
 
     elif name == 'USEDREFRESERV':
         refres = zb.get_filesystem_refreservation(dataset_name)
@@ -453,15 +1405,167 @@ Running as a regular user will skip some directories with "Permission denied" er
         raise ValueError('Unknown ZFS {} space user: {}'.format(dataset_name, name))
 
 
-def main():
-    parser = argparse.ArgumentParser(description='analyse space occupied by a ZFS filesystem.')
+def _make_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description='analyse space occupied by a ZFS filesystem.',
+                                     epilog='Run "zfspace history DATASET" to see how the recorded space grows, and '
+                                            '"zfspace fleet HOST..." to rank space users of many hosts at once. '
+                                            'Put "--" before a pool named history or fleet, like "zfspace -- fleet".')
     parser.add_argument('-V', '--version', action='version', version=__version__)
     parser.add_argument('-f', '--filter', type=float,
                         help='Threshold in range [0,1] to filter out all less significant parts on analysis.',
                         default=0.632)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of zfs queries to run in parallel. Defaults to the number of CPUs.')
+    parser.add_argument('-t', '--timeout', type=float, default=None,
+                        help='Seconds to wait for a single snapshot range query before giving up.')
+    parser.add_argument('-c', '--cache', action='store_true',
+                        help='Keep snapshot range results on disk, so reruns only query ranges of new snapshots.')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Directory for the --cache files. Defaults to $XDG_CACHE_HOME/zfspace.')
+    parser.add_argument('--transport', type=str, default='exec', choices=list(transports),
+                        help='How to run zfs: "shell" starts a shell per command, "exec" starts zfs directly and '
+                             '"coproc" pipes commands into --jobs long living shells.')
+    parser.add_argument('--zfs-path', type=str, default=ZfsBridge.zfs_path, help='Path to zfs executable.')
+    parser.add_argument('-b', '--buckets', type=int, default=None,
+                        help='Group snapshots into this number of buckets and build the pyramid over buckets.')
+    parser.add_argument('--bucket-by', type=str, default=None, choices=['count', 'name', *bucket_time_formats],
+                        help='Group consecutive snapshots by count (see --buckets), creation time or name.')
+    parser.add_argument('--bucket-pattern', type=str, default=None,
+                        help='Regular expression for --bucket-by name, like "hourly|daily|monthly".')
+    parser.add_argument('--drill', type=int, default=None,
+                        help='Show the pyramid of snapshots inside the bucket with this index, counting from 0.')
+    parser.add_argument('--prune', type=human2size, nargs='?', const=0, default=None,
+                        help='Skip queries of snapshot ranges inside ranges that hold no space, or no more than '
+                             'the given size like 100M. Ranges below the size are shown as 0.')
+    parser.add_argument('--estimate', action='store_true',
+                        help='Estimate the snapshot pyramid from written@ properties with two zfs calls instead of '
+                             'a dry-run per snapshot range. Shows the error bound of the cells.')
+    parser.add_argument('--refine', type=int, default=0, metavar='N',
+                        help='Confirm the N biggest cells of an --estimate pyramid with exact range queries.')
+    parser.add_argument('--plan-free', type=human2size, default=None,
+                        help='Find the fewest snapshots to destroy to free this much space, like 500G. '
+                             "Snapshots don't have to be consecutive.")
+    parser.add_argument('--plan-snapshots', type=int, default=None,
+                        help='Find the snapshots freeing the most space when destroying at most this many of them.')
+    parser.add_argument('--keep-per', type=str, default=None, choices=list(bucket_time_formats),
+                        help='Keep at least one snapshot per hour, day, week, month or year in --plan-* plans.')
+    parser.add_argument('--simulate', type=str, action='append', default=None, metavar='POLICY',
+                        help='Show the space a retention policy like "hourly=24,daily=7,weekly=4,monthly=12" '
+                             'would free. Repeat it to compare policies, add --recursive to check descendants too.')
+    parser.add_argument('--attribute', type=str, default=None, metavar='FIRST%LAST',
+                        help='Find the files holding the space of a range of snapshots, like a highlighted pyramid '
+                             'cell, with zfs diff. The dataset must be mounted.')
+    parser.add_argument('--summary', action='store_true',
+                        help='Only show how the used space of the dataset is divided. It takes a single zfs call, '
+                             'which suits shell prompts and health checks.')
+    parser.add_argument('--tui', action='store_true',
+                        help='Browse the snapshot pyramid and the children datasets in an interactive terminal view.')
+    parser.add_argument('-p', '--progressive', action='store_true',
+                        help='Draw the snapshot pyramid while it is queried, the shortest ranges first.')
+    parser.add_argument('-s', '--scan', action='store_true',
+                        help='Scan the files of the dataset in parallel when they take a significant space.')
+    parser.add_argument('-r', '--recursive', action='store_true',
+                        help='Analyze the dataset with all its descendants and rank where the space goes.')
+    parser.add_argument('--top', type=int, default=10,
+                        help='The number of the heaviest datasets to analyze with --recursive, '
+                             'or of folders and files to show with --attribute.')
+    parser.add_argument('--format', type=str, default='text', choices=['text', 'json', 'ndjson'],
+                        help='Print the analysis as text, as a JSON document or as JSON lines streamed while '
+                             'it goes, one line per summary, pyramid cell, recommendation and so on.')
+    parser.add_argument('--textfile', type=str, default=None,
+                        help='Keep running and write Prometheus metrics of the dataset to this file for the node '
+                             'exporter textfile collector. Add --recursive to export its descendants too and '
+                             '--cache to query only the changed snapshot ranges.')
+    parser.add_argument('--listen', type=str, default=None,
+                        help='Keep running and serve Prometheus metrics on [host:]port/metrics, localhost by default.')
+    parser.add_argument('--interval', type=float, default=300,
+                        help='Seconds between metric refreshes for --textfile and --listen.')
+    parser.add_argument('--query-budget', type=int, default=2000,
+                        help='Maximum range queries per refresh. Changed pyramids over it wait for the next one.')
+    parser.add_argument('--once', action='store_true', help='Refresh --textfile once and exit, to run from cron.')
+    parser.add_argument('--record', action='store_true',
+                        help='Record the space of the dataset, its descendants and the queried snapshot pyramids '
+                             'in the history. See "zfspace history -h".')
+    parser.add_argument('--history-db', type=str, default=None,
+                        help='The history database for --record. Defaults to ~/.local/share/zfspace/history.sqlite.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print zfs command latencies and time spent in every analysis phase to stderr.')
+    parser.add_argument('--profile-json', type=str, default=None,
+                        help='Write every zfs command and phase timing to this file as JSON.')
     parser.add_argument('dataset_name', type=str, help='a ZFS dataset name for analysis.')
+    return parser
+
+
+def _make_bridge(args, index=True):
+    cache = RangeSpaceCache(args.cache_dir) if args.cache or args.cache_dir else None
+    if args.transport == 'coproc':
+        transport = CoprocessTransport(args.zfs_path, processes=args.jobs or os.cpu_count() or 1)
+    else:
+        transport = transports[args.transport](args.zfs_path)
+    profiler = instrument.Profiler() if args.profile or args.profile_json else None
+    history = None
+    if args.record:
+        from .history import HistoryStore
+        history = HistoryStore(args.history_db)
+    return ZfsBridge(jobs=args.jobs, timeout=args.timeout, cache=cache, transport=transport, profiler=profiler,
+                     history=history, index=index)
+
 
-    args = parser.parse_args()
+def _parse_summary_args(argv):
+    """Reads the arguments of a plain --summary run without building the argparse parser.
+    Only --summary, --format, --transport, --zfs-path and the dataset name are understood.
+
+    :return: The arguments like parse_args returns them, or None if argparse is needed to read or reject argv
+    """
+    import types
+    args = types.SimpleNamespace(summary=False, format='text', transport='exec', zfs_path=ZfsBridge.zfs_path,
+                                 dataset_name=None, filter=0.632, jobs=None, timeout=None, cache=False,
+                                 cache_dir=None, record=False, history_db=None, profile=False, profile_json=None)
+    options = dict(format=['text', 'json', 'ndjson'], transport=list(transports), zfs_path=None)
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        name, separator, value = arg[2:].partition('=') if arg.startswith('--') else ('', '', '')
+        name = name.replace('-', '_')
+        if arg == '--summary':
+            args.summary = True
+        elif name in options and (separator or argv):
+            value = value if separator else argv.pop(0)
+            if options[name] is not None and value not in options[name]:
+                return None
+            setattr(args, name, value)
+        elif not arg.startswith('-') and args.dataset_name is None:
+            args.dataset_name = arg
+        else:
+            return None
+    return args if args.summary and args.dataset_name else None
+
+
+def _parse_args(argv):
+    """Returns the arguments of the command line. A plain --summary is read without argparse."""
+    args = _parse_summary_args(argv)
+    if args is not None:
+        return args
+    parser = _make_parser()
+    args = parser.parse_args(argv)
+    if (args.plan_free is not None or args.plan_snapshots is not None) and args.prune:
+        parser.error('--plan-free and --plan-snapshots need the sizes of all snapshot ranges, '
+                     "so they can't be used with --prune.")
+    return args
+
+
+def main():
+    # A pool named like a subcommand is analysed with "--" in front of it, which argparse skips
+    if sys.argv[1:2] == ['history']:
+        from .history import history_main
+        history_main(sys.argv[2:])
+        return
+    if sys.argv[1:2] == ['fleet']:
+        from .fleet import fleet_main
+        fleet_main(sys.argv[2:])
+        return
+    args = _parse_args(sys.argv[1:])
     if args.filter > 1 or args.filter < 0:
         raise ValueError('The filter cannot be out of [0,1] range.')
     global filter_level
@@ -470,11 +1574,121 @@ def main():
     # Initializing ZFS helper class
     zb = None  # Fix warnings about possible usage before initialization
     try:
-        zb = ZfsBridge()
+        zb = _make_bridge(args, index=not args.summary)
     except Exception as err:
         print(err)
         exit()
 
+    if args.summary:
+        try:
+            _print_summary(zb, args)
+        except ValueError as err:
+            print(err)
+            sys.exit(1)
+        finally:
+            if args.profile:
+                zb.profiler.print_summary()
+            if args.profile_json:
+                zb.profiler.dump(args.profile_json)
+        return
+
+    snapshot_args = dict(bucket_by=args.bucket_by or ('count' if args.buckets else None), buckets=args.buckets,
+                         pattern=args.bucket_pattern, drill=args.drill, prune=args.prune,
+                         progressive=args.progressive, estimate=args.estimate, refine=args.refine)
+    plan_args = None
+    if args.plan_free is not None or args.plan_snapshots is not None:
+        plan_args = dict(target=args.plan_free, max_snapshots=args.plan_snapshots, keep=args.keep_per)
+    try:
+        _analyze(zb, args, snapshot_args, plan_args)
+        if zb.history is not None:
+            zb.history.record(zb, args.dataset_name)
+    finally:
+        if args.profile:
+            zb.profiler.print_summary()
+        if args.profile_json:
+            zb.profiler.dump(args.profile_json)
+
+
+def _print_summary(zb: ZfsBridge, args):
+    """Prints the used space breakdown of the dataset, the start of the full analysis."""
+    summary = zb.get_dataset_summary(args.dataset_name)
+    if args.format != 'text':
+        from .output import formats, space_dict
+        output = formats[args.format]()
+        output.emit(dict(type='summary', dataset=args.dataset_name, space=space_dict(summary)))
+        output.close()
+        return
+    dv = DivBar()
+    print(term_format['WHITEBOLD'] + args.dataset_name + term_format['END'] + ' uses ' + term_format['CYAN'] +
+          size2human(summary[2][1]) + term_format['END'] + ':')
+    dv.print_dict(summary[3:])
+
+
+def _report_attribution(zb: ZfsBridge, args):
+    if args.format == 'text':
+        _print_attribution(zb, args.dataset_name, args.attribute, args.top)
+        return
+    from .output import formats
+    result = attribute_snapshot_range(zb, args.dataset_name, args.attribute, args.top)
+    output = formats[args.format]()
+    output.emit(dict(type='attribution', dataset=args.dataset_name, range=args.attribute,
+                     files=result.files, changes=result.changes, errors=result.errors, size=result.total,
+                     modified=result.modified,
+                     entries=dict(result.top_entries()),
+                     directories=[dict(size=size, path=path) for size, path in result.heaviest_directories(args.top)],
+                     largest=[dict(size=size, path=path, modified=modified)
+                              for size, path, modified in result.largest_files()]))
+    output.close()
+
+
+def _analyze(zb: ZfsBridge, args, snapshot_args, plan_args=None):
+    if args.simulate:
+        from .retention import RetentionPolicy, simulate, print_simulation
+        policies = [RetentionPolicy(text) for text in args.simulate]
+        zb._check_dataset_name(args.dataset_name)
+        datasets = [name for name in zb.index.datasets if zb.index.snapshots.get(name) and (
+            name == args.dataset_name or args.recursive and name.startswith(args.dataset_name + '/'))]
+        results = simulate(zb, datasets, policies, snapshot_args)
+        if args.format == 'text':
+            print_simulation(results)
+        else:
+            from .output import formats
+            output = formats[args.format]()
+            for result in results:
+                output.emit(dict(result._asdict(), type='retention'))
+            output.close()
+        return
+
+    if args.tui:
+        from .tui import browse
+        browse(zb, args.dataset_name, snapshot_args, filter_level)
+        return
+
+    if args.attribute:
+        _report_attribution(zb, args)
+        return
+
+    if args.textfile or args.listen:
+        from .exporter import Exporter, run_exporter
+        exporter = Exporter(zb, args.dataset_name, args.recursive, snapshot_args, args.query_budget)
+        run_exporter(exporter, args.interval, args.textfile, args.listen, args.once)
+        return
+
+    if args.format != 'text':
+        from .output import formats, emit_analysis, emit_pool_report
+        output = formats[args.format]()
+        if args.recursive:
+            emit_pool_report(zb, args.dataset_name, output, filter_level, args.top, snapshot_args)
+        else:
+            emit_analysis(zb, args.dataset_name, output, filter_level, snapshot_args, args.scan, plan_args)
+        output.close()
+        return
+
+    if args.recursive:
+        from .pool import print_pool_report
+        print_pool_report(zb, args.dataset_name, filter_level, args.top, snapshot_args)
+        return
+
     # Starting with dataset analysis
     summary = zb.get_dataset_summary(args.dataset_name)
 
@@ -493,7 +1707,9 @@ def main():
         part_count += item[1] / summary[2][1]  # Normalized sum
         try:
             dv.print_hr()
-            deep_analysis(zb, args.dataset_name, *item)  # Analyze each part individually
+            # Analyze each part individually
+            deep_analysis(zb, args.dataset_name, *item, snapshot_args=snapshot_args, scan=args.scan,
+                          plan_args=plan_args)
         except Exception as err:
             print(err)
             raise
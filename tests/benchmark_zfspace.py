@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+""" Benchmarks of the snapshot space pipeline on a fake pool made by fake_zfs.py. Root and ZFS are not needed.
+
+Every step is measured for wall time, the number of zfs processes started and the peak memory allocated by python.
+Run it from the project directory:
+python3 tests/benchmark_zfspace.py --sizes 10 30 100 --latency 0.01
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from src.zfspace import zfspace  # noqa: E402
+from src.zfspace.zfspace import ZfsBridge, SnapshotSpace, CoprocessTransport, transports  # noqa: E402
+
+fake_zfs = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_zfs.py')
+dataset_name = 'pool/data'
+
+
+def measure(calls_file, function, *args, **kwargs):
+    """Runs function and returns a tuple of its result, wall time in seconds, zfs calls and peak memory in bytes."""
+    open(calls_file, 'w').close()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    with open(calls_file) as f:
+        calls = sum(1 for _ in f)
+    return result, elapsed, calls, peak
+
+
+def make_bridge(transport, jobs):
+    if transport == 'coproc':
+        return ZfsBridge(jobs=jobs, transport=CoprocessTransport(fake_zfs, processes=jobs))
+    return ZfsBridge(jobs=jobs, transport=transports[transport](fake_zfs))
+
+
+def run_main(transport, jobs):
+    argv = sys.argv
+    sys.argv = ['zfspace', '--zfs-path', fake_zfs, '--transport', transport, '--jobs', str(jobs), dataset_name]
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            zfspace.main()
+    finally:
+        sys.argv = argv
+
+
+def benchmark(size, transport, jobs, max_exact, calls_file):
+    """Yields (step name, wall time, zfs calls, peak memory) for a pool with a dataset of size snapshots."""
+    zb, *stats = measure(calls_file, make_bridge, transport, jobs)
+    yield ('index',) + tuple(stats)
+    try:
+        if size <= max_exact:
+            snapshots = zb.get_snapshot_names(dataset_name)
+            _, *stats = measure(calls_file, zb.get_snapshots_space, dataset_name, snapshots)
+            yield ('get_snapshots_space',) + tuple(stats)
+        _, *stats = measure(calls_file, SnapshotSpace, dataset_name, zb)
+        yield ('SnapshotSpace',) + tuple(stats)
+    finally:
+        zb.transport.close()
+    _, *stats = measure(calls_file, run_main, transport, jobs)
+    yield ('main',) + tuple(stats)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks zfspace against a fake zfs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 30, 100, 1000],
+                        help='Numbers of snapshots in the benchmarked dataset.')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds every fake zfs call takes.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='Parallel zfs queries.')
+    parser.add_argument('--transport', nargs='+', choices=sorted(transports), default=['exec'],
+                        help='Transports to benchmark.')
+    parser.add_argument('--max-exact', type=int, default=100,
+                        help='The full pyramid of get_snapshots_space is calculated only up to this many snapshots.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the fake pool generator.')
+    parser.add_argument('--json', type=str, help='Write results to this file as JSON to compare runs later.')
+    args = parser.parse_args()
+
+    results = list()
+    print('{:>6} {:>8} {:<20} {:>10} {:>10} {:>12}'.format('N', 'TRANS', 'STEP', 'SECONDS', 'ZFS CALLS', 'PEAK KiB'))
+    with tempfile.TemporaryDirectory() as directory:
+        calls_file = os.path.join(directory, 'calls')
+        os.environ['FAKE_ZFS_CALLS'] = calls_file
+        os.environ['FAKE_ZFS_LATENCY'] = str(args.latency)
+        for size in args.sizes:
+            state_file = os.path.join(directory, 'state-{}.json'.format(size))
+            with open(state_file, 'w') as f:
+                subprocess.check_call([sys.executable, fake_zfs, '--generate', str(size), '--seed', str(args.seed)],
+                                      stdout=f)
+            os.environ['FAKE_ZFS_STATE'] = state_file
+            for transport in args.transport:
+                for step, elapsed, calls, peak in benchmark(size, transport, args.jobs, args.max_exact, calls_file):
+                    print('{:>6} {:>8} {:<20} {:>10.3f} {:>10} {:>12}'.format(
+                        size, transport, step, elapsed, calls, peak // 1024))
+                    results.append(dict(snapshots=size, transport=transport, step=step, seconds=elapsed,
+                                        zfs_calls=calls, peak_memory=peak))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(latency=args.latency, jobs=args.jobs, results=results), f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+""" A stand-in for zfs executable to test and benchmark zfspace without root and without a pool.
+
+Usage: fake_zfs.py --generate SNAPSHOTS [--seed SEED] > state.json
+       FAKE_ZFS_STATE=state.json fake_zfs.py list|get|destroy ...
+
+The get command knows written and written@snapshot besides the space properties.
+
+Snapshots of every dataset are modelled as sets of blocks. A block is born in some snapshot and is referenced
+by every later snapshot until the one it was freed in. A block that is still alive is referenced by the dataset
+itself. All space properties and the results of "destroy -nvp" dry-runs are calculated from the blocks.
+
+Environment variables:
+FAKE_ZFS_STATE - path to the JSON state made with --generate
+FAKE_ZFS_LATENCY - seconds to sleep in every call, to look like a busy pool
+FAKE_ZFS_CALLS - a file to append the subcommand name of every call to, to count calls
+"""
+
+import os
+import sys
+import json
+import time
+import random
+
+space_columns = ['name', 'avail', 'used', 'usedsnap', 'usedds', 'usedrefreserv', 'usedchild']
+aliases = dict(avail='available', usedsnap='usedbysnapshots', usedds='usedbydataset',
+               usedrefreserv='usedbyrefreservation', usedchild='usedbychildren')
+
+
+def generate(snapshots, seed=0):
+    """Makes a pool with a dataset of the given number of snapshots, its child and a volume with refreservation."""
+    rnd = random.Random(seed)
+    state = dict(datasets=dict(), snapshots=dict(), blocks=dict())
+    txg = [100]
+
+    def add_dataset(name, snapshot_count, blocks_per_snapshot, refreservation=0, volume=False):
+        txg[0] += 1
+        state['datasets'][name] = dict(guid=rnd.getrandbits(63), createtxg=txg[0], creation=1_600_000_000 + txg[0],
+                                       refreservation=refreservation, type='volume' if volume else 'filesystem',
+                                       mountpoint='-' if volume else '/' + name)
+        snaps, blocks = list(), list()
+        for i in range(snapshot_count):
+            txg[0] += 1
+            snaps.append(dict(name='auto-{:05d}'.format(i), guid=rnd.getrandbits(63), createtxg=txg[0],
+                              creation=1_600_000_000 + i * 3600))
+            for _ in range(blocks_per_snapshot):
+                life = int(rnd.expovariate(0.3))  # Most blocks live in a few snapshots
+                blocks.append([i, min(i + life, snapshot_count), rnd.randrange(1, 64) * 131072])
+        blocks.append([0, snapshot_count, 64 * 1048576])  # Data that never changed
+        state['snapshots'][name] = snaps
+        state['blocks'][name] = blocks
+
+    add_dataset('pool', 0, 0)
+    add_dataset('pool/data', snapshots, 3)
+    add_dataset('pool/data/child', 3, 2)
+    add_dataset('pool/vol', 0, 0, refreservation=256 * 1048576, volume=True)
+    return state
+
+
+class FakePool:
+    def __init__(self, state):
+        self.state = state
+
+    def snapshot_count(self, dataset):
+        return len(self.state['snapshots'].get(dataset, []))
+
+    def blocks(self, dataset):
+        return self.state['blocks'].get(dataset, [])
+
+    def children(self, dataset):
+        return [name for name in self.state['datasets'] if name.rsplit('/', 1)[0] == dataset and name != dataset]
+
+    def dataset_props(self, name):
+        n = self.snapshot_count(name)
+        props = dict(self.state['datasets'][name], name=name)
+        props['usedbydataset'] = sum(size for first, last, size in self.blocks(name) if last == n)
+        props['usedbysnapshots'] = sum(size for first, last, size in self.blocks(name) if last < n)
+        props['usedbyrefreservation'] = max(0, props['refreservation'] - props['usedbydataset'])
+        props['usedbychildren'] = sum(self.dataset_props(child)['used'] for child in self.children(name))
+        props['used'] = props['usedbydataset'] + props['usedbysnapshots'] + props['usedbyrefreservation'] + \
+            props['usedbychildren']
+        props['referenced'] = props['usedbydataset']
+        props['available'] = 1 << 40
+        return props
+
+    def snapshot_props(self, dataset, index):
+        info = self.state['snapshots'][dataset][index]
+        blocks = self.blocks(dataset)
+        return dict(info, name='{}@{}'.format(dataset, info['name']), type='snapshot',
+                    used=sum(size for first, last, size in blocks if first == last == index),
+                    referenced=sum(size for first, last, size in blocks if first <= index <= last),
+                    mountpoint=None, refreservation=None, available=None, usedbysnapshots=None,
+                    usedbydataset=None, usedbyrefreservation=None, usedbychildren=None)
+
+    def props(self, name):
+        if '@' in name:
+            dataset, snapshot = name.split('@')
+            names = [info['name'] for info in self.state['snapshots'].get(dataset, [])]
+            if snapshot not in names:
+                raise KeyError(name)
+            return self.snapshot_props(dataset, names.index(snapshot))
+        if name not in self.state['datasets']:
+            raise KeyError(name)
+        return self.dataset_props(name)
+
+    def written(self, name, since=None):
+        """Space referenced by a snapshot or a dataset and born after the snapshot named since, like written@since.
+        Without since it is the space born after the previous snapshot, like written. None if since is not older."""
+        dataset, _, snapshot = name.partition('@')
+        names = [info['name'] for info in self.state['snapshots'].get(dataset, [])]
+        index = names.index(snapshot) if snapshot else len(names)
+        if since is None:
+            start = index - 1
+        elif since not in names or names.index(since) >= index:
+            return None
+        else:
+            start = names.index(since)
+        return sum(size for first, last, size in self.blocks(dataset) if start < first <= index <= last)
+
+    def object_type(self, name):
+        return 'snapshot' if '@' in name else self.state['datasets'][name]['type']
+
+    def all_objects(self):
+        for name in self.state['datasets']:
+            yield name
+            for info in self.state['snapshots'].get(name, []):
+                yield '{}@{}'.format(name, info['name'])
+
+    def destroy_set(self, dataset, spec):
+        """Returns indexes of snapshots in a destroy specification like a%b,c"""
+        names = [info['name'] for info in self.state['snapshots'][dataset]]
+        indexes = set()
+        for part in spec.split(','):
+            first, _, last = part.partition('%')
+            start = names.index(first) if first else 0
+            end = names.index(last) if last else (start if '%' not in part else len(names) - 1)
+            indexes.update(range(start, end + 1))
+        return sorted(indexes)
+
+    def reclaim(self, dataset, indexes):
+        indexes = set(indexes)
+        return sum(size for first, last, size in self.blocks(dataset)
+                   if last < self.snapshot_count(dataset) and all(i in indexes for i in range(first, last + 1)))
+
+
+def parse_options(args, with_value):
+    """Splits zfs style arguments into a dict of options and a list of operands. Flags may be combined like -Hp."""
+    options, operands = dict(), list()
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('-') and len(arg) > 1:
+            for j, flag in enumerate(arg[1:]):
+                if flag in with_value:
+                    value = arg[j + 2:] or args[i + 1]
+                    i += 0 if arg[j + 2:] else 1
+                    options.setdefault(flag, []).append(value)
+                    break
+                options[flag] = True
+        else:
+            operands.append(arg)
+        i += 1
+    return options, operands
+
+
+def format_value(value, parsable):
+    if value is None:
+        return '-'
+    if isinstance(value, int) and not parsable and value >= 1024:
+        return '{:.1f}K'.format(value / 1024)
+    return str(value)
+
+
+def print_table(rows, columns, options):
+    if 'H' in options:
+        for row in rows:
+            print('\t'.join(row))
+    else:
+        widths = [max(len(str(value)) for value in column) for column in zip(columns, *rows)]
+        for row in [columns] + rows:
+            print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+def command_list(pool, args):
+    options, operands = parse_options(args, 'odtsS')
+    properties = ','.join(options.get('o', ['name,used,avail,refer,mountpoint'])).split(',')
+    if properties == ['space']:
+        properties = space_columns
+    types = ','.join(options.get('t', ['filesystem,volume'])).split(',')
+    if 'all' in types:
+        types = ['filesystem', 'volume', 'snapshot']
+    depth = int(options['d'][0]) if 'd' in options else (1 << 30 if 'r' in options or not operands else 0)
+    objects = list()
+    for name in pool.all_objects():
+        for root in operands or [name.split('/')[0].split('@')[0]]:
+            base = name.split('@')[0]
+            if base == root or base.startswith(root + '/'):
+                if base.count('/') - root.count('/') + ('@' in name) <= depth:
+                    objects.append(name)
+                break
+    for operand in operands:
+        try:
+            pool.props(operand)
+        except KeyError:
+            sys.stderr.write("cannot open '{}': dataset does not exist\n".format(operand))
+            return 1
+    rows = [pool.props(name) for name in objects]
+    rows = [row for row in rows if row['type'] in types]
+    for key, reverse in (('s', False), ('S', True)):
+        for prop in options.get(key, []):
+            rows.sort(key=lambda row: row[aliases.get(prop, prop)] or 0, reverse=reverse)
+    print_table([[format_value(row.get(aliases.get(prop, prop)), 'p' in options) for prop in properties]
+                 for row in rows], [prop.upper() for prop in properties], options)
+    return 0
+
+
+def command_get(pool, args):
+    options, operands = parse_options(args, 'odt')
+    fields = ','.join(options.get('o', ['name,property,value,source'])).split(',')
+    properties, targets = operands[0].split(','), operands[1:]
+    if 'r' in options or 'd' in options:
+        depth = int(options['d'][0]) if 'd' in options else 1 << 30
+        types = ','.join(options.get('t', ['all'])).split(',')
+        targets = [name for root in targets for name in pool.all_objects()
+                   if (name.split('@')[0] == root or name.startswith(root + '/')) and
+                   name.split('@')[0].count('/') - root.count('/') + ('@' in name) <= depth and
+                   ('all' in types or pool.object_type(name) in types)]
+    rows = list()
+    for target in targets:
+        try:
+            props = pool.props(target)
+        except KeyError:
+            sys.stderr.write("cannot open '{}': dataset does not exist\n".format(target))
+            return 1
+        for prop in properties:
+            if prop == 'written' or prop.startswith('written@'):
+                value = format_value(pool.written(target, prop.partition('@')[2] or None), 'p' in options)
+            else:
+                value = format_value(props.get(aliases.get(prop, prop)), 'p' in options)
+            row = dict(name=target, property=prop, value=value, source='-')
+            rows.append([row[field] for field in fields])
+    print_table(rows, [field.upper() for field in fields], options)
+    return 0
+
+
+def command_destroy(pool, args):
+    options, operands = parse_options(args, '')
+    dataset, spec = operands[0].split('@')
+    indexes = pool.destroy_set(dataset, spec)
+    if 'n' not in options:
+        sys.stderr.write('fake zfs does not destroy anything\n')
+        return 1
+    if 'v' in options:
+        for i in indexes:
+            print('{}\t{}@{}'.format('destroy' if 'p' in options else 'would destroy', dataset,
+                                     pool.state['snapshots'][dataset][i]['name']))
+    print('reclaim\t{}'.format(pool.reclaim(dataset, indexes)) if 'p' in options else
+          'would reclaim {}'.format(format_value(pool.reclaim(dataset, indexes), False)))
+    return 0
+
+
+def main(argv):
+    if argv[:1] == ['--generate']:
+        seed = int(argv[3]) if argv[2:3] == ['--seed'] else 0
+        json.dump(generate(int(argv[1]), seed), sys.stdout)
+        return 0
+    if os.environ.get('FAKE_ZFS_CALLS'):
+        with open(os.environ['FAKE_ZFS_CALLS'], 'a') as f:
+            f.write(argv[0] + '\n')
+    time.sleep(float(os.environ.get('FAKE_ZFS_LATENCY', 0)))
+    with open(os.environ['FAKE_ZFS_STATE']) as f:
+        pool = FakePool(json.load(f))
+    commands = dict(list=command_list, get=command_get, destroy=command_destroy)
+    if not argv or argv[0] not in commands:
+        sys.stderr.write('fake zfs supports {} commands only\n'.format(', '.join(commands)))
+        return 2
+    return commands[argv[0]](pool, argv[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
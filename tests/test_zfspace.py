@@ -1,11 +1,95 @@
-from unittest import TestCase
+from unittest import TestCase, skipIf
 import os
-from src.zfspace.zfspace import size2human, shorten_names
+import sys
+import io
+import json
+import time
+import tempfile
+import subprocess
+import contextlib
+import urllib.error
+import urllib.request
+from src.zfspace.zfspace import size2human, human2size, shorten_names, ZfsBridge, RangeSpaceCache, SnapshotInfo, \
+    group_snapshots, PoolIndex, SnapshotSpace, _print_scan, ShellTransport, ExecTransport, CoprocessTransport, \
+    _parse_summary_args, _parse_args, _make_parser, TriangularMatrix
+from src.zfspace import zfspace as zfspace_module
+from src.zfspace.pool import heaviest_datasets, pool_report
+from src.zfspace.scanner import scan_filesystem, parse_zfs_diff, attribute_changes, TopSizes, _Walk
+from src.zfspace.instrument import Profiler
+from src.zfspace.output import JsonOutput, NdjsonOutput, emit_analysis
+from src.zfspace.exporter import Exporter, serve_metrics, run_exporter
+from src.zfspace.planner import DeletionPlanner
+from src.zfspace.retention import RetentionPolicy, RetentionSimulator, simulate
+from src.zfspace.tui import Browser, PyramidView, curses
+from src.zfspace.history import HistoryStore
+from src.zfspace.fleet import SshTransport, make_transport, analyze_fleet, fleet_report
 
 
 os.chdir(os.path.dirname(__file__) + '/..')
 
 
+class ModelTransport(ExecTransport):
+    """Stands in for /sbin/zfs, which BlockModelBridge answers instead of running it."""
+    def check(self):
+        pass
+
+
+class BlockModelBridge(ZfsBridge):
+    """ZfsBridge answering range queries from a list of blocks instead of a real pool.
+    Each block is a tuple (first snapshot index, last snapshot index, size) of snapshots referencing it.
+    """
+    def __init__(self, snapshots, blocks, jobs=4, cache=None):
+        self.snapshots = snapshots
+        self.blocks = blocks
+        self.queries = 0
+        lines = ['pool\tfilesystem\t100\t60\t0\t10\t0\t50\t/pool\t0\t1\t1\t1\n',
+                 'pool/ds\tfilesystem\t100\t50\t40\t10\t0\t0\t/pool/ds\t0\t2\t2\t2\n']
+        for index, name in enumerate(snapshots):
+            lines.append('pool/ds@{}\tsnapshot\t-\t0\t-\t-\t-\t-\t-\t-\t{}\t{}\t{}\n'.format(
+                name, 1000 + index, 10 + index, 1_600_000_000 + index))
+        super().__init__(jobs=jobs, cache=cache, transport=ModelTransport(), index=PoolIndex(lines))
+
+    def refresh(self):
+        pass  # The index is made in __init__
+
+    def _run(self, *args, timeout=None):
+        """Answers "destroy -nvp dataset@a%b,c" dry-runs."""
+        self.queries += 1
+        indexes = set()
+        for part in args[2].split('@')[1].split(','):
+            first, _, last = part.partition('%')
+            indexes.update(range(self.snapshots.index(first), self.snapshots.index(last or first) + 1))
+        freed = sum(size for start, end, size in self.blocks if indexes.issuperset(range(start, end + 1)))
+        return 'destroy\t{}\nreclaim\t{}\n'.format(args[2], freed)
+
+    def _get_snapshot_range_space(self, dataset, first_snap, last_snap):
+        self.queries += 1
+        first, last = self.snapshots.index(first_snap), self.snapshots.index(last_snap)
+        return str(sum(size for start, end, size in self.blocks if first <= start and end <= last))
+
+
+FAKE_ZFS = 'tests/fake_zfs.py'
+
+
+def make_fake_state(directory, snapshots, seed, name='state'):
+    """Writes a random pool of tests/fake_zfs.py with the given number of snapshots, returns the path of the file."""
+    state_file = os.path.join(directory, name + '.json')
+    with open(state_file, 'w') as f:
+        subprocess.check_call([sys.executable, FAKE_ZFS, '--generate', str(snapshots), '--seed', str(seed)], stdout=f)
+    return state_file
+
+
+@contextlib.contextmanager
+def fake_zfs(snapshots, seed):
+    """Points tests/fake_zfs.py at a random pool in a temporary directory, yields the path of the state file."""
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ['FAKE_ZFS_STATE'] = make_fake_state(directory, snapshots, seed)
+        try:
+            yield os.environ['FAKE_ZFS_STATE']
+        finally:
+            del os.environ['FAKE_ZFS_STATE']
+
+
 class TestZfspace(TestCase):
     def test_size2human(self):
         self.assertTrue(size2human(123) == '123 B')
@@ -33,9 +117,682 @@ class TestZfspace(TestCase):
         self.assertTrue(size2human(1_150_000_000_000_000_000, fmt='short') == '1021P')
         self.assertTrue(size2human(2_000_000_000_000_000_000_000, fmt='short') == '2Z')
 
+    def test_human2size(self):
+        self.assertEqual(human2size('123'), 123)
+        self.assertEqual(human2size('1k'), 1024)
+        self.assertEqual(human2size('1.5 GiB'), 1_610_612_736)
+        self.assertEqual(human2size('2T'), 2 * 1024 ** 4)
+        self.assertEqual(human2size(size2human(1021 * 1024 ** 5)), 1021 * 1024 ** 5)
+        with self.assertRaises(ValueError):
+            human2size('lots')
+
     def test_shorten_names(self):
         names = ['zfs_1', 'zfs_2', 'zfs_backup']
         shortn = shorten_names(names, [5, 4, 9])
         self.assertTrue(shortn[0] == 'zfs_1')
         self.assertTrue(shortn[1] == '...2')
         self.assertTrue(shortn[2] == '...backup')
+
+    def test_get_snapshots_space(self):
+        snapshots = ['s0', 's1', 's2', 's3', 's4']
+        blocks = [(0, 0, 10), (0, 2, 7), (1, 3, 5), (2, 2, 3), (3, 4, 11), (1, 1, 2), (0, 4, 13), (4, 4, 1)]
+        zb = BlockModelBridge(snapshots, blocks)
+        used, would_free = zb.get_snapshots_space('pool/ds', snapshots)
+        self.assertEqual(zb.queries, 15)
+        for row in range(len(snapshots)):
+            for col in range(len(snapshots) - row):
+                exclusive = sum(size for start, end, size in blocks if start == col and end == col + row)
+                freed = sum(size for start, end, size in blocks if col <= start and end <= col + row)
+                self.assertEqual(used[row][col], exclusive)
+                self.assertEqual(would_free[row][col], freed)
+
+    def test_range_space_cache(self):
+        snapshots = ['s0', 's1', 's2', 's3', 's4']
+        blocks = [(0, 0, 10), (0, 2, 7), (1, 3, 5), (2, 2, 3), (3, 4, 11), (1, 1, 2), (0, 4, 13), (4, 4, 1)]
+        with tempfile.TemporaryDirectory() as directory:
+            zb = BlockModelBridge(snapshots, blocks, cache=RangeSpaceCache(directory))
+            _, expected = zb.get_snapshots_space('pool/ds', snapshots)
+            self.assertEqual(zb.queries, 15)
+
+            # A rerun only asks for ranges ending at the newest snapshot
+            zb = BlockModelBridge(snapshots, blocks, cache=RangeSpaceCache(directory))
+            _, would_free = zb.get_snapshots_space('pool/ds', snapshots)
+            self.assertEqual(zb.queries, 5)
+            self.assertEqual(would_free, expected)
+
+            # A new snapshot makes ranges ending at the previous newest snapshot stale too
+            blocks.append((4, 5, 17))
+            zb = BlockModelBridge(snapshots + ['s5'], blocks, cache=RangeSpaceCache(directory))
+            _, would_free = zb.get_snapshots_space('pool/ds', snapshots + ['s5'])
+            self.assertEqual(zb.queries, 11)
+            self.assertEqual(would_free[3][1], 5 + 3 + 11 + 1 + 2)
+
+    def test_exclusive(self):
+        def brute_force(would_free):
+            # Subtract the exclusive space of every subrange, row by row like the original substract_children
+            used = [list(row) for row in would_free]
+            for i in range(1, len(used)):
+                for j in range(len(used) - i):
+                    used[i][j] -= sum(used[x][y] for x in range(i) for y in range(j, j + i - x + 1))
+            return used
+
+        blocks = [(0, 0, 10), (0, 2, 7), (1, 3, 5), (2, 2, 3), (3, 4, 11), (1, 1, 2), (0, 4, 13), (4, 4, -1)]
+        numpy_module = zfspace_module._numpy()
+        for size in range(1, 6):
+            would_free = TriangularMatrix(size)
+            for row in range(size):
+                for col in range(size - row):
+                    would_free.set(row, col, sum(block for first, last, block in blocks
+                                                 if col <= first and last <= col + row))
+            expected = brute_force(would_free)
+            zfspace_module.numpy = False  # The pure Python path
+            try:
+                self.assertEqual(list(would_free.exclusive()), expected)
+            finally:
+                zfspace_module.numpy = numpy_module
+            self.assertEqual([[would_free.exclusive_at(row, col) for col in range(size - row)] for row in range(size)],
+                             expected)
+            if numpy_module is not None:
+                self.assertEqual(list(would_free.exclusive()), expected)
+
+    @skipIf(zfspace_module._numpy() is None, 'numpy is not installed')
+    def test_exclusive_numpy(self):
+        would_free = TriangularMatrix(3)
+        for (row, col), size in {(0, 0): 5, (0, 1): 2, (0, 2): 4, (1, 0): 9, (1, 1): 8, (2, 0): 20}.items():
+            would_free.set(row, col, size)
+        out = TriangularMatrix(3)
+        would_free._exclusive_numpy(out)
+        self.assertEqual(list(out), [[5, 2, 4], [2, 2], [20 - 9 - 8 + 2]])
+
+    def test_group_snapshots(self):
+        names = ['hourly-1', 'hourly-2', 'daily-1', 'daily-2', 'daily-3', 'hourly-3', 'monthly-1']
+        identities = [SnapshotInfo(name, str(i), i, 1_600_000_000 + i * 86400) for i, name in enumerate(names)]
+        self.assertEqual([(first, last) for _, first, last in group_snapshots(identities, 'count', 3)],
+                         [(0, 1), (2, 4), (5, 6)])
+        self.assertEqual(len(group_snapshots(identities, 'count', 100)), len(names))
+        self.assertEqual(len(group_snapshots(identities, 'day')), len(names))
+        by_name = group_snapshots(identities, 'name', pattern='^([a-z]+)-')
+        self.assertEqual([label for label, _, _ in by_name], ['hourly (2)', 'daily (3)', 'hourly (1)', 'monthly (1)'])
+        self.assertEqual([(first, last) for _, first, last in by_name], [(0, 1), (2, 4), (5, 5), (6, 6)])
+        self.assertEqual(group_snapshots([], 'count', 3), [])
+        many = ['snap-{:02}'.format(i) for i in range(40)]
+        ss = SnapshotSpace('pool/ds', BlockModelBridge(many, [(i, i, 1) for i in range(40)]), bucket_by='name',
+                           pattern='.*', buckets=8)
+        self.assertEqual(len(ss.columns), 8)  # 40 name buckets are too many to show, equal ones are used instead
+
+        # The pyramid over buckets queries bucket boundaries only
+        blocks = [(0, 0, 10), (0, 2, 7), (1, 3, 5), (2, 2, 3), (3, 4, 11), (1, 1, 2), (0, 6, 13), (6, 6, 1)]
+        zb = BlockModelBridge(names, blocks)
+        used, would_free = zb.get_snapshots_space('pool/ds', names, [(first, last) for _, first, last in by_name])
+        self.assertEqual(zb.queries, 10)
+        self.assertEqual(would_free[0], [12, 3 + 11, 0, 1])
+        self.assertEqual(used[1], [7 + 5, 0, 0])
+        self.assertEqual(would_free[3][0], sum(size for _, _, size in blocks))
+
+    def test_pruned_snapshots_space(self):
+        snapshots = ['s{}'.format(i) for i in range(20)]
+        blocks = [(0, 0, 10), (0, 2, 7), (1, 3, 5), (2, 2, 3), (1, 1, 11), (3, 3, 1)]
+        zb = BlockModelBridge(snapshots, blocks)
+        expected = zb.get_snapshots_space('pool/ds', snapshots)
+        zb = BlockModelBridge(snapshots, blocks)
+        self.assertEqual(zb.get_snapshots_space('pool/ds', snapshots, prune=0), expected)
+        self.assertLess(zb.queries, 210 / 2)
+
+        # Queried ranges keep their size, ranges inside the ones of the threshold or less are shown as 0
+        used, would_free = BlockModelBridge(snapshots, blocks).get_snapshots_space('pool/ds', snapshots, prune=10)
+        self.assertEqual(would_free[0][:3], [10, 11, 0])
+        self.assertEqual(would_free[2][0], 20 + 11)
+        self.assertEqual(used[2][0], 7)
+        self.assertTrue(all(size >= 0 for row in used for size in row))
+
+        # Ranges below the threshold don't make their neighbours negative
+        snapshots = ['s0', 's1', 's2']
+        zb = BlockModelBridge(snapshots, [(1, 1, 3), (2, 2, 3), (0, 0, 2), (0, 2, 2)])
+        used, would_free = zb.get_snapshots_space('pool/ds', snapshots, prune=4)
+        self.assertEqual(list(used), [[2, 3, 3], [0, 0], [2]])
+        zb = BlockModelBridge(snapshots, [(1, 1, 3), (2, 2, 5)])  # s1 alone isn't queried inside s0%s1 of 3
+        used, would_free = zb.get_snapshots_space('pool/ds', snapshots, prune=4)
+        self.assertEqual(would_free[0][1], 0)
+        self.assertEqual(used[2][0], 0)
+        self.assertTrue(all(size >= 0 for row in used for size in row))
+        ss = SnapshotSpace('pool/ds', zb, prune=4)
+        self.assertTrue(ss.render(0.368))
+
+    def test_pool_index(self):
+        zb = BlockModelBridge(['s0', 's1'], [])
+        self.assertEqual(zb.get_dataset_summary('pool/ds'), [('NAME', 'pool/ds'), ('AVAIL', 100), ('USED', 50),
+                                                             ('USEDSNAP', 40), ('USEDDS', 10), ('USEDREFRESERV', 0),
+                                                             ('USEDCHILD', 0)])
+        self.assertEqual([child[0][1] for child in zb.get_children_summary('pool')], ['pool/ds'])
+        self.assertEqual(zb.get_filesystem_mountpoint('pool/ds'), '/pool/ds')
+        self.assertEqual(zb.get_snapshot_names('pool/ds'), ['s0', 's1'])
+        self.assertEqual(zb.get_snapshot_identities('pool/ds')[1], SnapshotInfo('s1', 1001, 11, 1_600_000_001))
+        with self.assertRaises(ValueError):
+            zb.get_snapshot_names('pool/dss')
+
+    def test_heaviest_datasets(self):
+        zb = BlockModelBridge([], [])
+        tree = [('pool', 1000, 990), ('pool/a', 600, 500), ('pool/a/x', 400, 0), ('pool/a/y', 100, 0),
+                ('pool/b', 390, 0), ('pool/c', 0, 0)]
+        zb.index = PoolIndex(['{}\tfilesystem\t0\t{}\t0\t0\t0\t{}\t-\t0\t1\t1\t1'.format(name, used, child)
+                              for name, used, child in tree])
+        self.assertEqual(heaviest_datasets(zb, 'pool', 2), [(400, 'pool/a/x'), (390, 'pool/b')])
+        self.assertEqual(heaviest_datasets(zb, 'pool/a', 5), [(400, 'pool/a/x'), (100, 'pool/a/y'), (100, 'pool/a')])
+
+    def test_scan_filesystem(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'a', 'deep'))
+            os.makedirs(os.path.join(root, 'child'))
+            for name, size in (('a/deep/big', 300_000), ('a/small', 5_000), ('file', 70_000), ('child/x', 9_000)):
+                with open(os.path.join(root, name), 'wb') as f:
+                    f.write(os.urandom(size))
+            os.link(os.path.join(root, 'a', 'deep', 'big'), os.path.join(root, 'a', 'deep', 'big_link'))
+
+            def blocks(*names):
+                return sum(os.lstat(os.path.join(root, name)).st_blocks * 512 for name in names)
+
+            result = scan_filesystem(root, jobs=2, top=2, exclude=[os.path.join(root, 'child')])
+            self.assertEqual(result.files, 4)
+            self.assertEqual(dict(result.top_entries()), dict(a=blocks('a', 'a/deep', 'a/deep/big', 'a/small'),
+                                                              file=blocks('file')))
+            heaviest = result.heaviest_directories()
+            self.assertEqual(heaviest[0], (blocks('a/deep/big'), os.path.join(root, 'a', 'deep')))
+            # The hardlinked file is forgotten once both of its links are seen
+            walk = _Walk(root, os.lstat(root).st_dev, set(), 2)
+            walk.worker()
+            self.assertEqual(walk.result.files, 5)
+            self.assertEqual(walk.unseen_links, dict())
+
+        with tempfile.TemporaryDirectory() as root:  # Workers share the directories of a wide and deep tree
+            total = 0
+            for i in range(40):
+                directory = os.path.join(root, *('d{}'.format(j) for j in range(i % 7 + 1))) + str(i)
+                os.makedirs(directory)
+                with open(os.path.join(directory, 'f'), 'wb') as f:
+                    f.write(os.urandom(5_000))
+            for directory, subdirs, files in os.walk(root):
+                total += sum(os.lstat(os.path.join(directory, name)).st_blocks * 512 for name in subdirs + files)
+            for jobs in (1, 4):
+                result = scan_filesystem(root, jobs=jobs)
+                self.assertEqual((result.files, sum(size for _, size in result.top_entries())), (40, total))
+
+        with tempfile.TemporaryDirectory() as root:  # Empty files only
+            open(os.path.join(root, 'empty'), 'w').close()
+            with io.StringIO() as out, contextlib.redirect_stdout(out):
+                _print_scan(BlockModelBridge([], []), 'pool/ds', root)
+                self.assertIn('Scanned 1 files', out.getvalue())
+
+        # Millions of top level entries are summed in bounded memory, keeping the heavy ones
+        sizes = TopSizes(capacity=10)
+        for i in range(10000):
+            sizes.add('small{}'.format(i), 1)
+            if i % 100 == 0:
+                sizes.add('big', 50)
+        self.assertEqual(len(sizes.sums), 10)
+        self.assertEqual(sizes.total, 10000 + 5000)
+        self.assertEqual(sizes.items()[0][0], 'big')
+        self.assertGreaterEqual(sizes.items()[0][1], 5000)
+
+    def test_attribute_changes(self):
+        with tempfile.TemporaryDirectory() as mountpoint:
+            root = os.path.join(mountpoint, '.zfs', 'snapshot', 'b')
+            os.makedirs(os.path.join(root, 'logs', 'app'))
+            for name, size in (('logs/app/one.log', 200_000), ('logs/app/my file', 60_000), ('logs/old', 90_000),
+                               ('data', 30_000)):
+                with open(os.path.join(root, name), 'wb') as f:
+                    f.write(os.urandom(size))
+            os.utime(os.path.join(root, 'logs', 'old'), (1000, 1000))  # Written before the range
+
+            def blocks(name):
+                return os.lstat(os.path.join(root, name)).st_blocks * 512
+
+            diff = ['M\t{}/logs/app\n'.format(mountpoint),
+                    '-\t{}/logs/app/one.log\n'.format(mountpoint),
+                    'M\t{}/logs/app/my\\0040file\n'.format(mountpoint),
+                    '-\t{}/logs/old\n'.format(mountpoint),
+                    'R\t{0}/data\t{0}/data.moved\n'.format(mountpoint),
+                    '+\t{}/new\n'.format(mountpoint),
+                    '-\t{}/gone\n'.format(mountpoint)]
+            self.assertEqual(list(parse_zfs_diff(diff[4:5])),
+                             [('R', mountpoint + '/data', mountpoint + '/data.moved')])
+            result = attribute_changes(parse_zfs_diff(diff), mountpoint, root, jobs=2, top=2, since=2000)
+            self.assertEqual(result.changes, 7)
+            self.assertEqual(result.files, 2)  # The renamed file still holds its blocks in the live filesystem
+            self.assertEqual(result.errors, 1)
+            app = blocks('logs/app/one.log') + blocks('logs/app/my file')
+            self.assertEqual(result.total, app)
+            self.assertEqual(result.modified, blocks('logs/app/my file'))
+            self.assertEqual(result.heaviest_directories(), [(app, 'logs/app')])
+            self.assertEqual(dict(result.top_entries()), dict(logs=app))
+            self.assertEqual([(path, modified) for _, path, modified in result.largest_files()],
+                             [('logs/app/one.log', False), ('logs/app/my file', True)])
+
+    def test_frame_rendering(self):
+        snapshots = ['snap-{:03}'.format(i) for i in range(60)]
+        blocks = [(i, min(i + i % 4, 59), (i + 1) * 10 ** 7) for i in range(60)]
+        zb = BlockModelBridge(snapshots, blocks)
+        ss = SnapshotSpace('pool/ds', zb, bucket_by='count', buckets=60)
+        frame = ss.render(0.5)
+        self.assertEqual(frame.count('\n'), 61)
+        self.assertNotIn('......', frame)  # Narrow cells get short sizes instead of dots
+
+        view = PyramidView(ss, 0.5)
+        lines = view.render(80, 12)
+        self.assertEqual(len(lines), 12)
+        cells = [text for line in lines[1:-2] for _, text, _ in line if text != '|']
+        self.assertEqual(len(cells), 7 + 7 + 6 + 6 + 5 + 5 + 4 + 4 + 3)  # Only the cells in 9 rows of 80 columns
+        view.move(rows=3, cols=50)
+        lines = view.render(80, 12)
+        self.assertIn('pool/ds@snap-050%snap-053: 4 snapshot(s)', lines[-1][0][1])
+        self.assertIn('cursor', [style for line in lines for _, _, style in line])
+        if curses is not None:
+            browser = Browser(zb, 'pool/ds', dict(bucket_by='count', buckets=60))
+            for key in (curses.KEY_RIGHT, curses.KEY_UP, ord('+'), ord('\t')):
+                self.assertTrue(browser.handle(key))
+            self.assertIs(browser.views[-1], browser.tree)
+            browser.handle(ord('\t'))
+            self.assertEqual((browser.views[-1].row, browser.views[-1].col, browser.views[-1].zoom), (1, 1, 4))
+            self.assertFalse(browser.handle(ord('q')))
+
+    def test_history(self):
+        snapshots = ['s0', 's1', 's2', 's3']
+        blocks = [(0, 0, 10), (0, 2, 7), (1, 3, 5), (2, 2, 3)]
+        day = 86400
+        with tempfile.TemporaryDirectory() as directory:
+            store = HistoryStore(os.path.join(directory, 'history.sqlite'))
+            zb = BlockModelBridge(snapshots, blocks)
+            zb.history = store
+            SnapshotSpace('pool/ds', zb)
+            store.record(zb, 'pool', now=day)
+            store.record(zb, 'pool', now=2 * day)  # Nothing changed, so nothing but the run is written
+            zb.blocks = blocks + [(1, 2, 100)]
+            zb.index.datasets['pool/ds']['used'] += 1000
+            zb.index.datasets['pool']['used'] += 1000
+            SnapshotSpace('pool/ds', zb)
+            store.record(zb, 'pool', now=3 * day)
+            del zb.index.datasets['pool/ds']
+            store.record(zb, 'pool', now=4 * day)
+
+            db = store._connect()
+            self.assertEqual(db.execute('SELECT count(*) FROM space').fetchone()[0], 2 + 2 + 1)
+            self.assertEqual(db.execute('SELECT count(*) FROM snapshots').fetchone()[0], 4)
+            self.assertEqual(db.execute('SELECT count(*) FROM cells').fetchone()[0], 10 + 4)  # Ranges with s1 and s2
+            self.assertEqual(store.samples(), (4, day, 4 * day))
+            # The value holds from the start of the period to the last run, though it changed on the third day
+            self.assertEqual(store.dataset_growth('pool', 2.5 * day), ('pool', 1060, 1000, 2 * day, 500))
+            self.assertIsNone(store.dataset_growth('pool/ds', 0))  # Destroyed
+            self.assertEqual(store.top_growers('pool', day), [('pool', 1060, 1000, 3 * day, 1000 / 3)])
+            growers = store.range_growers('pool/ds', 0, top=4)
+            self.assertEqual(sorted((growth.name, growth.change) for growth in growers),
+                             [('pool/ds@s0%s2', 100), ('pool/ds@s0%s3', 100), ('pool/ds@s1%s2', 100),
+                              ('pool/ds@s1%s3', 100)])
+            store.close()
+
+    def test_fake_zfs(self):
+        with fake_zfs(6, seed=3) as state_file:
+            with open(state_file) as f:
+                state = json.load(f)
+            zb = ZfsBridge(jobs=2, zfs_path=FAKE_ZFS)
+            snapshots = zb.get_snapshot_names('pool/data')
+            _, would_free = zb.get_snapshots_space('pool/data', snapshots)
+            comma_list = zb._run('destroy', '-nvp', 'pool/data@auto-00000,auto-00002%auto-00003')
+
+        def freed(indexes):
+            return sum(size for first, last, size in state['blocks']['pool/data']
+                       if last < 6 and set(range(first, last + 1)) <= set(indexes))
+
+        self.assertEqual(len(snapshots), 6)
+        for row in range(6):
+            self.assertEqual(would_free.row(row), [freed(range(col, col + row + 1)) for col in range(6 - row)])
+        self.assertEqual(zb.get_dataset_summary('pool/data')[3], ('USEDSNAP', would_free.get(5, 0)))
+        self.assertEqual(zb.get_filesystem_mountpoint('pool/vol'), None)
+        self.assertEqual(int(zb._parse_reclaim(comma_list)), freed([0, 2, 3]))
+
+    def test_progressive(self):
+        with fake_zfs(6, seed=4):
+            zb = ZfsBridge(jobs=3, zfs_path=FAKE_ZFS)
+            exclusive, would_free = zb.get_snapshots_space('pool/data', zb.get_snapshot_names('pool/data'))
+            cells = list()
+            ss = SnapshotSpace('pool/data', zb, progressive=True)
+            ss.query_progressive(lambda *cell: cells.append(cell))
+            printed = SnapshotSpace('pool/data', zb, progressive=True)
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                printed.print_used(0.368)
+            # Progressive queries go through the transport of the bridge
+            for transport in (ShellTransport(FAKE_ZFS), CoprocessTransport(FAKE_ZFS, processes=2)):
+                bridge = ZfsBridge(jobs=3, transport=transport)
+                try:
+                    through = SnapshotSpace('pool/data', bridge, progressive=True)
+                    through.query_progressive()
+                finally:
+                    transport.close()
+                self.assertEqual((through.snapshot_size_matrix, through.would_free_matrix), (exclusive, would_free))
+        self.assertEqual(ss.snapshot_size_matrix, exclusive)
+        self.assertEqual(ss.would_free_matrix, would_free)
+        self.assertEqual(sorted(cells), sorted((row, col, exclusive.get(row, col), would_free.get(row, col))
+                                               for row in range(6) for col in range(6 - row)))
+        # Nothing is drawn ahead of the final pyramid when the output is not a terminal
+        self.assertEqual(out.getvalue(), printed.render(0.368))
+
+    def test_quick_summary(self):
+        with fake_zfs(4, seed=3):
+            profiler = Profiler()
+            zb = ZfsBridge(zfs_path=FAKE_ZFS, profiler=profiler, index=False)
+            summary = zb.get_dataset_summary('pool/data')
+            self.assertEqual(len(profiler.commands), 1)
+            self.assertIsNone(zb.index)
+            with self.assertRaisesRegex(ValueError, 'Did you mean'):
+                zb.get_dataset_summary('pool/dta')
+            # Only the suggestion is printed, not the error of the failed quick listing too
+            wrong_name = subprocess.run([sys.executable, '-m', 'zfspace', '--summary', '--zfs-path',
+                                         os.path.abspath(FAKE_ZFS), 'pool/dta'], cwd='src',
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            full = ZfsBridge(zfs_path=FAKE_ZFS)
+        self.assertEqual(summary, full.get_dataset_summary('pool/data'))
+        # A plain --summary is read without argparse, the same way argparse reads it
+        for argv in (['--summary', 'pool/data'], ['pool/data', '--format=json', '--summary', '--zfs-path', '/z'],
+                     ['--transport', 'shell', '--summary', 'pool/data']):
+            quick, parsed = _parse_summary_args(argv), _make_parser().parse_args(argv)
+            self.assertEqual(vars(quick),
+                             {name: getattr(parsed, name) for name in vars(quick)})
+        for argv in (['pool/data'], ['--summary', '--format=xml', 'pool/data'], ['--summary', '-r', 'pool/data'],
+                     ['--summary', 'pool/data', 'pool/other'], ['--summary', 'pool/data', '--format']):
+            self.assertIsNone(_parse_summary_args(argv))
+        # A pool named like a subcommand is escaped with "--"
+        self.assertEqual(_parse_args(['--', 'history']).dataset_name, 'history')
+        self.assertEqual(_parse_args(['--summary', '--', 'history']).dataset_name, 'history')
+        self.assertEqual(_parse_args(['-r', '--', 'fleet']).dataset_name, 'fleet')
+        self.assertEqual(wrong_name.returncode, 1)
+        self.assertEqual(wrong_name.stderr, '')
+        self.assertIn('Did you mean', wrong_name.stdout)
+        self.assertEqual(zb.get_snapshot_names('pool/data'), full.get_snapshot_names('pool/data'))
+        # A failed listing is an error, not an empty pool
+        with self.assertRaisesRegex(OSError, 'failed: exit code 1'):
+            ZfsBridge(zfs_path='/bin/false')
+        broken = ZfsBridge(zfs_path='/bin/false', index=False)
+        with self.assertRaisesRegex(OSError, 'failed: exit code 1'):
+            broken.get_snapshot_names('pool/data')
+
+    def test_estimate(self):
+        with fake_zfs(12, seed=5) as state_file:
+            directory = os.path.dirname(state_file)
+            profiler = Profiler()
+            zb = ZfsBridge(jobs=2, zfs_path=FAKE_ZFS, profiler=profiler)
+            exact = SnapshotSpace('pool/data', zb)
+            queries = len(profiler.commands)
+            estimated = SnapshotSpace('pool/data', zb, estimate=True)
+            self.assertEqual(len(profiler.commands) - queries, 2)
+            drilled = SnapshotSpace('pool/data', zb, drill=1, buckets=4)
+            drilled_estimate = SnapshotSpace('pool/data', zb, drill=1, buckets=4, estimate=True, refine=2)
+            # Callers deciding when to query estimate the pyramid once
+            calls = list()
+            for make in (lambda bridge: SnapshotSpace('pool/data', bridge, estimate=True, refine=2),
+                         lambda bridge: Exporter(bridge, 'pool/data',
+                                                 snapshot_args=dict(estimate=True, refine=2)).refresh(),
+                         lambda bridge: RetentionSimulator(bridge, 'pool/data', dict(estimate=True, refine=2))):
+                bridge = ZfsBridge(jobs=2, zfs_path=FAKE_ZFS, profiler=profiler,
+                                   cache=RangeSpaceCache(os.path.join(directory, str(len(calls)))))
+                del profiler.commands[:]
+                make(bridge)
+                calls.append([sum(args[0] == command for args, _, _, _ in profiler.commands)
+                              for command in ('get', 'destroy')])
+            del profiler.commands[:]
+            RetentionSimulator(ZfsBridge(zfs_path=FAKE_ZFS, profiler=profiler), 'pool/data',
+                               dict(estimate=True, refine=2), max_queries=7)
+            self.assertFalse(any(args[0] in ('get', 'destroy') for args, _, _, _ in profiler.commands))
+
+        self.assertTrue(estimated.estimated)
+        self.assertEqual(estimated.error_bound, 0)
+        self.assertEqual(list(estimated.snapshot_size_matrix), list(exact.snapshot_size_matrix))
+        self.assertEqual(list(estimated.would_free_matrix), list(exact.would_free_matrix))
+        self.assertEqual(len(drilled_estimate.exact_cells), 2)
+        self.assertEqual(calls, [[2, 4]] * 3)
+        self.assertEqual(list(drilled_estimate.snapshot_size_matrix), list(drilled.snapshot_size_matrix))
+        self.assertEqual(list(drilled_estimate.would_free_matrix), list(drilled.would_free_matrix))
+
+    def test_fleet(self):
+        with tempfile.TemporaryDirectory() as directory:
+            hosts = list()
+            for name, seed in (('a', 1), ('b', 2)):
+                hosts.append('{}=env FAKE_ZFS_STATE={} {}'.format(name, make_fake_state(directory, 5, seed, name),
+                                                                  FAKE_ZFS))
+            hosts += ['slow=sh -c "sleep 3" zfs', 'broken=tests/no_such_zfs']
+            results = list(analyze_fleet([make_transport(spec) for spec in hosts], deadline=1.5, jobs=2))
+            os.environ['FAKE_ZFS_STATE'] = os.path.join(directory, 'a.json')
+            try:
+                own = pool_report(ZfsBridge(zfs_path=FAKE_ZFS), 'pool', 0.368)
+            finally:
+                del os.environ['FAKE_ZFS_STATE']
+
+        by_host = {result.host: result for result in results}
+        self.assertEqual([result.host for result in results][-1], 'slow')  # Reported at the deadline, after the rest
+        self.assertFalse(by_host['slow'].finished)
+        self.assertIsNone(by_host['slow'].items)
+        self.assertIn('not found', by_host['broken'].error)
+        self.assertEqual([(item.size, item.dataset, item.part) for item in by_host['a'].items],
+                         [(size, name, part) for size, name, part, _ in own])
+        report = fleet_report(results)
+        self.assertEqual(len(report), len(by_host['a'].items) + len(by_host['b'].items))
+        self.assertEqual([item.size for item in report], sorted((item.size for item in report), reverse=True))
+        name, command = make_transport('a=env FAKE_ZFS_STATE=a.json tests/fake_zfs.py')
+        self.assertEqual((name, command.zfs_path), ('a', 'tests/fake_zfs.py'))
+        self.assertEqual(command.argv(['list']), ['env', 'FAKE_ZFS_STATE=a.json', 'tests/fake_zfs.py', 'list'])
+        advice = ' '.join(item.advice for item in by_host['a'].items)
+        self.assertIn('"tests/fake_zfs.py set refreservation', advice)
+        self.assertNotIn('FAKE_ZFS_STATE', advice)  # The wrapper of the command is not a part of the advice
+        ssh = SshTransport('admin@node1', ssh='ssh -p 2222')
+        argv = ssh.argv(['destroy', '-nvp', 'pool/my data@a%b'])
+        self.assertEqual(argv[:4], ['ssh', '-p', '2222', '-n'])
+        self.assertEqual(argv[-6:], ['admin@node1', '--', '/sbin/zfs', 'destroy', '-nvp', "'pool/my data@a%b'"])
+
+    def test_transport_lines(self):
+        for transport in (ShellTransport('printf'), ExecTransport('printf'), CoprocessTransport('printf')):
+            self.assertEqual(list(transport.lines(['a\\nb c\\n\\nd'])), ['a\n', 'b c\n', '\n', 'd'])
+            self.assertEqual(list(transport.lines(['a\\n'])), ['a\n'])
+            transport.zfs_path = 'ls'
+            with self.assertRaisesRegex(OSError, 'failed: .*zfspace-missing'):
+                list(transport.lines(['/zfspace-missing']))
+            transport.zfs_path = 'printf'
+            self.assertEqual(list(transport.lines(['done'])), ['done'])  # The shell is still usable after a failure
+            transport.close()
+
+    def test_coprocess_transport(self):
+        transport = CoprocessTransport('printf', processes=1)
+        # Outputs of consecutive commands in the same shell are told apart by the sentinel
+        self.assertEqual(transport.run(['a\\nb\\n']), 'a\nb\n')
+        self.assertEqual(transport.run(['no new line']), 'no new line')
+        self.assertEqual(transport.run(['']), '')
+        self.assertEqual(transport.run(['\\n\\n']), '\n\n')
+        shell = transport._idle[0]
+        shell.process.kill()  # A dead shell is replaced with a new one after the command fails
+        with self.assertRaises(OSError):
+            transport.run(['lost'])
+        self.assertEqual(transport.run(['back']), 'back')
+        self.assertIsNot(transport._idle[0], shell)
+        transport.close()
+
+        with tempfile.TemporaryDirectory() as directory:
+            pid_file = os.path.join(directory, 'pid')
+            transport = CoprocessTransport('sh')
+            with self.assertRaises(TimeoutError):
+                transport.run(['-c', 'echo $$ > {}; exec sleep 60'.format(pid_file)], timeout=0.5)
+            with open(pid_file) as f:
+                pid = int(f.read())
+            # The command is killed with the shell, at most a zombie is left for init to reap
+            with contextlib.suppress(FileNotFoundError):
+                for _ in range(50):
+                    with open('/proc/{}/stat'.format(pid)) as f:
+                        if f.read().rsplit(')', 1)[1].split()[0] == 'Z':
+                            break
+                    time.sleep(0.1)
+                else:
+                    self.fail('The command outlived its shell')
+            self.assertEqual(transport.run(['-c', 'echo alive']), 'alive\n')
+            transport.close()
+
+    def test_profiler(self):
+        class EchoTransport:
+            zfs_path = 'echo'
+
+            def run(self, args, timeout=None):
+                if args[0] == 'fail':
+                    raise TimeoutError()
+                return ' '.join(args) + '\n'
+
+            def lines(self, args):
+                yield from self.run(args).splitlines(keepends=True)
+
+        transport = EchoTransport()
+        self.assertIs(Profiler(enabled=False).wrap(transport), transport)
+        profiler = Profiler()
+        wrapped = profiler.wrap(transport)
+        self.assertEqual(wrapped.zfs_path, 'echo')
+        with profiler.phase('queries'):
+            self.assertEqual(wrapped.run(['destroy', '-nvp']), 'destroy -nvp\n')
+            self.assertEqual(list(wrapped.lines(['list'])), ['list\n'])
+            with self.assertRaises(TimeoutError):
+                wrapped.run(['fail'])
+        self.assertEqual([(args, size) for args, _, _, size in profiler.commands],
+                         [(['destroy', '-nvp'], 13), (['list'], 5), (['fail'], None)])
+        self.assertEqual([name for name, _, _ in profiler.phases], ['queries'])
+        self.assertEqual(sum(count for _, count in profiler.histogram()), 3)
+        self.assertEqual(len(profiler.to_dict()['commands']), 3)
+
+    def test_structured_output(self):
+        snapshots = ['s0', 's1', 's2']
+        blocks = [(0, 0, 10), (0, 1, 7), (1, 2, 5), (2, 2, 3)]
+        zb = BlockModelBridge(snapshots, blocks)
+        stream = io.StringIO()
+        output = JsonOutput(stream)
+        emit_analysis(zb, 'pool/ds', output, 0.5)
+        output.close()
+        document = json.loads(stream.getvalue())
+        self.assertEqual(document['dataset'], 'pool/ds')
+        self.assertEqual(document['space']['USEDSNAP'], 40)
+        self.assertEqual([part['part'] for part in document['parts']], ['USEDSNAP'])
+        part = document['parts'][0]
+        self.assertEqual(part['exclusive'], [[10, 0, 3], [7, 5], [0]])
+        self.assertEqual(part['would_free'], [[10, 0, 3], [17, 8], [25]])
+        self.assertEqual(part['recommendations'][0]['command'], '/sbin/zfs destroy pool/ds@s0%s2')
+
+        stream = io.StringIO()
+        emit_analysis(zb, 'pool/ds', NdjsonOutput(stream), 1, dict(prune=0))
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([record['type'] for record in records[:3]], ['summary', 'part', 'snapshots'])
+        cells = [record for record in records if record['type'] == 'cell']
+        self.assertEqual(len(cells), 6)
+        self.assertEqual(cells[-1], dict(type='cell', row=2, col=0, first='s0', last='s2', snapshots=3,
+                                         exclusive=0, would_free=25))
+        self.assertEqual([record['part'] for record in records if record['type'] == 'part'], ['USEDSNAP', 'USEDDS'])
+
+    def test_exporter(self):
+        snapshots = ['s0', 's1', 's2', 's3', 's4']
+        blocks = [(0, 0, 10), (0, 2, 7), (1, 3, 5), (2, 2, 3), (3, 4, 11)]
+        with tempfile.TemporaryDirectory() as directory:
+            zb = BlockModelBridge(snapshots, blocks, cache=RangeSpaceCache(directory))
+            exporter = Exporter(zb, 'pool', recursive=True)
+            metrics = exporter.refresh()
+            self.assertEqual(zb.queries, 15)
+            self.assertIn('zfspace_space_bytes{dataset="pool/ds",column="USEDSNAP"} 40\n', metrics)
+            self.assertIn('zfspace_snapshot_range_bytes{dataset="pool/ds",length="3",age="2",kind="would_free"} 20\n',
+                          metrics)
+            self.assertIn('zfspace_destroy_candidate_snapshots{dataset="pool/ds",rank="1"} ', metrics)
+            self.assertNotIn('"s0"', metrics)  # Snapshot names would start new series as snapshots rotate
+            self.assertIn('zfspace_pyramid_stale{dataset="pool/ds"} 0\n', metrics)
+            self.assertEqual(metrics.count('# TYPE zfspace_space_bytes gauge'), 1)
+            exporter.refresh()
+            self.assertEqual(zb.queries, 15)  # Nothing has changed
+            zb.index.datasets['pool/ds']['usedbysnapshots'] = 41
+            exporter.refresh()
+            self.assertEqual(zb.queries, 20)  # Only ranges ending at the newest snapshot are not cached
+            path = os.path.join(directory, 'zfspace.prom')
+            exporter.write_textfile(path)
+            with open(path) as f:
+                self.assertEqual(f.read(), exporter.get_metrics())
+            server = serve_metrics(exporter, '127.0.0.1:0')  # Any free port
+            try:
+                url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+                with urllib.request.urlopen(url + '/metrics') as response:
+                    self.assertEqual(response.headers['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+                    self.assertEqual(response.read().decode(), exporter.get_metrics())
+                with self.assertRaises(urllib.error.HTTPError) as error:
+                    urllib.request.urlopen(url + '/other')
+                self.assertEqual(error.exception.code, 404)
+                error.exception.close()
+            finally:
+                server.shutdown()
+                server.server_close()
+            os.remove(path)
+            run_exporter(exporter, textfile=path, listen='127.0.0.1:0', once=True)  # Stops its server on return
+            with open(path) as f:
+                self.assertEqual(f.read(), exporter.get_metrics())
+        # Without a cache every change queries the whole pyramid again
+        zb = BlockModelBridge(snapshots, blocks)
+        exporter = Exporter(zb, 'pool/ds')
+        exporter.refresh()
+        zb.index.datasets['pool/ds']['usedbysnapshots'] = 41
+        exporter.refresh()
+        self.assertIsNone(zb.cache)
+        self.assertEqual(zb.queries, 30)
+
+    def test_deletion_planner(self):
+        snapshots = ['s0', 's1', 's2', 's3', 's4', 's5']
+        blocks = [(0, 0, 10), (1, 2, 30), (2, 2, 1), (3, 3, 2), (4, 5, 25), (0, 5, 100), (5, 5, 4)]
+        zb = BlockModelBridge(snapshots, blocks)
+        ss = SnapshotSpace('pool/ds', zb)
+        planner = DeletionPlanner(ss)
+        # The best set is not a contiguous range: s1, s2, s4 and s5 free 30 + 1 + 25 + 4
+        plan = planner.plan(target=60)
+        self.assertEqual((plan.runs, plan.snapshots, plan.freed), ([(1, 2), (4, 5)], 4, 60))
+        self.assertEqual(planner.destroy_spec(plan.runs), 'pool/ds@s1%s2,s4%s5')
+        queries = zb.queries
+        self.assertEqual(planner.dry_run(plan.runs), 60)
+        self.assertEqual(planner.dry_run(plan.runs), 60)
+        self.assertEqual(zb.queries, queries + 1)
+        self.assertEqual(planner.plan(max_snapshots=2).runs, [(1, 2)])
+        self.assertEqual(planner.plan(max_snapshots=3).freed, 41)
+        self.assertIsNone(planner.plan(target=1000))
+        self.assertEqual(planner.plan(target=170).runs, [(0, 5)])
+        # All snapshots are made in the same hour, so one of them has to stay
+        self.assertIsNone(DeletionPlanner(ss, keep='hour').plan(target=170))
+
+        # Zeros of a pruned pyramid would mislead the plan
+        blocks = [(i, i, 3) for i in range(6)]
+        self.assertEqual(DeletionPlanner(SnapshotSpace('pool/ds', BlockModelBridge(snapshots, blocks), prune=0))
+                         .plan(target=6).snapshots, 2)
+        with self.assertRaisesRegex(ValueError, '--prune'):
+            DeletionPlanner(SnapshotSpace('pool/ds', BlockModelBridge(snapshots, blocks), prune=7))
+
+        # Hundreds of columns are planned exactly
+        snapshots = ['s{}'.format(i) for i in range(240)]
+        blocks = [(i, min(i + i % 5, 239), 1 + i % 7) for i in range(240)]
+        ss = SnapshotSpace('pool/ds', BlockModelBridge(snapshots, blocks), buckets=240, bucket_by='count')
+        self.assertEqual(len(ss.columns), 240)
+        plan = DeletionPlanner(ss).plan(max_snapshots=5)
+        best = max(ss.would_free_matrix.get(last - first, first) for first in range(240)
+                   for last in range(first, min(first + 5, 240)))
+        self.assertGreaterEqual(plan.freed, best)
+
+    def test_retention_simulation(self):
+        snapshots = ['s0', 's1', 's2', 's3', 's4', 's5']
+        blocks = [(0, 0, 10), (1, 2, 30), (2, 2, 1), (3, 3, 2), (4, 5, 25), (0, 5, 100), (5, 5, 4)]
+        zb = BlockModelBridge(snapshots, blocks)
+        identities = zb.get_snapshot_identities('pool/ds')
+        self.assertEqual(RetentionPolicy('last=2').kept(identities), {4, 5})
+        self.assertEqual(RetentionPolicy('last=1,hourly=3').kept(identities), {5})  # All are made in one hour
+        with self.assertRaises(ValueError):
+            RetentionPolicy('fortnightly=2')
+        policies = [RetentionPolicy('last=2'), RetentionPolicy('hourly=1'), RetentionPolicy('last=6')]
+        # Without the pyramid in the cache a comma separated dry-run per policy is cheaper
+        results = simulate(zb, ['pool/ds'], policies)
+        self.assertEqual(zb.queries, 2)
+        self.assertEqual([(result.kept, result.destroyed, result.freed, result.queried_runs) for result in results],
+                         [(2, 4, 43, 1), (1, 5, 43, 1), (6, 0, 0, 0)])
+        simulator = RetentionSimulator(zb, 'pool/ds')
+        self.assertEqual(simulator.evaluate(policies[0]), (2, 4, 43, 1, []))
+        # Estimated sizes that may be off are dry-run, unless all cells of the range were refined
+        simulator.ss.estimated, simulator.ss.error_bound = True, 5
+        simulator.ss.exact_cells = {(0, 0), (0, 1), (1, 0)}
+        self.assertEqual(simulator.evaluate(policies[0]), (2, 4, 0, 0, [(0, 3)]))
+        self.assertEqual(simulator.known_freed(0, 1), 10)
+        self.assertIsNone(simulator.known_freed(1, 2))